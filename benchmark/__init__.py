@@ -0,0 +1,5 @@
+r"""
+Micro-benchmarks of the data and model hot paths, on CPU against synthetic data (see `dataset/synthetic.py`).
+
+Run `python -m benchmark --help` from the project root.
+"""
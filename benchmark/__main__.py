@@ -0,0 +1,64 @@
+r"""
+Usage (from the project root):
+    python -m benchmark run --output results/benchmark/baseline.json
+    python -m benchmark run --cases split_by_day pack_batch --output results/benchmark/current.json
+    python -m benchmark compare results/benchmark/baseline.json results/benchmark/current.json --threshold 0.1
+"""
+import argparse
+import sys
+
+from benchmark import cases  # noqa: F401, 注册所有case
+from benchmark.context import BenchContext
+from benchmark.runner import CASES, run, save, load, compare
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmark")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_run = subparsers.add_parser("run", help="run the benchmark cases and save the results as JSON")
+    parser_run.add_argument("--cases", nargs="+", default=None, choices=list(CASES.keys()),
+                            help="cases to run, all by default")
+    parser_run.add_argument("--output", default=r"./results/benchmark/latest.json")
+    parser_run.add_argument("--data_dir", default=r"./data/benchmark", help="where the synthetic dataset is cached")
+    parser_run.add_argument("--scale", type=float, default=0.02, help="synthetic dataset size relative to MIMIC-III")
+    parser_run.add_argument("--seed", type=int, default=10043)
+    parser_run.add_argument("--batch_size", type=int, default=1024)
+    parser_run.add_argument("--repeat", type=int, default=5)
+    parser_run.add_argument("--warmup", type=int, default=1)
+
+    parser_compare = subparsers.add_parser("compare", help="flag the regressions of current results against a baseline")
+    parser_compare.add_argument("baseline")
+    parser_compare.add_argument("current")
+    parser_compare.add_argument("--threshold", type=float, default=0.1,
+                                help="relative slowdown of the median time regarded as a regression")
+    parser_compare.add_argument("--mem_threshold", type=float, default=None,
+                                help="relative growth of the tracemalloc peak regarded as a regression")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        ctx = BenchContext(args.data_dir, args.scale, args.seed, args.batch_size)
+        results = run(ctx, args.cases, args.repeat, args.warmup)
+        save(results, args.output)
+        print(f"> results saved to {args.output}")
+        return 0
+
+    baseline, current = load(args.baseline), load(args.current)
+    for key in ("scale", "seed", "batch_size"):
+        if baseline["meta"].get(key) != current["meta"].get(key):
+            print(f"WARNING: `{key}` differs between baseline and current results")
+
+    rows = compare(baseline, current, args.threshold, args.mem_threshold)
+    print(f"{'case':<32}{'baseline ms':>14}{'current ms':>14}{'ratio':>9}{'mem ratio':>11}")
+    for row in rows:
+        flag = "  REGRESSED" if row["regressed"] else ""
+        print(f"{row['case']:<32}{row['baseline_ms']:>14.3f}{row['current_ms']:>14.3f}"
+              f"{row['time_ratio']:>9.3f}{row['mem_ratio']:>11.3f}{flag}")
+    num_regressed = sum(row["regressed"] for row in rows)
+    print(f"> {num_regressed} of {len(rows)} cases regressed")
+    return 1 if num_regressed > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+r"""
+Benchmark cases of the data and model hot paths. Each case's setup builds its inputs from the `BenchContext`
+(not timed) and returns the function to be timed.
+"""
+import numpy as np
+import torch
+
+from benchmark.runner import register
+from dataset.unified import SourceDataFrames, OneAdmOneHG, DFDataset, string2list
+from model.backbone import BackBoneV2
+from model.sequential_recommender import DIN, SASRec
+from model.context_aware_recommender import DSSM
+from utils.optim import get_optimizer
+
+
+# ---------------------------------------- data: backbone ---------------------------------------- #
+
+@register("source_dataframes_init", repeat=1)
+def source_dataframes_init(ctx):
+    data_dir = ctx.prepare_data()
+    return lambda: SourceDataFrames(data_dir)
+
+
+@register("onehg_getitem")
+def onehg_getitem(ctx):
+    dataset = ctx.hg_dataset
+    indices = list(range(min(16, len(dataset))))
+    return lambda: [dataset[idx] for idx in indices]
+
+
+@register("split_by_day")
+def split_by_day(ctx):
+    hg = ctx.long_hg
+    return lambda: OneAdmOneHG.split_by_day(hg)
+
+
+@register("pack_batch")
+def pack_batch(ctx):
+    hgs = ctx.long_hg_days
+    return lambda: OneAdmOneHG.pack_batch(hgs, len(hgs))
+
+
+@register("neg_sample_for_cur_day")
+def neg_sample_for_cur_day(ctx):
+    num_drugs = len(ctx.source_dfs.drugid2mappedid)
+    pos_indices = [hg["admission", "took", "drug"].edge_index for hg in ctx.long_hg_days]
+    return lambda: [OneAdmOneHG.neg_sample_for_cur_day(pos, num_itm_nodes=num_drugs) for pos in pos_indices]
+
+
+# ---------------------------------------- model: backbone ---------------------------------------- #
+
+@register("backbone_forward")
+def backbone_forward(ctx):
+    model, hg = ctx.backbone, ctx.long_hg
+    model.eval()
+
+    def fn():
+        with torch.no_grad():
+            return model(hg.clone())  # forward会原地修改hg的特征，计时包含clone
+    return fn
+
+
+@register("backbone_forward_backward")
+def backbone_forward_backward(ctx):
+    model, hg = ctx.backbone, ctx.long_hg
+
+    def fn():
+        model.train()
+        model.zero_grad()
+        logits, labels = model(hg.clone())
+        BackBoneV2.get_loss(logits, labels).backward()
+    return fn
+
+
+# ---------------------------------------- data: baselines ---------------------------------------- #
+
+@register("all_day_neg_samples")
+def all_day_neg_samples(ctx):
+    dataset = ctx.drug_dataset
+    mappedid, pos_shard = ctx.long_pos_shard
+    return lambda: dataset._all_day_neg_samples(pos_shard, mappedid)
+
+
+@register("add_history_seq")
+def add_history_seq(ctx):
+    dataset = ctx.seq_dataset
+    mappedid, pos_shard = ctx.long_pos_shard
+    ctx.reseed()
+    interaction = dataset._all_day_neg_samples(pos_shard, mappedid)
+    return lambda: dataset._add_history_seq(pos_shard, interaction)
+
+
+@register("dfdataset_collect_fn")
+def dfdataset_collect_fn(ctx):
+    rows = ctx.seq_rows
+    return lambda: DFDataset.collect_fn(rows)
+
+
+@register("columnar_take")
+def columnar_take(ctx):
+    table = ctx.seq_table
+    indices = np.sort(np.random.default_rng(ctx.seed).choice(len(table), ctx.batch_size, replace=False))
+    return lambda: table.take_tensors(indices)
+
+
+@register("string2list")
+def string2list_case(ctx):
+    histories = [row["history"] for row in ctx.seq_rows]
+    return lambda: [string2list(h) for h in histories]
+
+
+# ---------------------------------------- model: baselines ---------------------------------------- #
+
+@register("sequential_embedding_forward")
+def sequential_embedding_forward(ctx):
+    layer, batch = ctx.seq_embedding_layer, ctx.seq_batch
+
+    def fn():
+        with torch.no_grad():
+            return layer(batch)
+    return fn
+
+
+@register("sequential_embedding_forward_backward")
+def sequential_embedding_forward_backward(ctx):
+    layer, batch = ctx.make_seq_embedding_layer(), ctx.seq_train_batch
+
+    def fn():
+        layer.zero_grad()
+        user_embedding, item_seqs_embedding = layer(batch)
+        (user_embedding.sum() + item_seqs_embedding.sum()).backward()
+    return fn
+
+
+def _grouped_history_forward_backward(ctx, model_class):
+    """按(住院, 天)只编码一次历史序列（默认的group_history=True）的前向+反向"""
+    batch = ctx.seq_train_batch
+    ctx.reseed()
+    model = model_class(ctx.baseline_config(group_history=True), ctx.seq_dataset)
+    model.train()
+
+    def fn():
+        model.zero_grad()
+        model.calculate_loss(batch).backward()
+    return fn
+
+
+@register("din_forward_backward")
+def din_forward_backward(ctx):
+    return _grouped_history_forward_backward(ctx, DIN)
+
+
+@register("sasrec_forward_backward")
+def sasrec_forward_backward(ctx):
+    return _grouped_history_forward_backward(ctx, SASRec)
+
+
+@register("dssm_predict")
+def dssm_predict(ctx):
+    """物品塔输出取自缓存的`DSSM.predict`"""
+    batch = ctx.context_train_batch
+    ctx.reseed()
+    model = DSSM(ctx.baseline_config(double_tower=True), ctx.context_dataset)
+    model.eval()
+
+    def fn():
+        with torch.no_grad():
+            return model.predict(batch)
+    return fn
+
+
+def _embedding_train_step(ctx, sparse_embedding):
+    r"""序列推荐embedding层的一步训练（前向+反向+优化器更新），embedding表为稀疏/稠密梯度"""
+    layer = ctx.make_seq_embedding_layer(sparse_embedding)
+    optimizer = get_optimizer(layer, 1e-3, sparse_embedding)
+    batch = ctx.seq_train_batch
+
+    def fn():
+        optimizer.zero_grad()
+        user_embedding, item_seqs_embedding = layer(batch)
+        (user_embedding.sum() + item_seqs_embedding.sum()).backward()
+        optimizer.step()
+    return fn
+
+
+@register("embedding_train_step_dense")
+def embedding_train_step_dense(ctx):
+    return _embedding_train_step(ctx, sparse_embedding=False)
+
+
+@register("embedding_train_step_sparse")
+def embedding_train_step_sparse(ctx):
+    return _embedding_train_step(ctx, sparse_embedding=True)
+
+
+# ---------------------------------------- metrics ---------------------------------------- #
+
+@register("ddi_calc_rate")
+def ddi_calc_rate(ctx):
+    calculator, drug_sets = ctx.ddi_calculator, ctx.ddi_drug_sets
+    return lambda: [calculator.calc_ddi_rate(drugs) for drugs in drug_sets]
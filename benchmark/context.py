@@ -0,0 +1,216 @@
+r"""
+Shared fixtures of the benchmark cases, built lazily on synthetic data (see `dataset/synthetic.py`).
+"""
+import os
+import dill
+import numpy as np
+import pandas as pd
+import torch
+
+from functools import cached_property
+from typing import Dict
+
+from dataset.synthetic import SyntheticConfig, generate
+from dataset.columnar import ColumnarTable
+from dataset.unified import (SourceDataFrames,
+                             OneAdmOneHG,
+                             SingleItemType,
+                             SingleItemTypeForContextAwareRec,
+                             SingleItemTypeForSequentialRec,
+                             DFDataset,
+                             NegSamplingDataset,
+                             field2type,
+                             string2list)
+from model.backbone import BackBoneV2
+from model.layers import SequentialEmbeddingLayer
+from utils.config import HeteroGraphConfig, GNNConfig, max_adm_length
+from utils.ddi import DDICalculator
+from utils.misc import init_seed
+
+
+class SyntheticVoc:
+    """与COGNet的`voc_final.pkl`中的`med_voc`接口一致"""
+    def __init__(self, words):
+        self.idx2word = dict(enumerate(words))
+        self.word2idx = {w: i for i, w in self.idx2word.items()}
+
+
+class BenchContext:
+    r"""
+    Args:
+        data_dir: where the synthetic dataset is cached, generated if missing
+        scale: size of the synthetic dataset relative to MIMIC-III
+        seed: seed of the data generator and of the random functions during benchmarking
+        batch_size: number of rows of the baseline-model batches
+    """
+
+    def __init__(self, data_dir: str = r"./data/benchmark", scale: float = 0.02, seed: int = 10043,
+                 batch_size: int = 1024):
+        self.scale = scale
+        self.seed = seed
+        self.batch_size = batch_size
+        self.data_dir = os.path.join(data_dir, f"scale_{scale}_seed_{seed}")
+        self.device = torch.device("cpu")
+
+    def prepare_data(self):
+        if not os.path.exists(os.path.join(self.data_dir, "PRESCRIPTIONS_PREPROCESSED.csv.gz")):
+            print(f"> generating synthetic dataset into {self.data_dir}...")
+            generate(self.data_dir, SyntheticConfig(scale=self.scale, seed=self.seed))
+        return self.data_dir
+
+    def reseed(self):
+        init_seed(self.seed)
+
+    @cached_property
+    def source_dfs(self) -> SourceDataFrames:
+        return SourceDataFrames(self.prepare_data())
+
+    @cached_property
+    def long_adm_id(self) -> int:
+        """训练集中住院天数处于p90的住院（取不超过`max_adm_length`的），作为有代表性的较重的样本"""
+        adm_len = self.source_dfs.df_labevents.groupby("HADM_ID").TIMESTEP.max() + 1
+        adm_len = adm_len[adm_len.index.isin(self.source_dfs.adm_train) & (adm_len <= max_adm_length)]
+        target = adm_len.quantile(0.9, interpolation="nearest")
+        return int(adm_len[adm_len == target].index.min())
+
+    # ---------------------------------------- backbone ---------------------------------------- #
+
+    @cached_property
+    def hg_dataset(self) -> OneAdmOneHG:
+        return OneAdmOneHG(self.source_dfs, "train")
+
+    @cached_property
+    def long_hg(self):
+        return self.hg_dataset[self.hg_dataset.admissions.index(self.long_adm_id)]
+
+    @cached_property
+    def long_hg_days(self):
+        return OneAdmOneHG.split_by_day(self.long_hg)
+
+    @cached_property
+    def backbone(self) -> BackBoneV2:
+        self.reseed()
+        node_types, edge_types = HeteroGraphConfig.use_all_edge_type()
+        gnn_conf = GNNConfig("GENConv", 2, node_types, edge_types)
+        return BackBoneV2(self.source_dfs, "drug", 64, gnn_conf, self.device, num_enc_layers=2, embedding_size=10)
+
+    # ---------------------------------------- baselines ---------------------------------------- #
+
+    @cached_property
+    def drug_dataset(self) -> SingleItemType:
+        return SingleItemType(self.source_dfs, "train", "drug")
+
+    @cached_property
+    def seq_dataset(self) -> SingleItemTypeForSequentialRec:
+        return SingleItemTypeForSequentialRec(self.source_dfs, "train", "drug")
+
+    @cached_property
+    def long_pos_shard(self):
+        mappedid = self.source_dfs.get_mapped_id('HADM_ID', self.long_adm_id)
+        return mappedid, self.drug_dataset.gb_uid.get_group(mappedid)
+
+    @cached_property
+    def seq_rows(self):
+        r"""`batch_size`行序列推荐的样本（`pd.Series`），其中history为字符串，与从DFDataset的csv缓存中读出的一致"""
+        self.reseed()
+        collector, num_rows = [], 0
+        for idx in range(len(self.seq_dataset)):
+            interaction = self.seq_dataset[idx]
+            if len(interaction) == 0:
+                continue
+            collector.append(interaction)
+            num_rows += len(interaction)
+            if num_rows >= self.batch_size:
+                break
+        df = pd.concat(collector, axis=0).iloc[:self.batch_size].reset_index(drop=True)
+        df["history"] = df["history"].map(str).astype("string")
+        return [df.iloc[i] for i in range(len(df))]
+
+    @cached_property
+    def seq_table(self) -> ColumnarTable:
+        r"""`seq_rows`的列存储（与DFDataset的缓存格式一致），重复若干遍以便按乱序下标取一个batch"""
+        df = pd.DataFrame(self.seq_rows).reset_index(drop=True)
+        df["history"] = df["history"].apply(string2list)
+        df = pd.concat([df] * 8, ignore_index=True)
+        return ColumnarTable.from_dataframe(df, DFDataset.ragged_columns, field2type)
+
+    @cached_property
+    def seq_batch(self) -> Dict[str, torch.Tensor]:
+        return DFDataset.collect_fn(self.seq_rows)
+
+    @cached_property
+    def seq_embedding_layer(self) -> SequentialEmbeddingLayer:
+        return self.make_seq_embedding_layer()
+
+    def make_seq_embedding_layer(self, sparse_embedding: bool = False) -> SequentialEmbeddingLayer:
+        self.reseed()
+        return SequentialEmbeddingLayer(self.baseline_config(sparse_embedding=sparse_embedding), self.seq_dataset)
+
+    def baseline_config(self, **kwargs) -> Dict:
+        """基线模型的config，与run_baseline.py的默认参数一致（hidden_size小一些），kwargs覆盖其中的项"""
+        config = {
+            "device": self.device,
+            "embedding_size": 10,
+            "hidden_size": 64,
+            "mlp_hidden_size": [64, 64, 64],
+            "dropout_prob": 0.1,
+            "sparse_embedding": False,
+            "LABEL_FIELD": "label",
+            "USER_ID_FIELD": "user_id",
+            "ITEM_ID_FIELD": "item_id",
+            "MAX_HISTORY_ITEM_ID_LIST_LENGTH": 50,
+        }
+        config.update(kwargs)
+        return config
+
+    @cached_property
+    def seq_train_batch(self) -> Dict[str, torch.Tensor]:
+        r"""约`batch_size`行的序列推荐训练batch，与训练时的格式一致：同一(住院, 天)的各行共享去重后的历史序列"""
+        return NegSamplingDataset(self.seq_dataset, self.batch_size, self.seed)[0]
+
+    @cached_property
+    def context_dataset(self) -> SingleItemTypeForContextAwareRec:
+        return SingleItemTypeForContextAwareRec(self.source_dfs, "train", "drug")
+
+    @cached_property
+    def context_train_batch(self) -> Dict[str, torch.Tensor]:
+        """约`batch_size`行的上下文感知推荐batch（堆叠的特征矩阵）"""
+        return NegSamplingDataset(self.context_dataset, self.batch_size, self.seed)[0]
+
+    # ---------------------------------------- DDI ---------------------------------------- #
+
+    @cached_property
+    def ddi_calculator(self) -> DDICalculator:
+        r"""在合成的药品表上，生成DDICalculator所需的映射文件、ATC3词表和DDI邻接矩阵"""
+        path_ddi = os.path.join(self.data_dir, "ddi")
+        os.makedirs(path_ddi, exist_ok=True)
+        rng = np.random.default_rng(self.seed)
+
+        num_drugs = len(self.source_dfs.drugid2mappedid)
+        atc3_words = [f"{chr(ord('A') + i % 14)}{i // 14:02d}{chr(ord('A') + i % 26)}" for i in range(150)]
+        atc3_idx = rng.integers(0, len(atc3_words) + 20, size=num_drugs)  # 超出范围的表示该药品没有ATC编码
+        atc4 = np.array([f"{atc3_words[i]}A" if i < len(atc3_words) else np.nan for i in atc3_idx], dtype=object)
+        pd.DataFrame({
+            "NDC": self.source_dfs.drugid2mappedid.NDC.values,
+            "idx": np.arange(num_drugs),
+            "ATC4": atc4,
+            "list_cid": np.nan,
+        }).to_csv(os.path.join(path_ddi, "MAP_IDX4NDC_RXCUI_ATC4_CIDS.csv"))
+
+        with open(os.path.join(path_ddi, "voc_final.pkl"), 'wb') as f:
+            dill.dump({"med_voc": SyntheticVoc(atc3_words[:120])}, f)  # 部分ATC3不在词表中
+        ddi_adj = np.triu((rng.random((120, 120)) < 0.1).astype(np.int64), k=1)
+        with open(os.path.join(path_ddi, "ddi_A_final.pkl"), 'wb') as f:
+            dill.dump(ddi_adj + ddi_adj.T, f)
+
+        return DDICalculator(path_ddi)
+
+    @cached_property
+    def ddi_drug_sets(self):
+        """测试集中每个住院用过的药品下标"""
+        df = self.source_dfs.df_prescriptions
+        df = df[df.HADM_ID.isin(self.source_dfs.adm_test)]
+        ndc2idx = pd.Series(self.source_dfs.drugid2mappedid.mappedID.values,
+                            index=self.source_dfs.drugid2mappedid.NDC.values)
+        drug_idx = df.NDC.map(ndc2idx)
+        return [torch.from_numpy(v.unique()) for _, v in drug_idx.groupby(df.HADM_ID)][:64]
@@ -0,0 +1,142 @@
+r"""
+Case registry, measurement (wall time, tracemalloc peak, peak RSS), JSON results and regression comparison.
+"""
+import gc
+import json
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+import torch
+
+from dataclasses import dataclass
+from typing import Callable, Dict, List
+
+from utils.misc import reset_peak_rss, get_peak_rss_mb
+
+
+@dataclass
+class Case:
+    name: str
+    setup: Callable  # setup(ctx) -> fn，fn()是被计时的部分，准备工作放在setup中不计时
+    repeat: int = None  # 覆盖全局的重复次数（很慢的case）
+
+
+CASES: Dict[str, Case] = {}
+
+
+def register(name: str, repeat: int = None):
+    def decorator(setup):
+        assert name not in CASES, f"duplicated benchmark case: {name}"
+        CASES[name] = Case(name, setup, repeat)
+        return setup
+    return decorator
+
+
+def measure(fn: Callable, repeat: int = 5, warmup: int = 1) -> Dict:
+    r"""Time `fn` for `repeat` runs after `warmup` runs, then run it once more under tracemalloc.
+
+    - tracemalloc only sees the allocations of python objects and numpy arrays (not of torch tensors),
+      so the peak RSS during the timed runs is reported as well.
+    """
+    for _ in range(warmup):
+        fn()
+
+    gc.collect()
+    rss_reset = reset_peak_rss()
+    rss_before = get_peak_rss_mb()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    peak_rss = get_peak_rss_mb()
+
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    _, tracemalloc_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "repeat": repeat,
+        "median_s": statistics.median(durations),
+        "mean_s": statistics.mean(durations),
+        "min_s": min(durations),
+        "std_s": statistics.stdev(durations) if repeat > 1 else 0.,
+        "tracemalloc_peak_mb": tracemalloc_peak / 2 ** 20,
+        # 无法重置峰值时（非Linux），只能给出整个进程的峰值
+        "peak_rss_mb": peak_rss,
+        "peak_rss_delta_mb": peak_rss - rss_before if rss_reset else None,
+    }
+
+
+def run(ctx, names: List[str] = None, repeat: int = 5, warmup: int = 1) -> Dict:
+    selected = [CASES[name] for name in (names or CASES.keys())]
+    results = {}
+    for case in selected:
+        print(f"> running {case.name}...")
+        fn = case.setup(ctx)
+        ctx.reseed()
+        results[case.name] = measure(fn, case.repeat or repeat, warmup)
+        print(f"  median: {results[case.name]['median_s'] * 1e3:.3f} ms, "
+              f"tracemalloc peak: {results[case.name]['tracemalloc_peak_mb']:.2f} MB")
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "num_threads": torch.get_num_threads(),
+            "scale": ctx.scale,
+            "seed": ctx.seed,
+            "batch_size": ctx.batch_size,
+        },
+        "results": results,
+    }
+
+
+def save(results: Dict, path: str):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def load(path: str) -> Dict:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def compare(baseline: Dict, current: Dict, threshold: float = 0.1, mem_threshold: float = None) -> List[Dict]:
+    r"""Compare the median times (and optionally the tracemalloc peaks) of the cases in both results.
+
+    Args:
+        threshold: a case regresses if its median time is more than `1 + threshold` times the baseline
+        mem_threshold: same for the tracemalloc peak, not checked if None
+
+    Returns:
+        one row per common case, with the ratios and whether it regressed
+    """
+    rows = []
+    for name, cur in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        base = baseline["results"][name]
+        time_ratio = cur["median_s"] / max(base["median_s"], 1e-12)
+        mem_ratio = cur["tracemalloc_peak_mb"] / max(base["tracemalloc_peak_mb"], 1e-12)
+        regressed = time_ratio > 1 + threshold
+        if mem_threshold is not None:
+            regressed = regressed or mem_ratio > 1 + mem_threshold
+        rows.append({
+            "case": name,
+            "baseline_ms": base["median_s"] * 1e3,
+            "current_ms": cur["median_s"] * 1e3,
+            "time_ratio": time_ratio,
+            "baseline_mem_mb": base["tracemalloc_peak_mb"],
+            "current_mem_mb": cur["tracemalloc_peak_mb"],
+            "mem_ratio": mem_ratio,
+            "regressed": regressed,
+        })
+    return rows
@@ -0,0 +1,172 @@
+r"""
+Binary columnar storage of the baseline interaction datasets (see `DFDataset`).
+
+A table is a directory of `.npy` files, one per fixed-width column, and for each ragged (list) column such as
+`history`, a flat `{name}.values.npy` plus `{name}.offsets.npy` (row i is `values[offsets[i]:offsets[i+1]]`):
+
+    data/SingleItemTypeForSequentialRec/train_drug/
+        meta.json  user_id.npy  item_id.npy  label.npy  day.npy  history_len.npy
+        history.values.npy  history.offsets.npy
+
+A fixed-width column may also be a (num_rows, k) matrix, e.g. the stacked feature fields of the context-aware
+datasets, of which each row is taken as a whole.
+
+The files are loaded memory-mapped (copy-on-write, so `torch.from_numpy` shares the pages without a copy),
+hence loading is instant and forked processes share the same page cache.
+"""
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import torch
+
+from typing import Dict, List, Tuple, Sequence
+
+from utils.enum_type import FeatureType
+
+
+class ColumnarTable:
+    r"""
+    Args:
+        columns: name -> (num_rows,) array (or (num_rows, k) matrix) of each fixed-width column
+        ragged: name -> (values, offsets) of each ragged column, offsets has num_rows + 1 entries
+    """
+    format_version = 1
+
+    def __init__(self, columns: Dict[str, np.ndarray], ragged: Dict[str, Tuple[np.ndarray, np.ndarray]] = None):
+        self.columns = columns
+        self.ragged = ragged if ragged is not None else {}
+        lengths = {len(v) for v in self.columns.values()} | {len(offsets) - 1 for _, offsets in self.ragged.values()}
+        assert len(lengths) <= 1, "columns of different lengths"
+        self.num_rows = lengths.pop() if len(lengths) > 0 else 0
+
+    def __len__(self):
+        return self.num_rows
+
+    @property
+    def column_names(self) -> List[str]:
+        return list(self.columns.keys()) + list(self.ragged.keys())
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame, ragged_columns: Sequence[str] = (), field2type: Dict = None):
+        r"""Integer columns are stored as int32 and float columns as float32. Token fields of `field2type`
+        are stored as int32 even if they come as floats (e.g. item features taken from a float feature matrix)."""
+        field2type = field2type if field2type is not None else {}
+        columns = {}
+        ragged = {}
+        for name in df.columns:
+            if name in ragged_columns:
+                lists = df[name].values
+                lengths = np.fromiter((len(v) for v in lists), dtype=np.int64, count=len(lists))
+                offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+                np.cumsum(lengths, out=offsets[1:])
+                values = np.fromiter((x for v in lists for x in v), dtype=np.int32, count=int(offsets[-1]))
+                ragged[name] = (values, offsets)
+            elif field2type.get(name) == FeatureType.TOKEN or pd.api.types.is_integer_dtype(df[name].dtype):
+                columns[name] = df[name].values.astype(np.int32)
+            else:
+                columns[name] = df[name].values.astype(np.float32)
+        return cls(columns, ragged)
+
+    @classmethod
+    def concat(cls, tables: Sequence["ColumnarTable"]):
+        r"""Rows of `tables` one after another, the tables must have the same columns."""
+        if len(tables) == 0:
+            return cls({})
+        columns = {name: np.concatenate([t.columns[name] for t in tables]) for name in tables[0].columns}
+        ragged = {}
+        for name in tables[0].ragged:
+            values = np.concatenate([t.ragged[name][0] for t in tables])
+            offsets, total = [np.zeros(1, dtype=np.int64)], 0
+            for t in tables:
+                t_offsets = t.ragged[name][1]
+                offsets.append(t_offsets[1:] + total)  # 平移到拼接后values中的位置
+                total += int(t_offsets[-1])
+            ragged[name] = (values, np.concatenate(offsets))
+        return cls(columns, ragged)
+
+    def save(self, path_dir: str):
+        """先写到临时目录，再整体改名，不会留下写了一半的表"""
+        tmp_dir = path_dir.rstrip("/\\") + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name, array in self.columns.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(array))
+        for name, (values, offsets) in self.ragged.items():
+            np.save(os.path.join(tmp_dir, f"{name}.values.npy"), np.ascontiguousarray(values))
+            np.save(os.path.join(tmp_dir, f"{name}.offsets.npy"), np.ascontiguousarray(offsets))
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump({
+                "format_version": self.format_version,
+                "num_rows": self.num_rows,
+                "columns": {name: str(array.dtype) for name, array in self.columns.items()},
+                "ragged": list(self.ragged.keys()),
+            }, f, indent=2)
+        shutil.rmtree(path_dir, ignore_errors=True)
+        os.replace(tmp_dir, path_dir)
+
+    @staticmethod
+    def exists(path_dir: str):
+        return os.path.isfile(os.path.join(path_dir, "meta.json"))
+
+    @classmethod
+    def load(cls, path_dir: str, mmap: bool = True):
+        with open(os.path.join(path_dir, "meta.json")) as f:
+            meta = json.load(f)
+        assert meta["format_version"] == cls.format_version, f"outdated columnar table in {path_dir}, rebuild it"
+        mmap_mode = "c" if mmap else None
+
+        def load_array(filename):
+            return np.load(os.path.join(path_dir, filename), mmap_mode=mmap_mode)
+
+        columns = {name: load_array(f"{name}.npy") for name in meta["columns"]}
+        ragged = {name: (load_array(f"{name}.values.npy"), load_array(f"{name}.offsets.npy"))
+                  for name in meta["ragged"]}
+        return cls(columns, ragged)
+
+    def tensor(self, name: str) -> torch.Tensor:
+        """不拷贝，与（内存映射的）数组共享内存"""
+        return torch.from_numpy(self.columns[name])
+
+    def ragged_tensors(self, name: str) -> Tuple[torch.Tensor, torch.Tensor]:
+        values, offsets = self.ragged[name]
+        return torch.from_numpy(values), torch.from_numpy(offsets)
+
+    def take(self, indices) -> pd.DataFrame:
+        r"""Rows at `indices` (a slice or an integer array) as a DataFrame, ragged and matrix columns become lists."""
+        data = {name: array[indices] if array.ndim == 1 else array[indices].tolist()
+                for name, array in self.columns.items()}
+        for name, (values, offsets) in self.ragged.items():
+            if isinstance(indices, slice):
+                starts, ends = offsets[:-1][indices], offsets[1:][indices]
+            else:
+                starts, ends = offsets[indices], offsets[np.asarray(indices) + 1]
+            data[name] = [values[s:e].tolist() for s, e in zip(starts.tolist(), ends.tolist())]
+        return pd.DataFrame(data, columns=[name for name in self.column_names])
+
+    def take_tensors(self, indices, pad_value: int = 0) -> Dict[str, torch.Tensor]:
+        r"""Rows at `indices` (a slice or an integer array) as a dict of tensors, keeping the stored dtypes.
+
+        A ragged column becomes a padded (num_rows, max length in the batch) tensor, filled with `pad_value`,
+        and its lengths are under `{name}_len` unless that column already exists.
+        """
+        batch = {name: torch.from_numpy(np.ascontiguousarray(array[indices])) for name, array in self.columns.items()}
+        for name, (values, offsets) in self.ragged.items():
+            if isinstance(indices, slice):
+                starts, ends = offsets[:-1][indices], offsets[1:][indices]
+            else:
+                starts, ends = offsets[indices], offsets[np.asarray(indices) + 1]
+            lengths = ends - starts
+            max_len = int(lengths.max()) if len(lengths) > 0 else 0
+            # 一次性gather：第i行的第j个位置取values[starts[i] + j]，超出长度的位置填充
+            positions = np.arange(max_len)
+            mask = positions[None, :] < lengths[:, None]
+            gather = np.where(mask, starts[:, None] + positions[None, :], 0)
+            padded = np.where(mask, values[gather] if len(values) > 0 else pad_value, pad_value)
+            batch[name] = torch.from_numpy(padded.astype(values.dtype, copy=False))
+            batch.setdefault(f"{name}_len", torch.from_numpy(lengths.astype(np.int32)))
+        return batch
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return self.take(slice(None))
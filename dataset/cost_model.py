@@ -0,0 +1,236 @@
+r"""
+Per-admission cost model of `BackBoneV2`, computed with one vectorized pass over `SourceDataFrames`,
+and a tracker of the actual training time of each admission.
+
+The cost of an admission with D days (truncated to `max_adm_length`) is dominated by:
+    - the GNN over the D day snapshots, each of which holds all item nodes:
+        gnn_cost = num_layers * (D * num_nodes + 2 * num_edges)  (the edges are made undirected)
+    - the day attention, for each target day t in [1, D), every candidate item (positives + sampled negatives)
+      attends to the conditions of the previous days:
+        attention_pairs = sum_t num_candidates(t) * num_keys(t)
+and `cost = w_gnn * gnn_cost + w_att * attention_pairs`. The weights can be calibrated by
+`SlowSampleTracker.fit` against the measured step times, so that `cost` is in milliseconds.
+
+Usage:
+    >>> costs = compute_admission_costs(source_dfs, "drug", gnn_conf, admissions=source_dfs.adm_train)
+    >>> costs.nlargest(10, "cost")
+"""
+import sys; sys.path.append("..")
+import numpy as np
+import pandas as pd
+
+from typing import List, Tuple
+
+from dataset.unified import SourceDataFrames
+from utils.config import GNNConfig, max_adm_length, neg_sample_strategy
+
+
+# 与 OneAdmOneHG.neg_sample_for_cur_day 保持一致：当天没有正样本时至少采10个负样本
+MIN_NUM_NEG_SAMPLES = 10
+
+
+def _num_keys_per_day(max_days: int, attention_window: int = None, attention_summary: bool = False):
+    r"""(max_days,) number of attended previous days when predicting day t (index t), see
+    `BackBoneV2._get_pre_day_patient_conditions`"""
+    t = np.arange(max_days)
+    if attention_window is None:
+        return t
+    num_keys = np.minimum(t, attention_window)
+    if attention_summary:
+        num_keys = num_keys + (t > attention_window)
+    return num_keys
+
+
+def _num_candidates(num_pos: np.ndarray, num_items: int, strategy: int = neg_sample_strategy):
+    r"""一天中需要判断的物品数（正样本 + 负样本），`strategy`同`OneAdmOneHG.neg_sample_for_cur_day`
+
+    Args:
+        num_pos: number of positives of each day
+        num_items: size of the item vocabulary of the goal
+    """
+    if strategy == 2:
+        num_neg = 2 * num_pos
+    elif 10 <= strategy < num_items:
+        num_neg = np.full_like(num_pos, strategy)
+    elif strategy == -1:  # 全部物品
+        num_neg = np.full_like(num_pos, num_items)
+    else:
+        raise ValueError(f"invalid negative sample `strategy` args: {strategy}!")
+    num_neg = np.minimum(num_neg, np.maximum(num_items - num_pos, 0))  # 不会采到正样本
+    return np.where(num_pos > 0, num_pos + num_neg, MIN_NUM_NEG_SAMPLES)
+
+
+def compute_admission_costs(source_dfs: SourceDataFrames,
+                            goal: str,
+                            gnn_conf: GNNConfig,
+                            attention_window: int = None,
+                            attention_summary: bool = False,
+                            max_adm_length: int = max_adm_length,
+                            admissions: List[int] = None,
+                            cost_weights: Tuple[float, float] = (1., 1.),
+                            neg_sample_strategy: int = neg_sample_strategy):
+    r"""Predict the cost of each admission from the event tables, without building any graph.
+
+    Args:
+        goal: "drug" or "labitem", whose positives (and sampled negatives) are judged by the day attention
+        gnn_conf: the node/edge types and the number of layers of the GNN
+        attention_window, attention_summary, max_adm_length: the same as `BackBoneV2`
+        admissions: HADM_IDs to compute, defaults to all admissions of both tables
+        cost_weights: (w_gnn, w_att) to combine the two terms into `cost`
+        neg_sample_strategy: the negative sampling of the training days, see `OneAdmOneHG.neg_sample_for_cur_day`
+
+    Returns:
+        pd.DataFrame indexed by HADM_ID with columns:
+            num_days, num_labevents, num_prescriptions, num_nodes, gnn_cost, attention_pairs, cost
+    """
+    assert goal in ("drug", "labitem")
+    edge_type2df = {
+        ("admission", "did", "labitem"): source_dfs.df_labevents,
+        ("admission", "took", "drug"): source_dfs.df_prescriptions,
+    }
+    item_node_num = {
+        "labitem": len(source_dfs.itemid2mappedid),
+        "drug": len(source_dfs.drugid2mappedid),
+    }
+
+    # 只保留模型会用到的天（截断到max_adm_length）
+    events = {
+        edge_type: df.loc[df["TIMESTEP"] < max_adm_length, ["HADM_ID", "TIMESTEP"]]
+        for edge_type, df in edge_type2df.items()
+    }
+    if admissions is None:
+        admissions = np.union1d(*[df["HADM_ID"].unique() for df in events.values()])
+    index = pd.Index(admissions, name="HADM_ID")
+
+    costs = pd.DataFrame(index=index)
+    num_days = pd.concat([df.groupby("HADM_ID")["TIMESTEP"].max() for df in events.values()], axis=1).max(axis=1)
+    costs["num_days"] = (num_days.reindex(index).fillna(-1) + 1).astype("int64")
+    costs["num_labevents"] = events[("admission", "did", "labitem")].groupby("HADM_ID").size() \
+        .reindex(index, fill_value=0).astype("int64")
+    costs["num_prescriptions"] = events[("admission", "took", "drug")].groupby("HADM_ID").size() \
+        .reindex(index, fill_value=0).astype("int64")
+
+    # GNN：每天的快照都包含全部物品结点
+    costs["num_nodes"] = 1 + sum(item_node_num[node_type] for node_type in gnn_conf.node_types if node_type != "admission")
+    num_edges = sum(
+        costs["num_labevents"] if edge_type == ("admission", "did", "labitem") else costs["num_prescriptions"]
+        for edge_type in gnn_conf.edge_types if "rev" not in edge_type[1]
+    )
+    costs["gnn_cost"] = gnn_conf.gnn_layer_num * (costs["num_days"] * costs["num_nodes"] + 2 * num_edges)
+
+    # 注意力：先假设每个目标天都没有正样本，再修正有正样本的天
+    num_keys = _num_keys_per_day(max_adm_length, attention_window, attention_summary)
+    cum_num_keys = np.concatenate([[0], np.cumsum(num_keys)])  # cum_num_keys[D] = sum_{t<D} num_keys[t]
+    attention_pairs = MIN_NUM_NEG_SAMPLES * cum_num_keys[costs["num_days"].values]
+
+    goal_events = events[("admission", "took", "drug") if goal == "drug" else ("admission", "did", "labitem")]
+    goal_events = goal_events[goal_events["TIMESTEP"] >= 1]  # 第一天不做预测
+    num_pos = goal_events.groupby(["HADM_ID", "TIMESTEP"]).size()
+    timesteps = num_pos.index.get_level_values("TIMESTEP").values
+    correction = (_num_candidates(num_pos.values, item_node_num[goal], neg_sample_strategy) - MIN_NUM_NEG_SAMPLES) * num_keys[timesteps]
+    correction = pd.Series(correction, index=num_pos.index.get_level_values("HADM_ID")).groupby(level=0).sum()
+    costs["attention_pairs"] = (attention_pairs + correction.reindex(index, fill_value=0).values).astype("int64")
+
+    w_gnn, w_att = cost_weights
+    costs["cost"] = w_gnn * costs["gnn_cost"] + w_att * costs["attention_pairs"]
+    return costs
+
+
+class SlowSampleTracker:
+    r"""Record the actual time spent on each admission during training, and report the slowest ones.
+
+    Args:
+        top_n: number of admissions in the report
+
+    Example::
+
+        >>> tracker = SlowSampleTracker(top_n=20)
+        >>> tracker.record(hadm_id, load_s=0.05, compute_s=1.2)  # 每个住院训练完之后
+        >>> tracker.report(costs)  # 最慢的top_n个住院，附带预测的开销
+        >>> tracker.fit(costs)  # 用实测时间标定cost_weights
+    """
+
+    columns = ["count", "load_s", "compute_s", "max_step_s"]
+
+    def __init__(self, top_n: int = 20):
+        self.top_n = top_n
+        self._stats = {}  # hadm_id -> [count, load_s之和, compute_s之和, 最长的一步]
+
+    def __len__(self):
+        return len(self._stats)
+
+    def record(self, hadm_id: int, load_s: float, compute_s: float):
+        r"""
+        Args:
+            load_s: time to build the hetero graph of the admission
+            compute_s: time of its forward and backward pass
+        """
+        stats = self._stats.setdefault(int(hadm_id), [0, 0., 0., 0.])
+        stats[0] += 1
+        stats[1] += load_s
+        stats[2] += compute_s
+        stats[3] = max(stats[3], load_s + compute_s)
+
+    def to_frame(self):
+        r"""pd.DataFrame indexed by HADM_ID, with the mean time over the epochs (`step_s` = load_s + compute_s)"""
+        df = pd.DataFrame.from_dict(self._stats, orient="index", columns=self.columns)
+        df.index.name = "HADM_ID"
+        df["load_s"] /= df["count"]
+        df["compute_s"] /= df["count"]
+        df["step_s"] = df["load_s"] + df["compute_s"]
+        return df
+
+    def report(self, costs: pd.DataFrame = None):
+        r"""The `top_n` slowest admissions, joined with their predicted `costs` if given."""
+        df = self.to_frame().nlargest(self.top_n, "step_s")
+        if costs is not None:
+            df = df.join(costs, how="left")
+            df["share_of_time"] = df["step_s"] / self.to_frame()["step_s"].sum()
+        return df.reset_index()
+
+    def fit(self, costs: pd.DataFrame):
+        r"""Least squares fit of `step_s * 1000 ≈ w_gnn * gnn_cost + w_att * attention_pairs + intercept`.
+
+        Returns:
+            ((w_gnn, w_att), intercept_ms, r2), pass the weights as `cost_weights` to `compute_admission_costs`
+            so that the predicted `cost` is in milliseconds
+        """
+        df = self.to_frame().join(costs[["gnn_cost", "attention_pairs"]], how="inner")
+        assert len(df) >= 3, "too few admissions recorded to fit the cost weights"
+        X = np.stack([df["gnn_cost"].values, df["attention_pairs"].values, np.ones(len(df))], axis=1).astype("float64")
+        y = 1e3 * df["step_s"].values
+        coef, *_ = np.linalg.lstsq(X, y, rcond=None)
+        residual = y - X @ coef
+        r2 = 1. - (residual ** 2).sum() / max(((y - y.mean()) ** 2).sum(), 1e-12)
+        return (float(coef[0]), float(coef[1])), float(coef[2]), float(r2)
+
+
+if __name__ == '__main__':
+    import argparse
+    import utils.constant as constant
+    from utils.config import HeteroGraphConfig
+
+    parser = argparse.ArgumentParser(description="list the most costly admissions predicted by the cost model")
+    parser.add_argument("--root_path_dataset", default=constant.PATH_MIMIC_III_ETL_OUTPUT)
+    parser.add_argument("--goal", default="drug")
+    parser.add_argument("--gnn_type", default="GENConv")
+    parser.add_argument("--gnn_layer_num", type=int, default=3)
+    parser.add_argument("--attention_window", type=int, default=None)
+    parser.add_argument("--attention_summary", action="store_true", default=False)
+    parser.add_argument("--max_adm_length", type=int, default=max_adm_length)
+    parser.add_argument("--top_n", type=int, default=20)
+    parser.add_argument("--output", default=None, help="save the cost table of all admissions to this .csv")
+    args = parser.parse_args()
+
+    source_dfs = SourceDataFrames(args.root_path_dataset)
+    node_types, edge_types = HeteroGraphConfig.use_all_edge_type()
+    costs = compute_admission_costs(source_dfs, args.goal,
+                                    GNNConfig(args.gnn_type, args.gnn_layer_num, node_types, edge_types),
+                                    args.attention_window, args.attention_summary, args.max_adm_length,
+                                    admissions=source_dfs.adm_both)
+    print(costs.describe().T.to_string(float_format=lambda x: f"{x:.1f}"))
+    print(costs.nlargest(args.top_n, "cost").to_string())
+    print(f"> top 1% of the admissions account for "
+          f"{costs['cost'].nlargest(max(1, len(costs) // 100)).sum() / costs['cost'].sum():.1%} of the total cost")
+    if args.output is not None:
+        costs.to_csv(args.output)
@@ -0,0 +1,329 @@
+r"""
+Synthetic MIMIC-III-like ETL output, for benchmarks and tests on machines without credentialed MIMIC access.
+
+Writes the five files which `SourceDataFrames` loads, with the same columns (and the `field2dtype` schema)
+as the outputs of `preprocess_labitems.py` and `preprocess_drugs.py`:
+    ADMISSIONS_NEW.csv.gz, D_LABITEMS_NEW.csv.gz, LABEVENTS_PREPROCESSED.csv.gz,
+    PRESCRIPTIONS_PREPROCESSED.csv.gz, DRUGS_NDC_FEAT.csv.gz
+
+The default statistics follow MIMIC-III after ETL (~59k admissions, 753 lab items, 4294 drugs,
+median stay about a week with a long tail, ~30 lab events and ~10 prescriptions per admission-day,
+long-tailed item popularity). `scale` multiplies the number of admissions (up to 10x MIMIC-III).
+
+Usage:
+    python -m dataset.synthetic --output_dir data/synthetic --scale 0.05
+    python run_backbone.py --root_path_dataset data/synthetic --train ...
+"""
+import sys; sys.path.append("..")
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+from dataclasses import dataclass
+from tqdm import tqdm
+
+from dataset.unified import (list_selected_admission_columns,
+                             list_selected_drug_ndc_columns,
+                             list_selected_prescriptions_columns)
+
+
+# ETL之后各token特征列的取值个数（不含用于填充nan的0）
+admission_field_vocab = {
+    'ADMISSION_TYPE':     4,
+    'ADMISSION_LOCATION': 9,
+    'DISCHARGE_LOCATION': 17,
+    'INSURANCE':          5,
+    'LANGUAGE':           75,
+    'RELIGION':           20,
+    'MARITAL_STATUS':     7,
+    'ETHNICITY':          41,
+}
+admission_field_nan_ratio = {'LANGUAGE': 0.4, 'RELIGION': 0.01, 'MARITAL_STATUS': 0.2}
+labitem_field_vocab = {'FLUID': 14, 'CATEGORY': 3}
+prescription_field_vocab = {
+    "DRUG_TYPE":      3,
+    "PROD_STRENGTH":  20,   # 按NDC分别编码，取值很小
+    "DOSE_VAL_RX":    30,   # 同上
+    "DOSE_UNIT_RX":   60,
+    "FORM_VAL_DISP":  30,   # 同上
+    "FORM_UNIT_DISP": 40,
+    "ROUTE":          70,
+}
+value_units = ["mg/dL", "mEq/L", "K/uL", "%", "g/dL", "IU/L", "sec", "mmol/L", "fL", "pg"]
+
+
+@dataclass
+class SyntheticConfig:
+    num_admissions: int = 58976
+    num_labitems: int = 753
+    num_drugs: int = 4294
+    median_stay_days: float = 7.
+    stay_days_sigma: float = 0.7  # 住院天数服从对数正态分布
+    max_stay_days: int = 300
+    short_stay_ratio: float = 0.05  # 只有1天记录的住院，会被SourceDataFrames过滤掉
+    labevents_per_day: float = 30.
+    prescriptions_per_day: float = 10.
+    popularity_exponent: float = 1.  # 物品流行度服从Zipf分布
+    categorical_labitem_ratio: float = 0.2  # 非数值型的检验项目（结果为类别）
+    fake_ndc_ratio: float = 0.1  # NDC为0、按药名重新编号（<1000）的药品
+    scale: float = 1.
+    seed: int = 10043
+    chunk_size: int = 5000  # 每次生成的住院数，控制内存占用
+
+    def __post_init__(self):
+        assert 0 < self.scale <= 10, "scale should be in (0, 10]"
+        assert self.num_labitems > 0 and self.num_drugs > 0
+
+
+def _zipf_popularity(rng, n, exponent):
+    popularity = 1. / np.arange(1, n + 1) ** exponent
+    return rng.permutation(popularity / popularity.sum())
+
+
+def _small_codes(rng, size, max_code, p=0.5):
+    """偏向小值的类别编码（编码按出现频率排序，1最常见），取值[1, max_code]"""
+    return np.minimum(rng.geometric(p, size=size), max_code)
+
+
+def _gen_admissions(rng, cfg: SyntheticConfig, num_admissions):
+    hadm_ids = 100000 + rng.choice(num_admissions * 4, size=num_admissions, replace=False)
+    hadm_ids.sort()
+    subject_ids = rng.integers(1, max(2, int(num_admissions * 0.8)), size=num_admissions)
+
+    stay_days = np.round(rng.lognormal(np.log(cfg.median_stay_days), cfg.stay_days_sigma, size=num_admissions))
+    stay_days = np.clip(stay_days, 2, cfg.max_stay_days).astype(np.int64)
+    stay_days[rng.random(num_admissions) < cfg.short_stay_ratio] = 1
+
+    admit_day = np.datetime64("2100-01-01") + rng.integers(0, 365 * 100, size=num_admissions).astype("timedelta64[D]")
+    admit_times = admit_day.astype("datetime64[s]") + rng.integers(0, 86400, size=num_admissions).astype("timedelta64[s]")
+    disch_times = admit_times + (stay_days * 86400 - rng.integers(0, 43200, size=num_admissions)).astype("timedelta64[s]")
+
+    df = pd.DataFrame({
+        "ROW_ID": np.arange(1, num_admissions + 1),
+        "SUBJECT_ID": subject_ids,
+        "HADM_ID": hadm_ids,
+        "ADMITTIME": admit_times,
+        "DISCHTIME": disch_times,
+    })
+    for field in list_selected_admission_columns:
+        codes = _small_codes(rng, num_admissions, admission_field_vocab[field], p=0.35)
+        codes[rng.random(num_admissions) < admission_field_nan_ratio.get(field, 0.)] = 0
+        df[field] = codes
+    return df, stay_days
+
+
+def _gen_labitems(rng, cfg: SyntheticConfig):
+    n = cfg.num_labitems
+    df = pd.DataFrame({
+        "ROW_ID": np.arange(1, n + 1),
+        "ITEMID": 50800 + np.arange(n),
+        "LABEL": [f"lab item {i}" for i in range(n)],
+        "FLUID": _small_codes(rng, n, labitem_field_vocab["FLUID"], p=0.4),
+        "CATEGORY": _small_codes(rng, n, labitem_field_vocab["CATEGORY"], p=0.5),
+        "LOINC_CODE": [f"{rng.integers(1000, 99999)}-{rng.integers(0, 10)}" for _ in range(n)],
+    })
+    # 数值型检验项目的取值分布；类别型检验项目的类别数
+    profile = {
+        "is_categorical": rng.random(n) < cfg.categorical_labitem_ratio,
+        "mean": rng.lognormal(2., 1.5, size=n),
+        "std_ratio": rng.uniform(0.05, 0.5, size=n),
+        "num_categories": rng.integers(2, 12, size=n),
+        "unit": rng.integers(0, len(value_units), size=n),
+    }
+    return df, profile
+
+
+def _gen_drugs(rng, cfg: SyntheticConfig):
+    n = cfg.num_drugs
+    num_fake = min(int(n * cfg.fake_ndc_ratio), 999)
+    fake_ndc = np.arange(1, num_fake + 1)
+    real_ndc = np.sort(10 ** 8 + rng.choice(10 ** 10 - 10 ** 8, size=n - num_fake, replace=False))
+    ndc = np.concatenate([fake_ndc, real_ndc])
+
+    # 每种药品常用的剂型/途径等，处方中大部分时候取这些值
+    profile = {f: _small_codes(rng, n, prescription_field_vocab[f], p=0.3)
+               for f in ["DOSE_UNIT_RX", "FORM_UNIT_DISP", "ROUTE"]}
+    profile["DRUG_TYPE"] = np.where(rng.random(n) < 0.85, 1, rng.integers(2, 4, size=n))
+
+    drug_type_props = rng.dirichlet([8., 1., 1.], size=n)
+    drug_type_props.sort(axis=1)
+    df = pd.DataFrame({
+        "NDC": ndc,
+        "DRUG_TYPE_MAIN_Proportion": drug_type_props[:, 2],
+        "DRUG_TYPE_BASE_Proportion": np.where(rng.random(n) < 0.3, drug_type_props[:, 1], 0.),
+        "DRUG_TYPE_ADDITIVE_Proportion": np.where(rng.random(n) < 0.1, drug_type_props[:, 0], 0.),
+    })
+    df["FORM_UNIT_DISP_Freq_1"] = profile["FORM_UNIT_DISP"]
+    for k in range(2, 6):  # 越往后越少有
+        codes = _small_codes(rng, n, prescription_field_vocab["FORM_UNIT_DISP"], p=0.3)
+        codes[rng.random(n) > 0.5 ** (k - 1)] = 0
+        df[f"FORM_UNIT_DISP_Freq_{k}"] = codes
+    rxnorm_id = rng.integers(100000, 2000000, size=n).astype(str).astype(object)
+    rxnorm_id[(ndc < 1000) | (rng.random(n) < 0.15)] = np.nan
+    df["rxnorm_id"] = rxnorm_id
+    assert list(df.columns[1:-1]) == list_selected_drug_ndc_columns
+    return df, profile
+
+
+def _sample_daily_events(rng, stay_days, events_per_day, popularity):
+    r"""为每个住院的每一天采样不重复的物品（同一天同一物品只保留一条，与ETL中去重的结果一致）
+
+    Returns:
+        adm_idx, day, item_idx: 每条记录所属的住院（在chunk内的下标）、天、物品下标
+    """
+    num_items = len(popularity)
+    num_days = stay_days.sum()
+    day_adm = np.repeat(np.arange(len(stay_days)), stay_days)
+    day_starts = np.cumsum(stay_days) - stay_days
+    day = np.arange(num_days) - np.repeat(day_starts, stay_days)
+
+    # 病情越重的住院每天的事件越多
+    intensity = rng.lognormal(0., 0.5, size=len(stay_days))[day_adm]
+    counts = rng.poisson(events_per_day * intensity)
+    is_edge_day = (day == 0) | (day == stay_days[day_adm] - 1)  # 保证首末两天都有记录
+    counts[is_edge_day] = np.maximum(counts[is_edge_day], 1)
+    counts = np.minimum(counts, num_items)
+
+    rows = np.repeat(np.arange(num_days), counts)
+    items = rng.choice(num_items, size=len(rows), p=popularity)
+    keys = np.unique(rows * num_items + items)  # 去重，且按(天, 物品)排好序
+    rows, items = keys // num_items, keys % num_items
+    return day_adm[rows], day[rows], items
+
+
+def _gen_labevents_chunk(rng, cfg, df_adm, stay_days, df_labitems, lab_profile, lab_popularity, row_id_start):
+    adm_idx, day, item_idx = _sample_daily_events(rng, stay_days, cfg.labevents_per_day, lab_popularity)
+    n = len(adm_idx)
+
+    day_start = df_adm.ADMITTIME.values[adm_idx].astype("datetime64[D]") + day.astype("timedelta64[D]")
+    charttime = day_start.astype("datetime64[s]") + rng.integers(0, 86400, size=n).astype("timedelta64[s]")
+
+    is_categorical = lab_profile["is_categorical"][item_idx]
+    z = rng.standard_t(df=3, size=n)  # 重尾，异常值比正态分布多
+    valuenum = lab_profile["mean"][item_idx] * (1 + lab_profile["std_ratio"][item_idx] * z)
+    valuenum = np.where(is_categorical, np.nan, np.round(valuenum, 2))
+    catagory = np.where(is_categorical,
+                        np.minimum(rng.geometric(0.5, size=n), lab_profile["num_categories"][item_idx]), 0)
+
+    return pd.DataFrame({
+        "ROW_ID": np.arange(row_id_start, row_id_start + n),
+        "SUBJECT_ID": df_adm.SUBJECT_ID.values[adm_idx],
+        "HADM_ID": df_adm.HADM_ID.values[adm_idx],
+        "ITEMID": df_labitems.ITEMID.values[item_idx],
+        "CHARTTIME": charttime,
+        "VALUE": valuenum,
+        "VALUENUM": valuenum,
+        "VALUEUOM": np.array(value_units)[lab_profile["unit"][item_idx]],
+        "FLAG": np.where(~is_categorical & (np.abs(z) > 2), "abnormal", None),
+        "CATAGORY": catagory,
+        "VALUENUM_Z-SCORED": np.where(is_categorical, 0., np.round(z, 4)),
+        "TIMESTEP": day,
+    })
+
+
+def _gen_prescriptions_chunk(rng, cfg, df_adm, stay_days, df_drugs, drug_profile, drug_popularity, row_id_start):
+    adm_idx, day, drug_idx = _sample_daily_events(rng, stay_days, cfg.prescriptions_per_day, drug_popularity)
+    n = len(adm_idx)
+
+    day_start = df_adm.ADMITTIME.values[adm_idx].astype("datetime64[D]") + day.astype("timedelta64[D]")
+    startdate = day_start.astype("datetime64[s]") + (rng.integers(0, 24, size=n) * 3600).astype("timedelta64[s]")
+    enddate = startdate + np.timedelta64(86400, "s")  # ETL中已把多天的处方拆成了每天一条
+
+    df = pd.DataFrame({
+        "ROW_ID": np.arange(row_id_start, row_id_start + n),
+        "SUBJECT_ID": df_adm.SUBJECT_ID.values[adm_idx],
+        "HADM_ID": df_adm.HADM_ID.values[adm_idx],
+        "ICUSTAY_ID": np.where(rng.random(n) < 0.6, 200000 + df_adm.ROW_ID.values[adm_idx], np.nan),
+        "STARTDATE": startdate,
+        "ENDDATE": enddate,
+        "DRUG": np.char.add("drug ", drug_idx.astype(str)),
+        "DRUG_NAME_POE": np.char.add("drug ", drug_idx.astype(str)),
+        "DRUG_NAME_GENERIC": np.char.add("generic ", drug_idx.astype(str)),
+        "FORMULARY_DRUG_CD": np.char.add("FDC", drug_idx.astype(str)),
+        "GSN": np.char.zfill(drug_idx.astype(str), 6),
+        "NDC": df_drugs.NDC.values[drug_idx],
+    })
+    for field in list_selected_prescriptions_columns:
+        if field in drug_profile:  # 大部分时候取药品常用的值
+            codes = np.where(rng.random(n) < 0.9, drug_profile[field][drug_idx],
+                             _small_codes(rng, n, prescription_field_vocab[field], p=0.3))
+        else:
+            codes = _small_codes(rng, n, prescription_field_vocab[field], p=0.5)
+        df[field] = codes
+    df["TIMESTEP"] = day
+    return df
+
+
+def generate(output_dir: str, cfg: SyntheticConfig = SyntheticConfig()):
+    r"""Generate the synthetic ETL output files into `output_dir`, returns the number of rows of each file."""
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(cfg.seed)
+    num_admissions = max(10, int(round(cfg.num_admissions * cfg.scale)))
+
+    df_adm, stay_days = _gen_admissions(rng, cfg, num_admissions)
+    df_labitems, lab_profile = _gen_labitems(rng, cfg)
+    df_drugs, drug_profile = _gen_drugs(rng, cfg)
+    lab_popularity = _zipf_popularity(rng, cfg.num_labitems, cfg.popularity_exponent)
+    drug_popularity = _zipf_popularity(rng, cfg.num_drugs, cfg.popularity_exponent)
+
+    df_adm.to_csv(os.path.join(output_dir, "ADMISSIONS_NEW.csv.gz"))
+    df_labitems.to_csv(os.path.join(output_dir, "D_LABITEMS_NEW.csv.gz"))
+    df_drugs.to_csv(os.path.join(output_dir, "DRUGS_NDC_FEAT.csv.gz"))
+
+    # 行为表按住院分块生成并追加写入（gzip支持多段拼接），大scale时也不会占用过多内存
+    path_labevents = os.path.join(output_dir, "LABEVENTS_PREPROCESSED.csv.gz")
+    path_prescriptions = os.path.join(output_dir, "PRESCRIPTIONS_PREPROCESSED.csv.gz")
+    num_labevents, num_prescriptions = 0, 0
+    for start in tqdm(range(0, num_admissions, cfg.chunk_size), leave=False, ncols=80):
+        chunk = slice(start, start + cfg.chunk_size)
+        chunk_adm, chunk_stay_days = df_adm.iloc[chunk], stay_days[chunk]
+
+        df_labe = _gen_labevents_chunk(rng, cfg, chunk_adm, chunk_stay_days,
+                                       df_labitems, lab_profile, lab_popularity, num_labevents + 1)
+        df_labe.index = pd.RangeIndex(num_labevents, num_labevents + len(df_labe))
+        df_labe.to_csv(path_labevents, mode="w" if start == 0 else "a", header=start == 0)
+        num_labevents += len(df_labe)
+
+        df_pres = _gen_prescriptions_chunk(rng, cfg, chunk_adm, chunk_stay_days,
+                                           df_drugs, drug_profile, drug_popularity, num_prescriptions + 1)
+        df_pres.index = pd.RangeIndex(num_prescriptions, num_prescriptions + len(df_pres))
+        df_pres.to_csv(path_prescriptions, mode="w" if start == 0 else "a", header=start == 0)
+        num_prescriptions += len(df_pres)
+
+    return {
+        "admissions": len(df_adm),
+        "labitems": len(df_labitems),
+        "drugs": len(df_drugs),
+        "labevents": num_labevents,
+        "prescriptions": num_prescriptions,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output_dir", default=r"./data/synthetic")
+    parser.add_argument("--scale", type=float, default=SyntheticConfig.scale,
+                        help="number of admissions relative to MIMIC-III, in (0, 10]")
+    parser.add_argument("--num_admissions", type=int, default=SyntheticConfig.num_admissions,
+                        help="number of admissions at scale 1")
+    parser.add_argument("--num_labitems", type=int, default=SyntheticConfig.num_labitems)
+    parser.add_argument("--num_drugs", type=int, default=SyntheticConfig.num_drugs)
+    parser.add_argument("--median_stay_days", type=float, default=SyntheticConfig.median_stay_days)
+    parser.add_argument("--max_stay_days", type=int, default=SyntheticConfig.max_stay_days)
+    parser.add_argument("--labevents_per_day", type=float, default=SyntheticConfig.labevents_per_day)
+    parser.add_argument("--prescriptions_per_day", type=float, default=SyntheticConfig.prescriptions_per_day)
+    parser.add_argument("--seed", type=int, default=SyntheticConfig.seed)
+    args = parser.parse_args()
+
+    cfg = SyntheticConfig(num_admissions=args.num_admissions,
+                          num_labitems=args.num_labitems,
+                          num_drugs=args.num_drugs,
+                          median_stay_days=args.median_stay_days,
+                          max_stay_days=args.max_stay_days,
+                          labevents_per_day=args.labevents_per_day,
+                          prescriptions_per_day=args.prescriptions_per_day,
+                          scale=args.scale,
+                          seed=args.seed)
+    num_rows = generate(args.output_dir, cfg)
+    print(f"> synthetic dataset written to {args.output_dir}: {num_rows}")
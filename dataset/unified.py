@@ -4,7 +4,10 @@ import pandas as pd
 import os
 import torch
 import torch.utils.data as torchdata
-import random
+import numpy as np
+import multiprocessing as mp
+import shutil
+import hashlib
 import utils.constant as constant
 import torch_geometric.transforms as T
 
@@ -13,11 +16,14 @@ from torch_geometric.loader import DataLoader
 from torch_geometric.utils import negative_sampling
 from torch.utils.data import Dataset
 from sklearn.model_selection import train_test_split
-from typing import List, Dict, Union
+from typing import List, Dict, Optional, Tuple, Union
 from tqdm import tqdm
 
 from utils.enum_type import FeatureType, FeatureSource
 from utils.config import max_adm_length
+from utils.profiler import profiler
+from utils.misc import file_lock
+from dataset.columnar import ColumnarTable
 
 
 # 各个表的特征列
@@ -336,6 +342,19 @@ class SourceDataFrames:
         mapped_id = map_df[map_df[id_filed] == src_id].mappedID.values[0]
         return mapped_id
 
+    def share_memory_(self):
+        r"""Prepare to be shared read-only by forked processes (e.g. the trials of `run_sweep.py`).
+
+        The feature tensors are moved to shared memory, and the lazily built caches (the group indices of the
+        groupby objects) are built once here instead of in every child. The numeric columns of the DataFrames are
+        inherited copy-on-write by the children and never written, so they are shared as long as nobody modifies them.
+        """
+        for name in ("feat_admis", "feat_items", "feat_drugs"):
+            getattr(self, name).share_memory_()
+        for g in (self.g_admi, self.g_labe, self.g_pres):
+            _ = g.indices
+        return self
+
 
 class OneAdm(Dataset):
     """
@@ -369,7 +388,8 @@ class OneAdmOneHG(OneAdm):
     """将单次住院过程表示为一张异质图"""
     def __getitem__(self, idx):
         id = self.admissions[idx]
-        return self._convert_to_hetero_graph(id)
+        with profiler.region("convert_to_hetero_graph"):
+            return self._convert_to_hetero_graph(id)
 
     def _convert_to_hetero_graph(self, id):
         curr_id_df_admi = self.source_dfs.g_admi.get_group(id)
@@ -448,13 +468,18 @@ class OneAdmOneHG(OneAdm):
 
         return hetero_graph
 
+    @staticmethod
+    def get_adm_length(hg: HeteroData):
+        """住院天数（最后一个有记录的天 + 1）"""
+        last_lbe_day = hg["admission", "did", "labitem"].timestep.max().int().item()
+        last_pre_day = hg["admission", "took", "drug"].timestep.max().int().item()
+        return max(last_lbe_day, last_pre_day) + 1
+
     @staticmethod
     def split_by_day(hg: HeteroData):
         hgs = []
 
-        last_lbe_day = hg["admission", "did", "labitem"].timestep.max().int().item()
-        last_pre_day = hg["admission", "took", "drug"].timestep.max().int().item()
-        adm_len = max(last_lbe_day, last_pre_day)
+        adm_len = OneAdmOneHG.get_adm_length(hg) - 1
 
         device = hg["admission", "did", "labitem"].timestep.device
 
@@ -522,10 +547,15 @@ class OneAdmOneHG(OneAdm):
 
 
 class SingleItemType(OneAdm):
-    """只考虑 单种 用户-物品关系，如患者-检验项目 or 患者-药物"""
-    def __init__(self, source_dfs: SourceDataFrames, split, item_type: str):
+    """只考虑 单种 用户-物品关系，如患者-检验项目 or 患者-药物
+
+    The negative sampling and shuffling of an admission use its own generator seeded by (seed, user_id),
+    so an admission's samples do not depend on the order (or the process) in which the admissions are built.
+    """
+    def __init__(self, source_dfs: SourceDataFrames, split, item_type: str, seed: int = 3407):
         super(SingleItemType, self).__init__(source_dfs, split)
         self.item_type = item_type
+        self.seed = seed
         if self.item_type == "labitem":
             self.interaction = self.source_dfs.df_labevents.copy()
             self.interaction.sort_values(by=["HADM_ID", "TIMESTEP", "CHARTTIME", "ROW_ID"], inplace=True)
@@ -567,6 +597,7 @@ class SingleItemType(OneAdm):
 
         self.gb_uid = self.interaction.groupby('user_id')
         self.num_items = self.num(self.original_item_id_field)
+        self.all_items = np.sort(self.source_dfs.tokenfields2mappedid[self.original_item_id_field].mappedID.values)
         self.user_feat_fields = list_selected_admission_columns
         self.user_feat_values = self.source_dfs.feat_admis
         self.original_user_id_field = 'HADM_ID'
@@ -589,36 +620,88 @@ class SingleItemType(OneAdm):
         interaction.rename(columns=cols_to_rename, inplace=True)
         return interaction
 
-    def _cur_day_neg_sample(self, pos_items: List, num_neg_samples: int):
-        all_items = self.source_dfs.tokenfields2mappedid[
-            self.original_item_id_field].mappedID.values.tolist()
-        available = list(set(all_items) - set(pos_items))
-        num_neg_samples = num_neg_samples if num_neg_samples <= len(available) else len(available)
-        return random.sample(available, k=num_neg_samples)
+    def admission_rng(self, mappedid) -> np.random.Generator:
+        """每个住院独立的随机数生成器，只由(seed, user_id)决定"""
+        return np.random.default_rng([self.seed, int(mappedid)])
 
-    def _all_day_neg_samples(self, pos_shard, mappedid):
-        gb_day = pos_shard.groupby('day')
+    def neg_sample_arrays(self, admissions: List[Tuple[int, np.ndarray, np.ndarray]],
+                          rngs: List[np.random.Generator]) -> Dict[str, np.ndarray]:
+        r"""Sample the negatives of all days of a batch of admissions at once, 2 negatives per positive of a day
+        (fewer if the day has not enough items left), drawn without replacement among the items not positive that day.
 
-        # 按天进行负采样
-        mix_shards = []
-        days = pos_shard.day.unique().tolist()
-        days = [day for day in days if day < max_adm_length]  # 设置最长住院长度限制
-        for d in days:
-            cur_day_pos_shard = gb_day.get_group(d)
+        Each (admission, day) is a row of a (num_days, num_items) matrix of random keys, where the positives
+        (a per-day bitmask) get a key above all others; the negatives of a row are its smallest keys.
 
-            pos_items = cur_day_pos_shard['item_id'].values.tolist()
-            neg_items = self._cur_day_neg_sample(pos_items, num_neg_samples=2*len(pos_items))  # 暂用2:1负采样率
+        Args:
+            admissions: (user_id, item_ids, days) of the positives of each admission
+            rngs: generator of each admission (see `admission_rng`), the samples of an admission only depend on it
 
-            cur_day_neg_shard = pd.DataFrame()
-            cur_day_neg_shard['item_id'] = neg_items
-            cur_day_neg_shard['user_id'] = mappedid
-            cur_day_neg_shard['label'] = 0
-            cur_day_neg_shard['day'] = d
+        Returns:
+            the "user_id", "item_id", "label", "day" arrays of the positives and negatives, grouped by admission
+            then by day (ascending), in random order within a day
+        """
+        num_items = len(self.all_items)
+        row_user, row_day, pos_rows, pos_items, row_keys = [], [], [], [], []
+        adm_num_rows = []
+        num_rows = 0
+        for (mappedid, items, days), rng in zip(admissions, rngs):
+            keep = days < max_adm_length  # 设置最长住院长度限制
+            uniq_days, day_row = np.unique(days[keep], return_inverse=True)
+            row_user.append(np.full(len(uniq_days), mappedid, dtype=np.int64))
+            row_day.append(uniq_days.astype(np.int64))
+            pos_rows.append(day_row.reshape(-1) + num_rows)
+            pos_items.append(items[keep])
+            row_keys.append(rng.random((len(uniq_days), num_items)))
+            adm_num_rows.append(len(uniq_days))
+            num_rows += len(uniq_days)
+        row_user, row_day = np.concatenate(row_user), np.concatenate(row_day)
+        pos_rows, pos_items = np.concatenate(pos_rows), np.concatenate(pos_items).astype(np.int64)
+        neg_rows, neg_items = self.sample_day_negatives(np.concatenate(row_keys), pos_rows, pos_items)
+
+        # 正、负样本按(住院, 天)排在一起，再用各住院自己的生成器打乱每天之内的顺序
+        mix_rows, mix_items, mix_labels = mix_day_samples(pos_rows, pos_items, neg_rows, neg_items)
+        row_adm = np.repeat(np.arange(len(adm_num_rows)), adm_num_rows)
+        adm_num_samples = np.bincount(row_adm[mix_rows], minlength=len(adm_num_rows))
+        shuffle_keys = np.concatenate([rng.random(n) for rng, n in zip(rngs, adm_num_samples)] + [np.zeros(0)])
+        order = np.lexsort((shuffle_keys, mix_rows))
+
+        return {
+            "user_id": row_user[mix_rows[order]],
+            "item_id": mix_items[order],
+            "label": mix_labels[order],
+            "day": row_day[mix_rows[order]],
+        }
+
+    def sample_day_negatives(self, keys: np.ndarray, pos_rows: np.ndarray, pos_items: np.ndarray):
+        r"""The negatives of each (admission, day) row, 2 per positive, those with the smallest of the random `keys`.
 
-            cur_day_mix_shard = pd.concat([cur_day_pos_shard, cur_day_neg_shard], axis=0)
-            cur_day_mix_shard = cur_day_mix_shard.sample(frac=1)
+        Args:
+            keys: (num_rows, num_items) uniform random numbers in [0, 1), modified in place
+            pos_rows: the row of each positive
+            pos_items: the item of each positive
 
-            mix_shards.append(cur_day_mix_shard)
+        Returns:
+            (neg_rows, neg_items), grouped by row
+        """
+        num_rows, num_items = keys.shape
+        # 每天的正样本位图；重复的正样本也计入负样本数，与逐天采样时一致
+        pos_mask = np.zeros((num_rows, num_items), dtype=bool)
+        pos_mask[pos_rows, np.searchsorted(self.all_items, pos_items)] = True
+        num_neg = np.minimum(2 * np.bincount(pos_rows, minlength=num_rows), num_items - pos_mask.sum(axis=1))
+        keys[pos_mask] = 2.  # 随机数都小于1，正样本不会被选中
+
+        k_max = int(num_neg.max()) if num_rows > 0 else 0
+        if k_max == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        candidates = np.argpartition(keys, k_max - 1, axis=1)[:, :k_max]
+        order = np.argsort(np.take_along_axis(keys, candidates, axis=1), axis=1)
+        candidates = np.take_along_axis(candidates, order, axis=1)
+        selected = np.arange(k_max)[None, :] < num_neg[:, None]
+        return np.nonzero(selected)[0], self.all_items[candidates[selected]].astype(np.int64)
+
+    def _all_day_neg_samples(self, pos_shard, mappedid, rng: np.random.Generator = None):
+        rng = rng if rng is not None else self.admission_rng(mappedid)
+        arrays = self.neg_sample_arrays([(mappedid, pos_shard['item_id'].values, pos_shard['day'].values)], [rng])
 
         # 统一变成了以下形式的DF数据，示例：
         # user_id, item_id, label,  day
@@ -626,7 +709,7 @@ class SingleItemType(OneAdm):
         #       0,       5,     1,    0
         #       0,      11,     1,    1
         #       0,     225,     0,    2
-        return pd.concat(mix_shards, axis=0) if len(mix_shards) > 0 else pd.DataFrame()
+        return pd.DataFrame(arrays) if len(arrays["label"]) > 0 else pd.DataFrame()
 
     def __getitem__(self, idx):
         uid = self.admissions[idx]
@@ -699,12 +782,60 @@ class SingleItemType(OneAdm):
         return ret
 
 
-def get_pos_or_neg_shard(interaction: pd.DataFrame, is_pos: bool):
-    """得到interaction正或负样本的部分"""
-    if is_pos:
-        return interaction[interaction.label == 1]
+def mix_day_samples(pos_rows: np.ndarray, pos_items: np.ndarray, neg_rows: np.ndarray, neg_items: np.ndarray):
+    """正、负样本按所在的(住院, 天)行排在一起（行内先正后负），返回(rows, items, labels)"""
+    mix_rows = np.concatenate([pos_rows, neg_rows])
+    mix_items = np.concatenate([pos_items, neg_items])
+    mix_labels = np.concatenate([np.ones(len(pos_rows), dtype=np.int64), np.zeros(len(neg_rows), dtype=np.int64)])
+    grouped = np.argsort(mix_rows, kind="stable")
+    return mix_rows[grouped], mix_items[grouped], mix_labels[grouped]
+
+
+def add_bpr_triples(interaction: Dict[str, torch.Tensor], num_neg_per_pos: int = 2) -> Dict[str, torch.Tensor]:
+    r"""Pair each positive of a batch with `num_neg_per_pos` negatives of the same (admission, day) in the batch.
+
+    The k-th positive of an (admission, day) gets its (num_neg_per_pos * k)-th, ... negatives (cycling if the batch
+    holds fewer of them, e.g. a day cut by the batch boundary); positives without any negative in the batch are
+    dropped. The (user, positive item, negative item) triples are added as `bpr_user_id`, `bpr_pos_item_id` and
+    `bpr_neg_item_id`, the rows of the batch are kept.
+    """
+    user_id, item_id = interaction["user_id"], interaction["item_id"]
+    day = interaction["day"].long()
+    group = user_id.long() * (int(day.max()) + 1 if len(day) > 0 else 1) + day  # (住院, 天)的编号
+    is_pos = interaction["label"] == 1
+
+    # 正、负样本各自按(住院, 天)排在一起（组内保持batch中的顺序）
+    pos_rows, neg_rows = torch.nonzero(is_pos).squeeze(1), torch.nonzero(~is_pos).squeeze(1)
+    pos_rows = pos_rows[torch.sort(group[pos_rows], stable=True).indices]
+    neg_rows = neg_rows[torch.sort(group[neg_rows], stable=True).indices]
+    pos_groups, neg_groups = group[pos_rows], group[neg_rows]
+    _, pos_counts = torch.unique_consecutive(pos_groups, return_counts=True)
+    neg_unique_groups, neg_counts = torch.unique_consecutive(neg_groups, return_counts=True)
+    neg_starts = torch.cumsum(neg_counts, dim=0) - neg_counts
+    pos_rank = torch.arange(len(pos_rows)) - torch.repeat_interleave(torch.cumsum(pos_counts, dim=0) - pos_counts,
+                                                                     pos_counts)  # 在组内的次序
+
+    # 各正样本所在组的负样本
+    if len(neg_unique_groups) > 0:
+        g = torch.searchsorted(neg_unique_groups, pos_groups).clamp(max=len(neg_unique_groups) - 1)
+        has_neg = neg_unique_groups[g] == pos_groups
     else:
-        return interaction[interaction.label == 0]
+        g, has_neg = torch.zeros_like(pos_groups), torch.zeros_like(pos_groups, dtype=torch.bool)
+    pos_rows, pos_rank, g = pos_rows[has_neg], pos_rank[has_neg], g[has_neg]
+    slots = (pos_rank.unsqueeze(1) * num_neg_per_pos + torch.arange(num_neg_per_pos)) % neg_counts[g].unsqueeze(1)
+    triple_neg_rows = neg_rows[neg_starts[g].unsqueeze(1) + slots].reshape(-1)
+    triple_pos_rows = pos_rows.repeat_interleave(num_neg_per_pos)
+
+    interaction = dict(interaction)
+    interaction["bpr_user_id"] = user_id[triple_pos_rows]
+    interaction["bpr_pos_item_id"] = item_id[triple_pos_rows]
+    interaction["bpr_neg_item_id"] = item_id[triple_neg_rows]
+    return interaction
+
+
+def interaction_to_dataframe(interaction: Dict[str, torch.Tensor]) -> pd.DataFrame:
+    """把batch中每行一个值的列（不含history等序列列）转为DataFrame，如用于汇总测试集上的预测"""
+    return pd.DataFrame({name: tensor.cpu().numpy() for name, tensor in interaction.items() if tensor.dim() == 1})
 
 
 class SingleItemTypeForContextAwareRec(SingleItemType):
@@ -740,107 +871,506 @@ class SingleItemTypeForContextAwareRec(SingleItemType):
 
         return pd.concat([interaction, user_feat_shard, item_feat_shard], axis=1)
 
+    def stacked_fields(self):
+        r"""Layout of the feature matrices stored by `DFDataset` (the fields of `ContextEmbeddingLayer`, users first).
+
+        Returns:
+            (token_field_names, token_field_offsets, float_field_names): the offsets place each token field
+            in the embedding table shared by all the token fields
+        """
+        field_names = self.fields(source=[FeatureSource.USER, FeatureSource.ITEM_ID, FeatureSource.ITEM])
+        token_field_names = [f for f in field_names if self.source_dfs.field2type[f] == FeatureType.TOKEN]
+        float_field_names = [f for f in field_names if self.source_dfs.field2type[f] == FeatureType.FLOAT]
+        token_field_dims = [self.num(f) for f in token_field_names]
+        token_field_offsets = np.array((0, *np.cumsum(token_field_dims)[:-1]), dtype=np.int64)
+        return token_field_names, token_field_offsets, float_field_names
+
 
 class SingleItemTypeForSequentialRec(SingleItemType):
     def __getitem__(self, idx):
+        interaction, histories = self.get_with_histories(idx)
+        if len(interaction) > 0:  # 每行带上完整的历史序列
+            loc = interaction.columns.get_loc('history_id')
+            history = [histories[k] for k in interaction['history_id'].values]
+            interaction = interaction.drop(columns='history_id')
+            interaction.insert(loc, 'history', history)
+        return interaction
+
+    def get_with_histories(self, idx):
+        r"""Like `__getitem__`, but the history of a day is stored once instead of in each row of the day.
+
+        Returns:
+            (interaction, histories): the rows carry a `history_id` (local to the admission) instead of the history,
+            `histories[history_id]` is the list of history items
+        """
         uid = self.admissions[idx]
         mappedid = self.source_dfs.get_mapped_id('HADM_ID', uid)
         pos_shard = self.gb_uid.get_group(mappedid)
         if len(pos_shard) > 0:
             interaction = self._all_day_neg_samples(pos_shard, mappedid)
             if len(interaction) == 0:
-                return interaction
+                return interaction, []
             else:
-                interaction = self._add_history_seq(pos_shard, interaction)
+                return self._add_history_seq(pos_shard, interaction)
         else:
-            interaction = pd.DataFrame()  # Empty
-        return interaction
+            return pd.DataFrame(), []  # Empty
 
     def _add_history_seq(self, pos_shard, interaction):
-        """从第二天开始，为每条记录添加历史序列，"""
+        """从第二天开始，为每条记录添加历史序列的编号history_id及其长度，每天的历史序列只存一份"""
         pos_gb_day = pos_shard.groupby('day')
         int_gb_day = interaction.groupby('day')
 
         collector = []
+        histories: List[List[int]] = []
         days = pos_shard.day.unique().tolist()
         days = [day for day in days if day < max_adm_length]
         for i, d in enumerate(days):
             if i == 0:
                 continue
             pos_pre_day = pos_gb_day.get_group(days[i-1])  # 前一个有记录的天
-            int_cur_day = int_gb_day.get_group(d)
+            int_cur_day = int_gb_day.get_group(d).reset_index(drop=True)
 
             history = pos_pre_day['item_id'].values.tolist()
-            history_len = len(history)
+            int_cur_day['history_id'] = len(histories)
+            int_cur_day['history_len'] = len(history)
+            histories.append(history)
 
-            history = [history for _ in range(len(int_cur_day))]
-            history_len = [history_len for _ in range(len(int_cur_day))]
+            collector.append(int_cur_day)
 
-            df_hist = pd.DataFrame({'history': history,
-                                    'history_len': history_len})
+        if len(collector) == 0:
+            return pd.DataFrame(), []
+        return pd.concat(collector, axis=0), histories
 
-            int_cur_day.reset_index(inplace=True, drop=True)
-            df_hist.reset_index(inplace=True, drop=True)
 
-            collector.append(pd.concat([int_cur_day, df_hist], axis=1))
+class DFDataset(Dataset):
+    r"""供基线模型使用的Dataset，缓存为二进制列存储（见`dataset/columnar.py`），内存映射加载
 
-        return pd.concat(collector, axis=0)
+    The DataLoader fetches a whole batch at once through `__getitems__` (a slice for contiguous indices,
+    otherwise one gather per column). A batch is a dict of tensors keeping the stored dtypes (int32 ids and
+    token features, float32 float features, int32 label), which the embedding layers and the models take directly.
 
+    For the context-aware datasets, the feature fields are stored stacked as two matrices, `token_fields`
+    (int32, with the offset of each field in the shared embedding table already added) and `float_fields`
+    (float32), in the order of `SingleItemTypeForContextAwareRec.stacked_fields`, so that a batch is embedded
+    with a single lookup and a single linear layer.
 
-class DFDataset(Dataset):
-    r"""供基线模型使用的DataFrame Dataset"""
-    def __init__(self, pre_dataset):
+    For the sequential datasets, a history (the items of the previous day) is stored once per (admission, day)
+    in the `histories` table, and the rows only carry its `history_id`. A batch holds the distinct histories
+    of its rows in `history`, padded to the longest one, and `history_id` indexes them per row
+    (`history[history_id]`), with `history_len` giving the valid lengths.
+
+    The cache is kept per (seed, source data), i.e. in `data/{name}/{split}_{item_type}_seed{seed}_{source hash}`,
+    so a different seed or `--root_path_dataset` never loads the samples built for another one.
+    """
+    ragged_columns = ("history",)
+
+    def __init__(self, pre_dataset, num_workers: int = 1):
+        r"""
+        Args:
+            pre_dataset: one of the `SingleItemType*` datasets, built into the cache if it is not cached yet
+            num_workers: processes building the cache, the result is the same whatever the number
+        """
         name = pre_dataset.__class__.__name__
         split = pre_dataset.split
         item_type = pre_dataset.item_type
-        self.dataframe = self._get_preprocessed(name, split, item_type)  # 如果处理过，就直接加载
-
-        if self.dataframe is None:
-            self._collect_all_shard(pre_dataset)
-            self._save(name, split, item_type)
+        self.seed = pre_dataset.seed
+        self.path_etl_output = pre_dataset.source_dfs.path_etl_output
+        self.histories: Optional[ColumnarTable] = None  # 仅序列推荐的数据集有
+        # 仅上下文感知推荐的数据集有：特征列按此堆叠成矩阵存储
+        self.stacked_fields = pre_dataset.stacked_fields() \
+            if isinstance(pre_dataset, SingleItemTypeForContextAwareRec) else None
+        # 并发的试验（如run_sweep.py）只由第一个构建缓存，其余的等待后直接加载
+        with file_lock(self._get_table_dir(name, split, item_type)):
+            self.table = self._get_preprocessed(name, split, item_type)  # 如果处理过，就直接加载
+
+            if self.table is None:
+                self.table, self.histories = self._collect_all_shard(pre_dataset, num_workers)
+                self.table = self._stack_fields(self.table)
+                self._save(name, split, item_type)
 
     def _collect_all_shard(self, pre_dataset: Union[SingleItemType,
                                                     SingleItemTypeForContextAwareRec,
-                                                    SingleItemTypeForSequentialRec]):
-        print("> in DFDataset, concat all single admission instances...")
-        # 遍历，收集，拼成一个大的
-        all_adm_interaction = []
-        for sgl_adm_interaction in tqdm(pre_dataset, leave=False, ncols=80):
-            all_adm_interaction.append(sgl_adm_interaction)
-        self.dataframe = pd.concat(all_adm_interaction, axis=0)
+                                                    SingleItemTypeForSequentialRec],
+                           num_workers: int = 1):
+        print(f"> in DFDataset, concat all single admission instances ({num_workers} workers)...")
+        if num_workers > 1 and "fork" not in mp.get_all_start_methods():
+            print("> fork is unavailable, building in the main process")
+            num_workers = 1
+
+        if num_workers <= 1:
+            # 遍历，收集，拼成一个大的
+            all_adm_interaction = []
+            for idx in tqdm(range(len(pre_dataset)), leave=False, ncols=80):
+                with profiler.region("build_adm_interaction"):
+                    all_adm_interaction.append(_get_adm_interaction(pre_dataset, idx))
+            table, histories = _interactions_to_table(all_adm_interaction)
+        else:
+            # 按住院的顺序切成若干段，各工作进程把自己的段写成部分表，最后按顺序拼接
+            global _build_pre_dataset
+            _build_pre_dataset = pre_dataset  # 工作进程由fork继承，不需要序列化
+            path_dir_parts = self.table_dir + ".parts"
+            shutil.rmtree(path_dir_parts, ignore_errors=True)
+            os.makedirs(path_dir_parts)
+            chunk_size = max(1, len(pre_dataset) // (num_workers * 8))
+            tasks = [(k, range(start, min(start + chunk_size, len(pre_dataset))), path_dir_parts)
+                     for k, start in enumerate(range(0, len(pre_dataset), chunk_size))]
+            try:
+                with mp.get_context("fork").Pool(num_workers) as pool:
+                    paths = list(tqdm(pool.imap(_build_part, tasks), total=len(tasks), leave=False, ncols=80))
+                tables, all_histories = [], []
+                for path in paths:
+                    if path is None:
+                        continue
+                    table = ColumnarTable.load(path, mmap=True)
+                    if ColumnarTable.exists(_histories_dir(path)):  # 历史序列编号平移到拼接后的位置
+                        table.columns["history_id"] = table.columns["history_id"] + sum(map(len, all_histories))
+                        all_histories.append(ColumnarTable.load(_histories_dir(path), mmap=True))
+                    tables.append(table)
+                table = ColumnarTable.concat(tables)
+                histories = ColumnarTable.concat(all_histories) if len(all_histories) > 0 else None
+            finally:
+                _build_pre_dataset = None
+            shutil.rmtree(path_dir_parts, ignore_errors=True)
         print("> done!")
+        return table, histories
 
     def _get_preprocessed(self, name, split, item_type):
-        data_folder = self._get_data_folder(name)
-        filename = os.path.join(data_folder, f"{split}_{item_type}.csv.gz")
-        if os.path.isfile(filename):
-            return pd.read_csv(filename, index_col=0, dtype={"history": "string"})
-        else:
+        table_dir = self._get_table_dir(name, split, item_type)
+        if ColumnarTable.exists(table_dir):
+            table = ColumnarTable.load(table_dir, mmap=True)
+            if "history_id" in table.columns:
+                if not ColumnarTable.exists(_histories_dir(table_dir)):  # 没写完的缓存，重新构建
+                    return None
+                self.histories = ColumnarTable.load(_histories_dir(table_dir), mmap=True)
+                return table
+            if "history" in table.ragged:
+                # 每行一份历史序列的旧版列存储，去重后重新保存
+                print(f"> deduplicating the histories of {table_dir}...")
+                dataframe = table.to_dataframe()
+            elif self.stacked_fields is not None and "token_fields" not in table.columns:
+                # 特征逐列存储的旧版列存储，堆叠后重新保存
+                print(f"> stacking the feature fields of {table_dir}...")
+                self.table = self._stack_fields(table)
+                self._save(name, split, item_type)
+                return self._get_preprocessed(name, split, item_type)
+            else:
+                return table
+        elif not self._is_legacy_setting():
             return None
+        elif ColumnarTable.exists(self._get_legacy_table_dir(name, split, item_type)):
+            # 不区分种子和数据源的旧版列存储（默认种子、默认数据源构建的），拷贝过来后再按上面的流程转换
+            legacy_dir = self._get_legacy_table_dir(name, split, item_type)
+            print(f"> moving the cache of {legacy_dir} to {table_dir}...")
+            shutil.copytree(legacy_dir, table_dir)
+            return self._get_preprocessed(name, split, item_type)
+        else:
+            # 旧版的csv缓存：解析一次history字符串，转存为列存储
+            filename = self._get_csv_filename(name, split, item_type)
+            if not os.path.isfile(filename):
+                return None
+            print(f"> converting {filename} to columnar cache...")
+            dataframe = pd.read_csv(filename, index_col=0, dtype={"history": "string"})
+            if "history" in dataframe.columns:
+                dataframe["history"] = dataframe["history"].apply(string2list)
+
+        if "history" in dataframe.columns:
+            dataframe, histories = _dedup_histories(dataframe.reset_index(drop=True))
+            self.histories = _histories_to_table(histories)
+        self.table = ColumnarTable.from_dataframe(dataframe.reset_index(drop=True), self.ragged_columns, field2type)
+        self.table = self._stack_fields(self.table)
+        self._save(name, split, item_type)
+        return self._get_preprocessed(name, split, item_type)
+
+    def _stack_fields(self, table: ColumnarTable) -> ColumnarTable:
+        """上下文感知推荐的数据集：特征列 -> `token_fields`（加上偏移）、`float_fields`两个矩阵，其余列不变"""
+        if self.stacked_fields is None or len(table) == 0:
+            return table
+        return ColumnarTable(stack_feature_fields(table.columns, self.stacked_fields), table.ragged)
+
+    def _unstack_fields(self, dataframe: pd.DataFrame) -> pd.DataFrame:
+        """`_stack_fields`的逆过程（作用于`ColumnarTable.take`得到的DataFrame），还原逐列的特征"""
+        if self.stacked_fields is None:
+            return dataframe
+        token_field_names, token_field_offsets, float_field_names = self.stacked_fields
+        for name, field_names, offsets in (("token_fields", token_field_names, token_field_offsets),
+                                           ("float_fields", float_field_names, 0)):
+            if name not in dataframe.columns:
+                continue
+            values = np.array(dataframe.pop(name).tolist()).reshape(len(dataframe), len(field_names)) - offsets
+            for k, field_name in enumerate(field_names):
+                if field_name not in dataframe.columns:  # user_id、item_id已有单独的一列
+                    dataframe[field_name] = values[:, k]
+        return dataframe
 
     def _save(self, name, split, item_type):
-        data_folder = self._get_data_folder(name)
-        os.makedirs(data_folder, exist_ok=True)
-        filename = os.path.join(data_folder, f"{split}_{item_type}.csv.gz")
-        self.dataframe.to_csv(filename, compression='gzip')
+        table_dir = self._get_table_dir(name, split, item_type)
+        self.table.save(table_dir)
+        if self.histories is not None:  # 写在主表之后，加载时据此判断缓存是否完整
+            self.histories.save(_histories_dir(table_dir))
+
+    def export_csv(self, filename=None):
+        r"""Export to the csv format of the former cache (`history` as strings), e.g. for inspection."""
+        if filename is None:
+            filename = os.path.join(os.path.dirname(self.table_dir), os.path.basename(self.table_dir) + ".csv.gz")
+        dataframe = self._unstack_fields(self.table.to_dataframe())
+        if self.histories is not None:
+            histories = self.histories.to_dataframe()["history"].map(str).values
+            loc = dataframe.columns.get_loc("history_id")
+            history = histories[dataframe.pop("history_id").values]
+            dataframe.insert(loc, "history", history)
+        dataframe.to_csv(filename, compression='gzip')
+        return filename
 
     def _get_data_folder(self, name):
         return os.path.join("data", name)  # 正确前提：运行于项目一级目录下的主脚本
 
+    def _get_table_dir(self, name, split, item_type):
+        source_hash = hashlib.sha1(os.path.abspath(self.path_etl_output).encode()).hexdigest()[:8]
+        self.table_dir = os.path.join(self._get_data_folder(name),
+                                      f"{split}_{item_type}_seed{self.seed}_{source_hash}")
+        return self.table_dir
+
+    def _is_legacy_setting(self):
+        """旧版缓存（列存储和csv）只由默认种子、默认数据源构建"""
+        return self.seed == 3407 and \
+            os.path.abspath(self.path_etl_output) == os.path.abspath(constant.PATH_MIMIC_III_ETL_OUTPUT)
+
+    def _get_legacy_table_dir(self, name, split, item_type):
+        return os.path.join(self._get_data_folder(name), f"{split}_{item_type}")
+
+    def _get_csv_filename(self, name, split, item_type):
+        return os.path.join(self._get_data_folder(name), f"{split}_{item_type}.csv.gz")
+
     def __len__(self):
-        return len(self.dataframe)
+        return len(self.table)
 
     def __getitem__(self, idx):
-        # 获取数据行
-        return self.dataframe.iloc[idx]
+        # 获取数据行（`pd.Series`，带完整的历史序列），DataLoader按batch取数据时不会用到
+        row = self._unstack_fields(self.table.take(slice(idx, idx + 1))).iloc[0]
+        if self.histories is not None:
+            history_id = int(row.pop("history_id"))
+            history = self.histories.take(slice(history_id, history_id + 1))["history"].iloc[0]
+            row = pd.concat([row, pd.Series({"history": history})])
+        return row
+
+    def __getitems__(self, indices: List[int]) -> Dict[str, torch.Tensor]:
+        r"""Fetch a batch of rows in one go (called by the DataLoader instead of `__getitem__` per row)."""
+        if len(indices) > 0 and indices[-1] - indices[0] + 1 == len(indices) and \
+                all(indices[k] < indices[k + 1] for k in range(len(indices) - 1)):
+            batch = self.table.take_tensors(slice(indices[0], indices[-1] + 1))  # 连续的行直接切片
+        else:
+            batch = self.table.take_tensors(np.asarray(indices))
+
+        if self.histories is not None:
+            # 只取出本batch用到的历史序列，history_id改为在其中的下标
+            unique_ids, batch["history_id"] = torch.unique(batch["history_id"], return_inverse=True)
+            batch["history"] = self.histories.take_tensors(unique_ids.numpy())["history"]
+        return batch
+
+    @staticmethod
+    def collect_bpr_fn(rows) -> Dict[str, torch.Tensor]:
+        """`collect_fn`，再加上BPR的(用户, 正样本, 负样本)三元组（见`add_bpr_triples`）"""
+        batch = DFDataset.collect_fn(rows)
+        with profiler.region("collate"):
+            return add_bpr_triples(batch)
 
     @staticmethod
-    def collect_fn(rows):
-        df = pd.DataFrame(rows)
-        if 'history' in df.columns:
-            df['history'] = df['history'].astype("string")
-            df['history'] = df['history'].apply(string2list)
-        return df
+    def collect_fn(rows) -> Dict[str, torch.Tensor]:
+        with profiler.region("collate"):
+            if isinstance(rows, dict):  # 已由`__getitems__`整批取出
+                return rows
+            # 逐行取出的数据（如不支持`__getitems__`的旧版torch），先拼成DataFrame再转换，每行一份历史序列
+            df = pd.DataFrame(rows).reset_index(drop=True)
+            if 'history' in df.columns and len(df) > 0 and isinstance(df['history'].iloc[0], str):
+                df['history'] = df['history'].astype("string")
+                df['history'] = df['history'].apply(string2list)
+            batch = ColumnarTable.from_dataframe(df, DFDataset.ragged_columns, field2type).take_tensors(slice(None))
+            if 'history' in batch:
+                batch['history_id'] = torch.arange(len(df))
+            return batch
+
+
+class NegSamplingDataset(Dataset):
+    r"""供基线模型训练使用的Dataset，只保存正样本，负样本在取batch时采样，每个epoch都不同
+
+    The positives are grouped into (admission, day) units. An epoch shuffles the units (`set_epoch`) and packs them
+    into batches of about `batch_size` rows (each positive comes with 2 negatives), and an item of the dataset is
+    a whole batch: the negatives of its units are drawn with the vectorized `SingleItemType.sample_day_negatives`,
+    and it has the same columns as the batches of `DFDataset` built from the same `pre_dataset` (stacked features,
+    or deduplicated histories). Load it with `batch_size=None` and `DFDataset.collect_fn`.
+
+    The random numbers of a batch only depend on (seed, epoch, batch index), so the batches do not depend on the
+    DataLoader workers, and a resumed run gets the same batches.
+    """
+
+    def __init__(self, pre_dataset: Union[SingleItemType,
+                                          SingleItemTypeForContextAwareRec,
+                                          SingleItemTypeForSequentialRec],
+                 batch_size: int, seed: int = None):
+        r"""
+        Args:
+            pre_dataset: one of the `SingleItemType*` datasets, only its positives are used
+            batch_size: approximate number of rows (positives and negatives) of a batch
+            seed: seed of the shuffling and of the negative sampling, `pre_dataset.seed` if None
+        """
+        self.pre_dataset = pre_dataset
+        self.batch_size = batch_size
+        self.seed = seed if seed is not None else pre_dataset.seed
+        self.stacked_fields = pre_dataset.stacked_fields() \
+            if isinstance(pre_dataset, SingleItemTypeForContextAwareRec) else None
+        self.with_histories = isinstance(pre_dataset, SingleItemTypeForSequentialRec)
+
+        # 本数据集住院的正样本，按(住院, 天)分组，组内保持原顺序
+        map_df = pre_dataset.source_dfs.tokenfields2mappedid['HADM_ID']
+        mapped_ids = pd.Series(map_df['mappedID'].values, index=map_df['HADM_ID'].values).loc[pre_dataset.admissions]
+        positives = pre_dataset.interaction[pre_dataset.interaction['user_id'].isin(mapped_ids.values)]
+        positives = positives[positives['day'] < max_adm_length]  # 设置最长住院长度限制
+        user_ids, days = positives['user_id'].values, positives['day'].values
+        order = np.lexsort((days, user_ids))  # 稳定排序
+        user_ids, days, items = user_ids[order], days[order], positives['item_id'].values[order]
+        is_start = np.ones(len(items), dtype=bool)
+        is_start[1:] = (user_ids[1:] != user_ids[:-1]) | (days[1:] != days[:-1])
+        starts = np.flatnonzero(is_start)
+        # 每个(住院, 天)一行，items为当天的正样本，也是下一个有记录的天的历史序列
+        self.units = ColumnarTable(
+            {"user_id": user_ids[starts].astype(np.int64), "day": days[starts].astype(np.int64)},
+            {"items": (items.astype(np.int32), np.append(starts, len(items)).astype(np.int64))})
+        unit_user = self.units.columns["user_id"]
+        # 同一住院的上一个(住院, 天)，没有则为-1；序列推荐从第二天开始，每天以前一天的正样本为历史序列
+        self.prev_unit = np.where(np.append(False, unit_user[1:] == unit_user[:-1]),
+                                  np.arange(len(self.units)) - 1, -1)
+        self.train_units = np.flatnonzero(self.prev_unit >= 0) if self.with_histories else np.arange(len(self.units))
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch: int):
+        """打乱(住院, 天)，并按约batch_size行分成各batch（单个(住院, 天)不拆分）"""
+        self.epoch = epoch
+        units = np.random.default_rng([self.seed, epoch]).permutation(self.train_units)
+        _, offsets = self.units.ragged["items"]
+        num_rows = 3 * (offsets[units + 1] - offsets[units])  # 每个正样本带2个负样本
+        batch_of_unit = (np.cumsum(num_rows) - num_rows) // self.batch_size
+        self.batches = np.split(units, np.flatnonzero(np.diff(batch_of_unit)) + 1) if len(units) > 0 else []
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, idx) -> Dict[str, torch.Tensor]:
+        units = self.batches[idx]
+        rng = np.random.default_rng([self.seed, self.epoch, idx])
+        values, offsets = self.units.ragged["items"]
+        starts, counts = offsets[units], offsets[units + 1] - offsets[units]
+
+        # 各(住院, 天)的正样本，按行排在一起
+        pos_rows = np.repeat(np.arange(len(units)), counts)
+        pos_items = values[np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+        pos_items = pos_items.astype(np.int64)
+        neg_rows, neg_items = self.pre_dataset.sample_day_negatives(
+            rng.random((len(units), len(self.pre_dataset.all_items))), pos_rows, pos_items)
+        rows, items, labels = mix_day_samples(pos_rows, pos_items, neg_rows, neg_items)
+        order = np.lexsort((rng.random(len(rows)), rows))  # 打乱每天之内的顺序
+        rows, items, labels = rows[order], items[order], labels[order]
+
+        user_ids = self.units.columns["user_id"][units][rows]
+        columns = {
+            "user_id": user_ids.astype(np.int32),
+            "item_id": items.astype(np.int32),
+            "label": labels.astype(np.int32),
+            "day": self.units.columns["day"][units][rows].astype(np.int32),
+        }
+        if self.stacked_fields is not None:
+            user_feat = self.pre_dataset.get_user_feature(torch.from_numpy(user_ids)).numpy()
+            item_feat = self.pre_dataset.get_item_feature(torch.from_numpy(items)).numpy()
+            columns.update({name: user_feat[:, k] for k, name in enumerate(self.pre_dataset.user_feat_fields)})
+            columns.update({name: item_feat[:, k] for k, name in enumerate(self.pre_dataset.item_feat_fields)})
+            columns = stack_feature_fields(columns, self.stacked_fields)
+        batch = {name: torch.from_numpy(array) for name, array in columns.items()}
+
+        if self.with_histories:
+            # 与DFDataset的batch一致：本batch用到的历史序列（填充到最长的），history_id为每行在其中的下标
+            unique_prev, history_id = np.unique(self.prev_unit[units], return_inverse=True)
+            histories = self.units.take_tensors(unique_prev)
+            batch["history_id"] = torch.from_numpy(history_id.reshape(-1)[rows])
+            batch["history_len"] = histories["items_len"][batch["history_id"]]
+            batch["history"] = histories["items"]
+        return batch
+
+
+def stack_feature_fields(columns: Dict[str, np.ndarray], stacked_fields) -> Dict[str, np.ndarray]:
+    r"""Replace the feature columns by the `token_fields` (int32, offsets added) and `float_fields` (float32) matrices.
+
+    Args:
+        columns: name -> array of each column, including the fields of `stacked_fields`
+        stacked_fields: see `SingleItemTypeForContextAwareRec.stacked_fields`
+    """
+    token_field_names, token_field_offsets, float_field_names = stacked_fields
+    # user_id、item_id也保留单独的一列，如供测试时汇总预测
+    stacked = {name: array for name, array in columns.items()
+               if name in ("user_id", "item_id") or name not in token_field_names + float_field_names}
+    if len(token_field_names) > 0:
+        stacked["token_fields"] = np.stack([columns[f] for f in token_field_names], axis=1).astype(np.int32) \
+            + token_field_offsets.astype(np.int32)
+    if len(float_field_names) > 0:
+        stacked["float_fields"] = np.stack([columns[f] for f in float_field_names], axis=1).astype(np.float32)
+    return stacked
+
+
+_build_pre_dataset = None  # 并行构建DFDataset时，在fork之前设置
+
+
+def _get_adm_interaction(pre_dataset, idx):
+    """一个住院的样本，及其历史序列（非序列推荐的数据集为None）"""
+    if isinstance(pre_dataset, SingleItemTypeForSequentialRec):
+        return pre_dataset.get_with_histories(idx)
+    return pre_dataset[idx], None
+
+
+def _histories_dir(table_dir):
+    return os.path.join(table_dir, "histories")
+
+
+def _histories_to_table(histories: List[List[int]]) -> ColumnarTable:
+    return ColumnarTable.from_dataframe(pd.DataFrame({"history": histories}), DFDataset.ragged_columns)
+
+
+def _dedup_histories(dataframe: pd.DataFrame):
+    """每行一份历史序列 -> 每个(住院, 天)一份，行中只保留history_id"""
+    history_id = dataframe.groupby(["user_id", "day"], sort=False).ngroup().values
+    histories = dataframe["history"].values[~pd.Series(history_id).duplicated().values].tolist()
+    loc = dataframe.columns.get_loc("history")
+    dataframe = dataframe.drop(columns="history")
+    dataframe.insert(loc, "history_id", history_id)
+    return dataframe, histories
+
+
+def _interactions_to_table(interactions: List[Tuple[pd.DataFrame, Optional[List[List[int]]]]]):
+    r"""Concat the (interaction, histories) of the admissions, returns the table and the table of histories
+    (None for the datasets without histories), with `history_id` offset to the position in the latter."""
+    dataframes, all_histories = [], []
+    for interaction, histories in interactions:
+        if len(interaction) == 0:
+            continue
+        if histories is not None:
+            interaction = interaction.assign(history_id=interaction["history_id"] + len(all_histories))
+            all_histories.extend(histories)
+        dataframes.append(interaction)
+    if len(dataframes) == 0:
+        return ColumnarTable({}), None
+    dataframe = pd.concat(dataframes, axis=0).reset_index(drop=True)
+    table = ColumnarTable.from_dataframe(dataframe, DFDataset.ragged_columns, field2type)
+    return table, (_histories_to_table(all_histories) if "history_id" in dataframe.columns else None)
+
+
+def _build_part(task):
+    """在工作进程中构建一段住院的样本，写成部分表，返回其路径（没有样本时返回None）"""
+    part_idx, indices, path_dir_parts = task
+    table, histories = _interactions_to_table([_get_adm_interaction(_build_pre_dataset, idx) for idx in indices])
+    if len(table) == 0:
+        return None
+    path = os.path.join(path_dir_parts, f"part_{part_idx:05d}")
+    table.save(path)
+    if histories is not None:
+        histories.save(_histories_dir(path))
+    return path
 
 
 # https://stackoverflow.com/questions/69959719
@@ -1,2 +1,14 @@
 #!/bin/bash
 # following codes are assumed to be executed under conda env
+
+# sliding-window temporal attention at several window sizes W, next to full attention. An experimental option:
+# no throughput gain over full attention has been measured (stays up to 67 days, where the GNN dominates a day's cost)
+python run_backbone.py --train --test --max_adm_length 100 --notes "full attention, max_adm_length=100"
+for W in 3 7 14 28; do
+  python run_backbone.py --train --test --max_adm_length 100 --attention_window $W --attention_summary \
+    --notes "attention window W=$W with summary token, max_adm_length=100"
+done
+
+# the same windows as concurrent trials sharing one loaded dataset (throughput numbers are then not comparable
+# with the sequential runs, as the trials share the CPU cores)
+# python run_sweep.py --runner backbone --trials sweeps/attention_window.txt --num_workers 4
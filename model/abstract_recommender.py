@@ -66,6 +66,8 @@ class SequentialRecommender(AbstractRecommender):
         self.ITEM_SEQ = config.get("HISTORY_ITEM_ID_FIELD", "history")
         self.ITEM_SEQ_LEN = config.get("HISTORY_ITEM_ID_LIST_LENGTH_FIELD", "history_len")
         self.max_seq_length = config.get("MAX_HISTORY_ITEM_ID_LIST_LENGTH", 100)
+        # 同一(admission, day)的各行共享历史序列，按组只编码一次历史，再广播到各行
+        self.group_history = config.get("group_history", True)
         self.n_items = dataset.num_items
 
         # load parameters info
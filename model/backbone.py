@@ -3,6 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch
 
+from typing import List
 from d2l import torch as d2l
 from torch_geometric.nn import to_hetero
 from tqdm import tqdm
@@ -16,7 +17,8 @@ from dataset.unified import (SourceDataFrames,
 from utils.config import HeteroGraphConfig, MappingManager, GNNConfig, max_adm_length
 from utils.enum_type import FeatureType
 from utils.misc import init_seed
-from model.layers import LinksPredictor, SingelGnn, GraphEmbeddingLayer, AdditiveAttention
+from utils.profiler import profiler
+from model.layers import LinksPredictor, SingelGnn, GraphEmbeddingLayer, AdditiveAttention, checkpoint_gnn_layers
 from model.init import str2init
 
 
@@ -31,6 +33,12 @@ class BackBoneV2(nn.Module):
                  embedding_size: int = 10,
                  is_gnn_only: bool = False,
                  init_method: str = "xavier_normal",
+                 gnn_checkpoint: bool = False,
+                 gnn_checkpoint_layers: List[int] = None,
+                 sparse_embedding: bool = False,
+                 attention_window: int = None,
+                 attention_summary: bool = False,
+                 max_adm_length: int = max_adm_length,
                  **kwargs):
         super().__init__()
         self.source_dfs = source_dfs  # 提供有用的信息
@@ -43,23 +51,37 @@ class BackBoneV2(nn.Module):
         self.device = device
         self.is_gnn_only = is_gnn_only
 
+        # 时序注意力只看最近`attention_window`天（None则看之前所有天），
+        # `attention_summary`时，把窗口之外更早的天压缩成一个summary token
+        assert attention_window is None or attention_window > 0
+        self.attention_window = attention_window
+        self.attention_summary = attention_summary
+        self.max_adm_length = max_adm_length
+
         self.node_types = self.gnn_conf.node_types
         self.edge_types = self.gnn_conf.edge_types
 
+        # 物品结点数量取自数据本身（MIMIC-III上与MappingManager中的一致），以便使用不同规模的合成数据
+        item_node_num = {
+            "labitem": len(self.source_dfs.itemid2mappedid),
+            "drug": len(self.source_dfs.drugid2mappedid),
+        }
         self.item_vocab_size = {
-            node_type: self.gnn_conf.mapper.node_type_to_node_num[node_type]
+            node_type: item_node_num[node_type]
             for node_type in self.node_types if node_type != "admission"
         }
         self.item_id_embedding = nn.ModuleDict({
-            node_type: nn.Embedding(self.item_vocab_size[node_type], self.embedding_size)
+            node_type: nn.Embedding(self.item_vocab_size[node_type], self.embedding_size, sparse=sparse_embedding)
             for node_type in self.node_types if node_type != "admission"
         })
         self.node_features_embedding = nn.ModuleDict({
-            node_type: GraphEmbeddingLayer(self.embedding_size, *self._get_node_feat_dims(node_type))
+            node_type: GraphEmbeddingLayer(self.embedding_size, *self._get_node_feat_dims(node_type),
+                                           sparse=sparse_embedding)
             for node_type in self.node_types
         })
         self.edge_features_embedding = nn.ModuleDict({
-            "_".join(edge_type): GraphEmbeddingLayer(self.embedding_size, *self._get_edge_feat_dims(edge_type))
+            "_".join(edge_type): GraphEmbeddingLayer(self.embedding_size, *self._get_edge_feat_dims(edge_type),
+                                                     sparse=sparse_embedding)
             for edge_type in self.edge_types if "rev" not in edge_type[1]
         })
 
@@ -91,6 +113,8 @@ class BackBoneV2(nn.Module):
 
         self.gnn = SingelGnn(self.h_dim, self.gnn_conf.gnn_type, self.gnn_conf.gnn_layer_num)
         self.gnn = to_hetero(self.gnn, metadata=(self.gnn_conf.node_types, self.gnn_conf.edge_types))
+        if gnn_checkpoint:  # 用重计算换显存/内存，按层选择
+            checkpoint_gnn_layers(self.gnn, gnn_checkpoint_layers)
 
         # Final links predictor
         self.lp = LinksPredictor(self.h_dim, "mul")
@@ -143,57 +167,81 @@ class BackBoneV2(nn.Module):
 
         return token_field_dims, float_field_nums
 
-    def forward(self, hg):
+    def _encode(self, hg):
+        r"""Embed the features, split `hg` by day and encode all day snapshots with the GNN.
+
+        Returns:
+            total_hgs: the list of day snapshots
+            item_feats_enc: dict of (num_days, num_items, h_dim) item encodings of each item node type
+            patient_conditions: (1, num_days, h_dim), the patient condition of each day
+        """
         # emb
-        for node_type in self.node_types:
-            if node_type != "admission":
-                emb_node_features = self.node_features_embedding[node_type](hg[node_type].x)
-                emb_node_id = self.item_id_embedding[node_type](hg[node_type].node_id).unsqueeze(1)
-                emb_features = torch.cat([emb_node_id, emb_node_features], dim=1)
-                emb_features = self.node_features_aligner[node_type](emb_features.flatten(1))
-                hg[node_type].x = emb_features
-            else:  # admission
-                emb_node_features = self.node_features_embedding[node_type](hg[node_type].x)
-                emb_features = self.node_features_aligner[node_type](emb_node_features.flatten(1))
-                hg[node_type].x = emb_features
-
-        for edge_type in self.edge_types:
-            if "rev" in edge_type[1]:  # 没有按时间分划的原始图中，没有反向连接的边，因此不用处理
-                continue
-            else:
-                emb_edge_features = self.edge_features_embedding["_".join(edge_type)](hg[edge_type].x)
-                emb_features = self.edge_features_aligner["_".join(edge_type)](emb_edge_features.flatten(1))
-                hg[edge_type].x = emb_features
+        with profiler.region("embed"):
+            for node_type in self.node_types:
+                if node_type != "admission":
+                    emb_node_features = self.node_features_embedding[node_type](hg[node_type].x)
+                    emb_node_id = self.item_id_embedding[node_type](hg[node_type].node_id).unsqueeze(1)
+                    emb_features = torch.cat([emb_node_id, emb_node_features], dim=1)
+                    emb_features = self.node_features_aligner[node_type](emb_features.flatten(1))
+                    hg[node_type].x = emb_features
+                else:  # admission
+                    emb_node_features = self.node_features_embedding[node_type](hg[node_type].x)
+                    emb_features = self.node_features_aligner[node_type](emb_node_features.flatten(1))
+                    hg[node_type].x = emb_features
+
+            for edge_type in self.edge_types:
+                if "rev" in edge_type[1]:  # 没有按时间分划的原始图中，没有反向连接的边，因此不用处理
+                    continue
+                else:
+                    emb_edge_features = self.edge_features_embedding["_".join(edge_type)](hg[edge_type].x)
+                    emb_features = self.edge_features_aligner["_".join(edge_type)](emb_edge_features.flatten(1))
+                    hg[edge_type].x = emb_features
 
         # 按天进行分割，获取离散时间动态图
-        total_hgs = OneAdmOneHG.split_by_day(hg)
-        total_hgs = total_hgs[:max_adm_length]  # 设置最长长度限制
+        with profiler.region("split_by_day"):
+            total_hgs = OneAdmOneHG.split_by_day(hg)
+            total_hgs = total_hgs[:self.max_adm_length]  # 设置最长长度限制
 
         # 打包成 mini-batch 供GNN并行处理
-        packed_hgs = OneAdmOneHG.pack_batch(total_hgs, len(total_hgs))
+        with profiler.region("pack_batch"):
+            packed_hgs = OneAdmOneHG.pack_batch(total_hgs, len(total_hgs))
 
         packed_x_collection = packed_hgs.collect('x')
         packed_node_feats_ori = {k: x for k, x in packed_x_collection.items() if k in self.node_types}
         packed_edge_feats_ori = {k: x for k, x in packed_x_collection.items() if k in self.edge_types}
 
         # 这里面有batch norm，这也是为什么至少要有2天及以上的住院时长（确保batch_size > 1）
-        node_feats_enc = self.gnn(packed_node_feats_ori, packed_hgs.edge_index_dict, packed_edge_feats_ori)
+        with profiler.region("gnn"):
+            node_feats_enc = self.gnn(packed_node_feats_ori, packed_hgs.edge_index_dict, packed_edge_feats_ori)
 
         # 拆分每天的物品特征，每个图的物品结点数量固定
         item_feats_enc = {
-            node_type: x.view(-1, self.gnn_conf.mapper.node_type_to_node_num[node_type], self.h_dim)
+            node_type: x.view(-1, self.item_vocab_size[node_type], self.h_dim)
             for node_type, x in node_feats_enc.items() if (node_type != "admission" and node_type in self.node_types)
         }
 
         patient_conditions = node_feats_enc["admission"].unsqueeze(0)  # batch size = 1
 
+        return total_hgs, item_feats_enc, patient_conditions
+
+    def forward(self, hg):
+        total_hgs, item_feats_enc, patient_conditions = self._encode(hg)
+        with profiler.region("day_attention"):
+            return self._attend_by_day(total_hgs, item_feats_enc, patient_conditions)
+
+    def _attend_by_day(self, total_hgs, item_feats_enc, patient_conditions):
+        cum_patient_conditions = patient_conditions.cumsum(dim=1) if self.attention_summary else None
+
         logits = []
         labels = []
         for d, cur_day_hg in enumerate(total_hgs[1:]):  # 这里要扣除第一天，因为我们预测从第二天开始的序列
-            pre_day_patient_conditions = patient_conditions[:, :d+1, :]  # 之前天的病情表示
+            pre_day_patient_conditions = self._get_pre_day_patient_conditions(
+                patient_conditions, d, cum_patient_conditions)  # 之前天的病情表示
             pre_day_item_feats_enc = item_feats_enc[self.goal][d, :, :]  # 前一天的物品emb
 
-            cur_day_seq_to_be_judged, cur_day_01_labels = self._get_cur_day_seq_to_be_judged_and_labels(cur_day_hg)
+            with profiler.region("neg_sample"):
+                cur_day_seq_to_be_judged, cur_day_01_labels = \
+                    self._get_cur_day_seq_to_be_judged_and_labels(cur_day_hg)
             cur_day_seq_to_be_judged_emb = pre_day_item_feats_enc[cur_day_seq_to_be_judged]  # 取出相应行
 
             bsz = cur_day_seq_to_be_judged_emb.size(0)
@@ -226,6 +274,107 @@ class BackBoneV2(nn.Module):
 
         return logits, labels  # 按天收集
 
+    @torch.no_grad()
+    def retrieve(self, hg, k: int = 10, exact: bool = True, approx: bool = False, chunk_size: int = 1024):
+        r"""Top-k retrieval over the full goal vocabulary, for each day from the 2nd day on.
+
+        As `self.lp` scores with the bilinear form `re_weight_a(patient) · re_weight_b(item)`,
+        the item side projections `re_weight_b(item_feats_enc)` of each day snapshot are computed only once.
+
+        Args:
+            hg: the hetero graph of one admission (its features are embedded in place, as in `forward`)
+            k: how many items to retrieve per day
+            exact: rank with the item-attended patient condition, the same scores as `forward`,
+                the attention is computed for `chunk_size` items at a time to bound the memory
+            approx: rank with the un-attended latest patient condition, i.e. one matrix-vector product per day
+            chunk_size: number of items scored at a time
+
+        Returns:
+            Dict: {"exact" / "approx": (list of (k,) top-k scores, list of (k,) top-k item indices)}, one per day
+        """
+        assert self.lp.score_func == "mul", "retrieval only supports the bilinear `mul` score function"
+        assert exact or approx
+
+        total_hgs, item_feats_enc, patient_conditions = self._encode(hg)
+        cum_patient_conditions = patient_conditions.cumsum(dim=1) if self.attention_summary else None
+        goal_feats_enc = item_feats_enc[self.goal]  # (D, N, h)
+        item_projections = self.lp.project_items(goal_feats_enc)  # 每天快照的物品侧映射只算一次
+        num_items = goal_feats_enc.size(1)
+        k = min(k, num_items)
+
+        results = {}
+        if exact:
+            results["exact"] = ([], [])
+        if approx:
+            results["approx"] = ([], [])
+
+        for d in range(len(total_hgs) - 1):
+            pre_day_patient_conditions = self._get_pre_day_patient_conditions(
+                patient_conditions, d, cum_patient_conditions)
+
+            if approx or self.is_gnn_only:
+                # 不经注意力，直接用最近一天的病情表示，一次矩阵-向量乘法给所有物品打分
+                latest_scores = self.lp.score_all(pre_day_patient_conditions[0, -1, :], item_projections[d])
+                latest_topk = torch.topk(latest_scores, k)
+                if approx:
+                    results["approx"][0].append(latest_topk.values)
+                    results["approx"][1].append(latest_topk.indices)
+
+            if not exact:
+                continue
+            if self.is_gnn_only:  # 不用注意力时，上面的打分就是精确的
+                results["exact"][0].append(latest_topk.values)
+                results["exact"][1].append(latest_topk.indices)
+                continue
+
+            # 注意力的queries依赖于物品，因此按块计算，并合并每块的top-k
+            topk_scores = goal_feats_enc.new_empty(0)
+            topk_items = torch.empty(0, dtype=torch.long, device=goal_feats_enc.device)
+            for start in range(0, num_items, chunk_size):
+                chunk_feats_enc = goal_feats_enc[d, start:start+chunk_size, :]
+                bsz = chunk_feats_enc.size(0)
+                att_patient_conditions = self.attention(
+                    queries=chunk_feats_enc.unsqueeze(1),
+                    keys=pre_day_patient_conditions.expand(bsz, -1, -1),
+                    values=pre_day_patient_conditions.expand(bsz, -1, -1),
+                    valid_lens=None
+                ).view(bsz, -1)
+                chunk_scores = torch.mul(self.lp.re_weight_a(att_patient_conditions),
+                                         item_projections[d, start:start+bsz, :]).sum(-1)
+                chunk_items = torch.arange(start, start + bsz, device=chunk_scores.device)
+
+                merged_scores = torch.cat([topk_scores, chunk_scores])
+                merged_items = torch.cat([topk_items, chunk_items])
+                merged_topk = torch.topk(merged_scores, min(k, merged_scores.size(0)))
+                topk_scores, topk_items = merged_topk.values, merged_items[merged_topk.indices]
+
+            results["exact"][0].append(topk_scores)
+            results["exact"][1].append(topk_items)
+
+        return results
+
+    def _get_pre_day_patient_conditions(self, patient_conditions, d, cum_patient_conditions=None):
+        r"""Get the patient conditions attended when predicting day `d+1`.
+
+        Args:
+            patient_conditions: (1, num_days, h_dim)
+            d: index of the latest day to attend
+            cum_patient_conditions: `patient_conditions.cumsum(dim=1)`, needed by the summary token
+
+        Returns:
+            (1, L, h_dim), L = d+1 without a window, otherwise at most `attention_window` (+1 summary token)
+        """
+        if self.attention_window is None or d + 1 <= self.attention_window:
+            return patient_conditions[:, :d+1, :]
+
+        start = d + 1 - self.attention_window
+        window_conditions = patient_conditions[:, start:d+1, :]
+        if self.attention_summary:
+            # 窗口之外的[0, start)天取均值，作为summary token放在最前面
+            summary = (cum_patient_conditions[:, start-1, :] / start).unsqueeze(1)
+            window_conditions = torch.cat([summary, window_conditions], dim=1)
+        return window_conditions
+
     def _get_cur_day_seq_to_be_judged_and_labels(self, hg):
         r"""获取当天需要判断的物品序列"""
 
@@ -233,11 +382,11 @@ class BackBoneV2(nn.Module):
         if self.goal == "drug":
             pos_indices = hg["admission", "took", "drug"].edge_index
             neg_indices = OneAdmOneHG.neg_sample_for_cur_day(
-                pos_indices, num_itm_nodes=self.gnn_conf.mapper.node_type_to_node_num["drug"])
+                pos_indices, num_itm_nodes=self.item_vocab_size["drug"])
         else:  # "labitem"
             pos_indices = hg["admission", "did", "labitem"].edge_index
             neg_indices = OneAdmOneHG.neg_sample_for_cur_day(
-                pos_indices, num_itm_nodes=self.gnn_conf.mapper.node_type_to_node_num["labitem"])
+                pos_indices, num_itm_nodes=self.item_vocab_size["labitem"])
 
         # STEP 2：构建正负序列及标签
         cur_day_pos = pos_indices[1, :]
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as fn
 
 from torch.nn.init import xavier_normal_, constant_
 
@@ -31,6 +32,13 @@ class DSSM(ContextRecommender):
         # parameters initialization
         self.apply(self._init_weights)
 
+        # 物品塔只依赖物品特征：推理时对全部物品算一次并缓存，权重变化后重新计算
+        self.USER_ID = config.get("USER_ID_FIELD", "user_id")
+        self.ITEM_ID = config.get("ITEM_ID_FIELD", "item_id")
+        self.n_items = dataset.num_items
+        self.all_item_token_fields, self.all_item_float_fields = self._all_item_fields(dataset)
+        self._item_tower_cache = None  # (权重的版本, 全部物品归一化后的物品塔输出)
+
     def _init_weights(self, module):
         if isinstance(module, nn.Embedding):
             xavier_normal_(module.weight.data)
@@ -39,6 +47,59 @@ class DSSM(ContextRecommender):
             if module.bias is not None:
                 constant_(module.bias.data, 0)
 
+    def _all_item_fields(self, dataset):
+        """全部物品的物品塔输入：token特征[n_items, item_token_field_num]（已加上偏移），float特征或None"""
+        layer = self.embedding_layer
+        item_feat = dataset.get_item_feature()
+        assert item_feat.size(0) == self.n_items
+        columns = {self.ITEM_ID: torch.arange(self.n_items)}
+        columns.update({name: item_feat[:, k] for k, name in enumerate(dataset.item_feat_fields)})
+
+        item_token_field_names = layer.token_field_names[layer.user_token_field_num:]
+        item_token_field_offsets = torch.as_tensor(layer.token_field_offsets[layer.user_token_field_num:])
+        token_fields = torch.stack([columns[name].long() for name in item_token_field_names], dim=1) \
+            + item_token_field_offsets.unsqueeze(0) if len(item_token_field_names) > 0 else None
+        # 与double_tower_embed_input_fields一致：float特征列都属于物品塔
+        float_fields = torch.stack([columns[name].float() for name in layer.float_field_names], dim=1) \
+            if len(layer.float_field_names) > 0 else None
+        return (token_fields.to(self.device) if token_fields is not None else None,
+                float_fields.to(self.device) if float_fields is not None else None)
+
+    @staticmethod
+    def _tower_input(sparse_embedding, dense_embedding):
+        embeddings = []
+        if sparse_embedding is not None:
+            embeddings.append(sparse_embedding)
+        if dense_embedding is not None and len(dense_embedding.shape) == 3:
+            embeddings.append(dense_embedding)
+        return torch.cat(embeddings, dim=1).flatten(start_dim=1)
+
+    def _item_tower_version(self):
+        """物品塔各参数、缓冲区的存储位置及原地修改的次数，优化器更新、加载权重或移动设备后都会改变"""
+        tensors = list(self.embedding_layer.parameters()) \
+            + list(self.item_mlp_layers.parameters()) + list(self.item_mlp_layers.buffers())
+        return tuple((t.data_ptr(), t._version) for t in tensors)
+
+    def _user_tower(self, interaction):
+        return self.user_mlp_layers(self._tower_input(*self.embedding_layer.embed_user_tower_fields(interaction)))
+
+    @torch.no_grad()
+    def item_tower_outputs(self):
+        r"""The L2-normalized item tower outputs of the whole item vocabulary, [n_items, mlp_hidden_size[-1]].
+
+        Computed in eval mode once, and again only after the weights have changed.
+        """
+        assert not self.training, "the item tower outputs are cached in eval mode only"
+        version = self._item_tower_version()
+        if self._item_tower_cache is None or self._item_tower_cache[0] != version:
+            layer = self.embedding_layer
+            item_sparse_embedding = layer.embed_token_fields(self.all_item_token_fields)
+            item_dense_embedding = layer.embed_float_fields(self.all_item_float_fields)
+            item_dense_embedding = item_dense_embedding.unsqueeze(1) if item_dense_embedding is not None else None
+            item_dnn_out = self.item_mlp_layers(self._tower_input(item_sparse_embedding, item_dense_embedding))
+            self._item_tower_cache = (version, fn.normalize(item_dnn_out, dim=1))
+        return self._item_tower_cache[1]
+
     def forward(self, interaction):
         embed_result = self.embedding_layer.double_tower_embed_input_fields(interaction)
         user_sparse_embedding, user_dense_embedding = embed_result[:2]
@@ -66,11 +127,39 @@ class DSSM(ContextRecommender):
         score = torch.cosine_similarity(user_dnn_out, item_dnn_out, dim=1)
         return score.squeeze(-1)
 
+    @torch.no_grad()
+    def retrieve(self, interaction, k: int = 10):
+        r"""Top-k items over the whole item vocabulary for the user of each row of `interaction`.
+
+        The user tower outputs are scored against the cached item tower outputs with one matrix product of the
+        normalized vectors, i.e. the same cosine scores as `forward`.
+
+        Returns:
+            (scores, items): [B, k] top-k scores (before the sigmoid of `predict`) and item ids
+        """
+        user_dnn_out = self._user_tower(interaction)
+        scores = torch.matmul(fn.normalize(user_dnn_out, dim=1), self.item_tower_outputs().t())  # [B, n_items]
+        topk = torch.topk(scores, min(k, self.n_items), dim=1)
+        return topk.values, topk.indices
+
     def calculate_loss(self, interaction):
-        label = torch.from_numpy(interaction[self.LABEL].values)\
-            .float().to(self.device)
+        label = interaction[self.LABEL].float().to(self.device)
         output = self.forward(interaction)
         return self.loss(output, label)
 
+    @torch.no_grad()
+    def _cached_score(self, interaction):
+        """与`forward`相同的打分：用户塔每个用户只算一次，物品塔的输出取自缓存"""
+        user_ids = interaction[self.USER_ID].to(self.device)
+        unique_users, inverse = torch.unique(user_ids, return_inverse=True)
+        first_rows = inverse.new_empty(len(unique_users)).scatter_(
+            0, inverse, torch.arange(len(user_ids), device=inverse.device))
+        user_dnn_out = self._user_tower({name: tensor[first_rows.to(tensor.device)]
+                                         for name, tensor in interaction.items()})
+        item_ids = interaction[self.ITEM_ID].long().to(self.device)
+        return (fn.normalize(user_dnn_out, dim=1)[inverse] * self.item_tower_outputs()[item_ids]).sum(dim=1)
+
     def predict(self, interaction):
-        return self.sigmoid(self.forward(interaction))
+        if self.training:
+            return self.sigmoid(self.forward(interaction))
+        return self.sigmoid(self._cached_score(interaction))
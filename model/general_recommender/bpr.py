@@ -3,7 +3,7 @@ import torch.nn as nn
 
 from model.abstract_recommender import GeneralRecommender
 from model.init import xavier_normal_initialization
-from dataset.unified import get_pos_or_neg_shard
+from dataset.unified import add_bpr_triples
 
 
 class BPR(GeneralRecommender):
@@ -21,17 +21,22 @@ class BPR(GeneralRecommender):
         return user_e, item_e
 
     def calculate_loss(self, interaction):
-        pos_shard = get_pos_or_neg_shard(interaction, is_pos=True)
-        neg_shard = get_pos_or_neg_shard(interaction, is_pos=False)
-
-        pos_user_e, pos_item_e = self.forward(pos_shard)
-        neg_user_e, neg_item_e = self.forward(neg_shard)
-
-        less_size = min(pos_item_e.size(0) * 2, neg_item_e.size(0))
-        pos_item_score = torch.mul(pos_user_e, pos_item_e).sum(dim=1).repeat(2)[:less_size]  # 2：1负采样策略
-        neg_item_score = torch.mul(neg_user_e, neg_item_e).sum(dim=1)[:less_size]
-
-        # 注意BPRLoss需要两个输入形状相同
+        # (用户, 正样本, 负样本)三元组，负样本来自同一(住院, 天)；一般已由DFDataset.collect_bpr_fn配好
+        if "bpr_neg_item_id" not in interaction:
+            interaction = add_bpr_triples(interaction)
+        pos_items = interaction["bpr_pos_item_id"]
+
+        # 用户只算一次，正、负样本的物品一起算
+        user_e, item_e = self.forward({
+            self.USER_ID: interaction["bpr_user_id"],
+            self.ITEM_ID: torch.cat([pos_items, interaction["bpr_neg_item_id"]]),
+        })
+        pos_item_e, neg_item_e = torch.split(item_e, [pos_items.size(0), pos_items.size(0)])
+        pos_item_score = torch.mul(user_e, pos_item_e).sum(dim=1)
+        neg_item_score = torch.mul(user_e, neg_item_e).sum(dim=1)
+
+        if pos_items.size(0) == 0:  # 没有三元组（如batch中只有正样本）：loss为0，而不是空张量的均值NaN
+            return (pos_item_score - neg_item_score).sum()
         loss = self.loss(pos_item_score, neg_item_score)
         return loss
 
@@ -47,7 +47,7 @@ class NeuMF(GeneralRecommender):
         return output.squeeze(-1)
 
     def calculate_loss(self, interaction):
-        label = torch.from_numpy(interaction[self.LABEL].values).float().to(self.device)
+        label = interaction[self.LABEL].float().to(self.device)
         output = self.forward(interaction)
         return self.loss(output, label)
 
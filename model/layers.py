@@ -4,7 +4,9 @@ import torch.nn.functional as fn
 import math
 import numpy as np
 
-from torch_geometric.nn.conv import GINEConv, GENConv, GATConv
+from contextlib import contextmanager, nullcontext
+from torch.utils.checkpoint import checkpoint
+from torch_geometric.nn.conv import GINEConv, GENConv, GATConv, MessagePassing
 from utils.enum_type import FeatureSource, FeatureType
 from model.init import normal_
 from typing import List
@@ -61,6 +63,78 @@ class SingelGnn(nn.Module):
         return node_feats
 
 
+class CheckpointWrapper(nn.Module):
+    r"""Run `module` with activation checkpointing: its activations are dropped after forward and recomputed
+    in backward (only when grad is enabled, validation/testing runs the plain forward).
+
+    The recompute runs in train mode like the forward, so it yields the same activations, but it must not update
+    the buffers again (e.g. the running stats of the BatchNorm inside `GENConv`): all buffers of `module` are
+    restored after the recompute. The `state_dict` keys are those of `module`, without the `module.` prefix.
+    """
+    def __init__(self, module: nn.Module):
+        super().__init__()
+        self.module = module
+        self._register_state_dict_hook(self._strip_module_prefix)
+        self._register_load_state_dict_pre_hook(self._add_module_prefix)
+
+    def forward(self, *args, **kwargs):
+        if not torch.is_grad_enabled():
+            return self.module(*args, **kwargs)
+        return checkpoint(self.module, *args, use_reentrant=False, context_fn=self._checkpoint_contexts, **kwargs)
+
+    def _checkpoint_contexts(self):
+        return nullcontext(), self._restore_buffers()
+
+    @contextmanager
+    def _restore_buffers(self):
+        saved = [buf.clone() for buf in self.module.buffers()]
+        try:
+            yield
+        finally:
+            with torch.no_grad():
+                for buf, value in zip(self.module.buffers(), saved):
+                    buf.copy_(value)
+
+    @staticmethod
+    def _strip_module_prefix(module, state_dict, prefix, local_metadata):
+        for key in [key for key in state_dict if key.startswith(prefix + "module.")]:
+            state_dict[prefix + key[len(prefix + "module."):]] = state_dict.pop(key)
+
+    @staticmethod
+    def _add_module_prefix(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        for key in [key for key in state_dict if key.startswith(prefix) and not key.startswith(prefix + "module.")]:
+            state_dict[prefix + "module." + key[len(prefix):]] = state_dict.pop(key)
+
+
+def checkpoint_gnn_layers(gnn: nn.Module, layer_indices: List[int] = None):
+    r"""Enable activation checkpointing for the conv layers of a (hetero) `SingelGnn`.
+
+    `to_hetero` traces `SingelGnn` with torch.fx, so `torch.utils.checkpoint` can not be called inside its
+    forward. Instead, every per-edge-type conv of the chosen layers is replaced by a `CheckpointWrapper` of it,
+    the messages of these layers are then dropped after forward and recomputed in backward. The `state_dict`
+    stays the same as without checkpointing.
+
+    Args:
+        gnn: `SingelGnn` or the module returned by `to_hetero(SingelGnn(...))`
+        layer_indices: indices of the layers to checkpoint, default all layers
+    """
+    # to_hetero 之后，`gnn.layers` 的每一层变成了按边类型存放 conv 的子模块
+    layers = list(gnn.layers.named_children())
+    if layer_indices is None:
+        layer_indices = range(len(layers))
+
+    for idx in layer_indices:
+        assert 0 <= idx < len(layers), f"invalid gnn layer index: {idx}"
+        name, layer = layers[idx]
+        if isinstance(layer, MessagePassing):
+            setattr(gnn.layers, name, CheckpointWrapper(layer))
+            continue
+        for edge_name, conv in list(layer.named_children()):
+            setattr(layer, edge_name, CheckpointWrapper(conv))
+
+    return gnn
+
+
 class LinksPredictor(nn.Module):
     def __init__(self, hidden_dim=128, score_func="linear"):
         super().__init__()
@@ -81,6 +155,24 @@ class LinksPredictor(nn.Module):
         else:
             return torch.mul(a, b).sum(-1)
 
+    def project_items(self, item_features):
+        """物品侧的映射 `re_weight_b(item)`，对于 `mul` 打分可提前算好并缓存"""
+        assert self.score_func != "linear"
+        return self.re_weight_b(item_features)
+
+    def score_all(self, cur_day_patient_condition, item_projections):
+        """用一次矩阵乘法，给所有物品打分
+
+        Args:
+            cur_day_patient_condition: (h,) or (B, h)
+            item_projections: (N, h), returned by `project_items`
+
+        Returns:
+            scores: (N,) or (B, N)
+        """
+        a = self.re_weight_a(cur_day_patient_condition)
+        return torch.matmul(a, item_projections.transpose(0, 1))
+
 
 def get_decoder_by_choice(choice: str, hidden_dim: int, num_layers: int = 1):
     if choice == "TransformerDecoder":
@@ -347,6 +439,50 @@ class SequenceAttLayer(nn.Module):
 
         return output
 
+    def forward_grouped(self, queries, keys, keys_length, group_index):
+        r"""Same as `forward`, with the keys given once per group (e.g. the rows sharing a history).
+
+        The first layer of the attention MLP is linear in [q, k, q - k, q * k], so its key-only part
+        `k (W_k - W_{q-k})^T` is computed once per group and only `q * k` per row.
+
+        Args:
+            queries: [B, H]
+            keys: [G, T, H], keys of each group
+            keys_length: [G]
+            group_index: [B], group of each row
+        """
+        embedding_size = queries.shape[-1]  # H
+        first_linear = next(m for m in self.att_mlp_layers.mlp_layers if isinstance(m, nn.Linear))
+        assert self.att_mlp_layers.dropout == 0, "the grouped attention needs an MLP without input dropout"
+        w_q, w_k, w_diff, w_prod = first_linear.weight.split(embedding_size, dim=1)
+
+        query_part = fn.linear(queries, w_q + w_diff, first_linear.bias)  # [B, hidden]
+        key_part = fn.linear(keys, w_k - w_diff)  # [G, T, hidden]
+        keys_of_rows = keys[group_index]  # [B, T, H]
+        hidden = key_part[group_index] + query_part.unsqueeze(1) \
+            + fn.linear(queries.unsqueeze(1) * keys_of_rows, w_prod)
+
+        # 第一层之后的部分与forward相同
+        first_idx = list(self.att_mlp_layers.mlp_layers).index(first_linear)
+        output = self.att_mlp_layers.mlp_layers[first_idx + 1:](hidden)
+        output = torch.transpose(self.dense(output), -1, -2)
+
+        output = output.squeeze(1)
+        mask = self.mask_mat.repeat(output.size(0), 1)
+        mask = mask >= keys_length[group_index].unsqueeze(1)
+        mask_value = -np.inf if self.softmax_stag else 0.0
+        output = output.masked_fill(mask=mask, value=torch.tensor(mask_value))
+        output = output.unsqueeze(1)
+        output = output / (embedding_size**0.5)
+
+        if self.softmax_stag:
+            output = fn.softmax(output, dim=2)  # [B, 1, T]
+
+        if not self.return_seq_weight:
+            output = torch.matmul(output, keys_of_rows)  # [B, 1, H]
+
+        return output
+
 
 class FMEmbedding(nn.Module):
     r"""Embedding for token fields.
@@ -355,6 +491,7 @@ class FMEmbedding(nn.Module):
         field_dims: list, the number of tokens in each token fields
         offsets: list, the dimension offset of each token field
         embed_dim: int, the dimension of output embedding vectors
+        sparse: bool, whether the embedding table produces sparse gradients
 
     Input:
         input_x: tensor, A 2D tensor with shape:``(batch_size,field_size)``.
@@ -363,9 +500,9 @@ class FMEmbedding(nn.Module):
         output: tensor,  A 3D tensor with shape: ``(batch_size,field_size,embed_dim)``.
     """
 
-    def __init__(self, field_dims, offsets, embed_dim):
+    def __init__(self, field_dims, offsets, embed_dim, sparse=False):
         super(FMEmbedding, self).__init__()
-        self.embedding = nn.Embedding(sum(field_dims), embed_dim)
+        self.embedding = nn.Embedding(sum(field_dims), embed_dim, sparse=sparse)
         self.offsets = offsets
 
     def forward(self, input_x):
@@ -373,6 +510,10 @@ class FMEmbedding(nn.Module):
         output = self.embedding(input_x)
         return output
 
+    def embed_offset_applied(self, input_x):
+        """`input_x`中已加上各列的偏移（如`DFDataset`中堆叠好的`token_fields`），直接查表"""
+        return self.embedding(input_x)
+
 
 class BaseFactorizationMachine(nn.Module):
     r"""Calculate FM result over the embeddings
@@ -407,6 +548,7 @@ class BaseEmbeddingLayer(nn.Module):
         self.device = config["device"]
         self.embedding_size = config["embedding_size"]
         self.LABEL = config.get("LABEL_FIELD", "label")
+        self.sparse = config.get("sparse_embedding", False)  # embedding表是否产生稀疏梯度
 
         # 子类初始化完需要调用以下函数！
         # self._get_fields_names_dims(dataset)
@@ -449,7 +591,8 @@ class BaseEmbeddingLayer(nn.Module):
             self.user_token_embedding_table = FMEmbedding(
                 self.user_token_field_dims,
                 self.user_token_field_offsets,
-                self.embedding_size)
+                self.embedding_size,
+                self.sparse)
         if len(self.user_float_field_names) > 0:
             self.user_float_embedding_table = nn.Linear(len(self.user_float_field_names), self.embedding_size)
 
@@ -460,7 +603,8 @@ class BaseEmbeddingLayer(nn.Module):
             self.item_token_embedding_table = FMEmbedding(
                 self.item_token_field_dims,
                 self.item_token_field_offsets,
-                self.embedding_size)
+                self.embedding_size,
+                self.sparse)
         if len(self.item_float_field_names) > 0:
             self.item_float_embedding_table = nn.Linear(len(self.item_float_field_names), self.embedding_size)
 
@@ -526,7 +670,7 @@ class GeneralEmbeddingLayer(BaseEmbeddingLayer):
         self.ITEM_ID = config.get("ITEM_ID_FIELD", "item_id")
 
         self.n_items = dataset.num_items
-        self.item_id_embedding_table = nn.Embedding(self.n_items, self.embedding_size)
+        self.item_id_embedding_table = nn.Embedding(self.n_items, self.embedding_size, sparse=self.sparse)
 
         self.user_features = dataset.user_feat_values.to(self.device)
         self.item_features = dataset.item_feat_values.to(self.device)
@@ -535,8 +679,8 @@ class GeneralEmbeddingLayer(BaseEmbeddingLayer):
         self._get_embedding_tables()
 
     def forward(self, interaction):
-        users = torch.from_numpy(interaction[self.USER_ID].values).long().to(self.device)
-        items = torch.from_numpy(interaction[self.ITEM_ID].values).long().to(self.device)
+        users = interaction[self.USER_ID].long().to(self.device)
+        items = interaction[self.ITEM_ID].long().to(self.device)
 
         users_embedding = self._embed_user_feat_fields(users)
         items_embedding = self._embed_item_feat_fields(items)
@@ -583,6 +727,10 @@ class ContextEmbeddingLayer(BaseEmbeddingLayer):
                 else:
                     raise NotImplementedError
 
+        # DFDataset的batch中堆叠好的特征矩阵（token列已加上偏移）
+        self.TOKEN_FIELDS = config.get("TOKEN_FIELDS_FIELD", "token_fields")
+        self.FLOAT_FIELDS = config.get("FLOAT_FIELDS_FIELD", "float_fields")
+
         self._get_fields_names_dims(dataset)
         self._get_embedding_tables()
 
@@ -615,7 +763,7 @@ class ContextEmbeddingLayer(BaseEmbeddingLayer):
             self.token_field_offsets = np.array(
                 (0, *np.cumsum(self.token_field_dims)[:-1]), dtype=np.long)
             self.token_embedding_table = FMEmbedding(
-                self.token_field_dims, self.token_field_offsets, self.embedding_size)
+                self.token_field_dims, self.token_field_offsets, self.embedding_size, self.sparse)
 
         # float fields 过一层fc
         if len(self.float_field_names) > 0:
@@ -628,37 +776,39 @@ class ContextEmbeddingLayer(BaseEmbeddingLayer):
             torch.FloatTensor: The embedding tensor of token sequence columns.
             torch.FloatTensor: The embedding tensor of float sequence columns.
         """
+        float_fields, token_fields = self._stacked_input_fields(interaction)
 
-        # float fields
-        float_fields = []
-        for field_name in self.float_field_names:
-            cur_float_field_values = interaction[field_name].values
-            cur_float_field_tensor = torch.from_numpy(cur_float_field_values).unsqueeze(1)
-            float_fields.append(cur_float_field_tensor)
-        if len(float_fields) > 0:
-            float_fields = torch.cat(float_fields, dim=1).float().to(self.device)  # [batch_size, num_float_field]
-        else:
-            float_fields = None
         # float fields 过一层全连接层转换到self.embedding_size
         dense_embedding = self.embed_float_fields(float_fields)  # [batch_size, embed_dim] or None
         dense_embedding = dense_embedding.unsqueeze(1) if dense_embedding is not None else dense_embedding
 
-        # token fields
-        token_fields = []
-        for field_name in self.token_field_names:
-            cur_token_field_values = interaction[field_name].values
-            cur_token_field_tensor = torch.from_numpy(cur_token_field_values).unsqueeze(1)
-            token_fields.append(cur_token_field_tensor)
-        if len(token_fields) > 0:
-            token_fields = torch.cat(token_fields, dim=1).long().to(self.device)  # [batch_size, num_token_field]
-        else:
-            token_fields = None
+        # token fields 已加上偏移，查一次表
         sparse_embedding = self.embed_token_fields(token_fields)  # [batch_size, num_token_field, embed_dim] or None
 
         # sparse_embedding shape: [batch_size, num_token_field, embed_dim] or None
         # dense_embedding shape:  [batch_size, 1,               embed_dim] or None
         return sparse_embedding, dense_embedding
 
+    def _stacked_input_fields(self, interaction):
+        """float特征[batch_size, num_float_field]、token特征[batch_size, num_token_field]（已加上偏移），没有则为None"""
+        if len(self.float_field_names) == 0:
+            float_fields = None
+        elif self.FLOAT_FIELDS in interaction:
+            float_fields = interaction[self.FLOAT_FIELDS].float().to(self.device)
+        else:  # 逐列的特征，如逐行取出再拼成的batch
+            float_fields = torch.stack([interaction[field_name] for field_name in self.float_field_names], dim=1)
+            float_fields = float_fields.float().to(self.device)
+
+        if len(self.token_field_names) == 0:
+            token_fields = None
+        elif self.TOKEN_FIELDS in interaction:
+            token_fields = interaction[self.TOKEN_FIELDS].long().to(self.device)
+        else:
+            token_fields = torch.stack([interaction[field_name] for field_name in self.token_field_names], dim=1)
+            token_fields = token_fields.long().to(self.device)
+            token_fields = token_fields + token_fields.new_tensor(self.token_field_offsets).unsqueeze(0)
+        return float_fields, token_fields
+
     def embed_float_fields(self, float_fields: torch.FloatTensor):
         if float_fields is None:
             return None
@@ -666,9 +816,10 @@ class ContextEmbeddingLayer(BaseEmbeddingLayer):
         return float_embedding
 
     def embed_token_fields(self, token_fields: torch.LongTensor):
+        """`token_fields`中已加上各列的偏移"""
         if token_fields is None:
             return None
-        token_embedding = self.token_embedding_table(token_fields)
+        token_embedding = self.token_embedding_table.embed_offset_applied(token_fields)
         return token_embedding
 
     def double_tower_embed_input_fields(self, interaction):
@@ -703,6 +854,16 @@ class ContextEmbeddingLayer(BaseEmbeddingLayer):
             second_dense_embedding,
         )
 
+    def embed_user_tower_fields(self, interaction):
+        """双塔中只取用户塔的输入（如物品塔的输出已缓存时），与`double_tower_embed_input_fields`的前两项相同"""
+        assert self.double_tower
+        _, token_fields = self._stacked_input_fields(interaction)
+        if token_fields is not None and self.user_token_field_num > 0:
+            first_sparse_embedding = self.embed_token_fields(token_fields[:, :self.user_token_field_num])
+        else:
+            first_sparse_embedding = None
+        return first_sparse_embedding, None  # mimic-iii 中，user特征列没有float类型
+
     def concat_embed_input_fields(self, interaction):
         sparse_embedding, dense_embedding = self.embed_input_fields(interaction)
         all_embeddings = []
@@ -724,12 +885,13 @@ class SequentialEmbeddingLayer(BaseEmbeddingLayer):
         self.ITEM_ID = config.get("ITEM_ID_FIELD", "item_id")
         self.ITEM_SEQ = config.get("HISTORY_ITEM_ID_FIELD", "history")
         self.ITEM_SEQ_LEN = config.get("HISTORY_ITEM_ID_LIST_LENGTH_FIELD", "history_len")
+        self.HISTORY_ID = config.get("HISTORY_ID_FIELD", "history_id")
         self.max_seq_length = config.get("MAX_HISTORY_ITEM_ID_LIST_LENGTH", 100)
 
         self.n_items = dataset.num_items  # 获取有多少个候选物品
         self.item_padding_idx = self.n_items  # 约定padding_idx
         self.item_id_embedding_table = nn.Embedding(
-            self.n_items + 1, self.embedding_size, padding_idx=self.item_padding_idx)
+            self.n_items + 1, self.embedding_size, padding_idx=self.item_padding_idx, sparse=self.sparse)
 
         self.user_features = dataset.user_feat_values.to(self.device)
         self.item_features = dataset.item_feat_values.to(self.device)
@@ -737,59 +899,91 @@ class SequentialEmbeddingLayer(BaseEmbeddingLayer):
         self._get_fields_names_dims(dataset)
         self._get_embedding_tables()
 
-    def embed_input_fields(self, user_id, next_item_item_seq):
+    def embed_input_fields(self, user_id, item_seq_ids, item_seq_len):
+        r"""
+        Args:
+            user_id: [B]
+            item_seq_ids: [B, 1 + max_seq_length], the target item followed by the history items,
+                padded with `item_padding_idx`
+            item_seq_len: [B], number of valid ids in `item_seq_ids` (target included)
+        """
         user_embedding = self._embed_user_feat_fields(user_id)
 
-        item_seqs_embedding = []
-        for ids in next_item_item_seq:
-            # L: 当前的item历史序列长度
-            L = ids.size(0)
-            if L >= self.max_seq_length + 1:  # 过长则截断
-                ids = ids[:(self.max_seq_length + 1)]
-                valid_ids_feature_embedding = self._embed_item_feat_fields(ids)
-            else:  # 过短则填充padding_idx
-                # 先获取长度内的有效id的特征emb
-                valid_ids_feature_embedding = self._embed_item_feat_fields(ids)
-
-                # 然后填充pad的部分，再和id_embedding相加
-                pad_size = (0, 0,
-                            0, 0,
-                            0, self.max_seq_length + 1 - L)
-                valid_ids_feature_embedding = fn.pad(valid_ids_feature_embedding, pad_size, value=0)
-                ids = torch.cat([ids,
-                                 torch.tensor([self.item_padding_idx] * (self.max_seq_length + 1 - L), device=self.device)])
-
-            ids_embedding = self.item_id_embedding_table(ids).unsqueeze(1)
-
-            item_seqs_embedding.append(torch.cat(
-                [valid_ids_feature_embedding, ids_embedding], dim=1).flatten(start_dim=1))
-
         # num_item_float_field == 0: [B, 1 + max_seq_length, (num_item_token_field + 1) * h]
         # num_item_float_field  > 0: [B, 1 + max_seq_length, (num_item_token_field + 2) * h]
-        item_seqs_embedding = torch.stack(item_seqs_embedding)
+        item_seqs_embedding = self._embed_item_seqs(item_seq_ids, item_seq_len)
 
         return user_embedding, item_seqs_embedding
 
+    def _embed_item_seqs(self, item_seq_ids, item_seq_len):
+        """[N, S]的物品id（有效长度item_seq_len，其后为padding_idx） -> [N, S, (特征列数 + 1) * h]"""
+        N, S = item_seq_ids.shape
+        mask = torch.arange(S, device=self.device).unsqueeze(0) < item_seq_len.unsqueeze(1)  # [N, S]
+
+        # 只对有效id取特征emb（一次gather），填充的位置为0
+        valid_ids_feature_embedding = self._embed_item_feat_fields(item_seq_ids[mask])  # [N_valid, F, h]
+        ids_feature_embedding = valid_ids_feature_embedding.new_zeros(N, S, *valid_ids_feature_embedding.shape[1:])
+        ids_feature_embedding[mask] = valid_ids_feature_embedding
+
+        ids_embedding = self.item_id_embedding_table(item_seq_ids).unsqueeze(2)  # padding_idx的emb为0
+
+        return torch.cat([ids_feature_embedding, ids_embedding], dim=2).flatten(start_dim=2)
+
+    def _pad_histories(self, histories, histories_len):
+        """截断或填充到max_seq_length，无效的位置填padding_idx"""
+        histories = histories[:, :self.max_seq_length]
+        histories = fn.pad(histories, (0, self.max_seq_length - histories.size(1)), value=self.item_padding_idx)
+        histories_len = torch.clamp(histories_len, max=self.max_seq_length)
+        histories = histories.masked_fill(
+            torch.arange(self.max_seq_length, device=self.device).unsqueeze(0) >= histories_len.unsqueeze(1),
+            self.item_padding_idx)
+        return histories, histories_len
+
     def forward(self, interaction):
-        user_id      = torch.from_numpy(interaction[self.USER_ID     ].values).to(self.device)
-        item_seq_len = torch.from_numpy(interaction[self.ITEM_SEQ_LEN].values).to(self.device)
-        item_seq     = interaction[self.ITEM_SEQ].values
-        next_items   = interaction[self.ITEM_ID ].values
-
-        collector_next_item_item_seq: List[torch.tensor] = []
-        for history_items, next_item in zip(item_seq, next_items):
-            # concatenate the history item seq with the target item to get embedding together
-            # 注意：这里将target item放在第一个位置，方便后续split
-            item_seq_next_item = torch.tensor([next_item] + history_items, device=self.device)
-            collector_next_item_item_seq.append(item_seq_next_item)
-
-        user_embedding, item_seqs_embedding = self.embed_input_fields(user_id, collector_next_item_item_seq)
+        user_id      = interaction[self.USER_ID     ].long().to(self.device)
+        item_seq_len = interaction[self.ITEM_SEQ_LEN].long().to(self.device)
+        history_id   = interaction[self.HISTORY_ID  ].long().to(self.device)
+        next_items   = interaction[self.ITEM_ID     ].long().to(self.device)
+        # batch中去重后的历史序列[H, 最长的历史长度]（已填充），按history_id取出每行的
+        item_seq     = interaction[self.ITEM_SEQ    ].long().to(self.device)[history_id]
+        item_seq, item_seq_len = self._pad_histories(item_seq, item_seq_len)
+
+        # concatenate the history item seq with the target item to get embedding together
+        # 注意：这里将target item放在第一个位置，方便后续split
+        item_seq_ids = torch.cat([next_items.unsqueeze(1), item_seq], dim=1)  # [B, 1 + max_seq_length]
+
+        user_embedding, item_seqs_embedding = self.embed_input_fields(user_id, item_seq_ids, item_seq_len + 1)
         return user_embedding, item_seqs_embedding
 
+    def forward_grouped(self, interaction):
+        r"""Like `forward`, but each distinct history of the batch (one per admission-day) is embedded once.
+
+        Returns:
+            user_embedding: [B, ...]
+            target_item_embedding: [B, (num_item_feature + 1) * h]
+            history_embedding: [H, max_seq_length, (num_item_feature + 1) * h], the H distinct histories
+            history_len: [H], clamped to max_seq_length
+            history_id: [B], index of each row's history in `history_embedding`
+        """
+        user_id      = interaction[self.USER_ID     ].long().to(self.device)
+        item_seq_len = interaction[self.ITEM_SEQ_LEN].long().to(self.device)
+        history_id   = interaction[self.HISTORY_ID  ].long().to(self.device)
+        next_items   = interaction[self.ITEM_ID     ].long().to(self.device)
+        histories    = interaction[self.ITEM_SEQ    ].long().to(self.device)
+
+        # 同一历史序列的各行长度相同
+        histories_len = item_seq_len.new_zeros(histories.size(0)).scatter_(0, history_id, item_seq_len)
+        histories, histories_len = self._pad_histories(histories, histories_len)
+
+        user_embedding = self._embed_user_feat_fields(user_id)
+        target_item_embedding = self._embed_item_seqs(next_items.unsqueeze(1), torch.ones_like(next_items)).squeeze(1)
+        history_embedding = self._embed_item_seqs(histories, histories_len)
+        return user_embedding, target_item_embedding, history_embedding, histories_len, history_id
+
 
 class GraphEmbeddingLayer(nn.Module):
     """异质图中，admission, lab item / drug等结点特征通用的embedding layer；边特征也可以复用"""
-    def __init__(self, embedding_size, token_field_dims, float_field_nums):
+    def __init__(self, embedding_size, token_field_dims, float_field_nums, sparse=False):
         super().__init__()
         self.embedding_size = embedding_size
         self.token_field_dims = token_field_dims
@@ -802,7 +996,8 @@ class GraphEmbeddingLayer(nn.Module):
             self.token_embedding_table = FMEmbedding(
                 self.token_field_dims,
                 self.token_field_offsets,
-                self.embedding_size
+                self.embedding_size,
+                sparse
             )
         if self.float_field_nums > 0:
             self.float_embedding_table = nn.Linear(self.float_field_nums, self.embedding_size)
@@ -59,15 +59,22 @@ class DIN(SequentialRecommender):
                 constant_(module.bias.data, 0)
 
     def forward(self, interaction):
-        user_embedding, item_seqs_embedding = self.embedding_layer(interaction)
-
-        target_item_feat_emb, history_item_feat_emd = torch.split(
-            item_seqs_embedding, [1, self.max_seq_length], dim=1)
-        target_item_feat_emb = target_item_feat_emb.squeeze(1)
-
-        # attention
-        item_seq_len = torch.from_numpy(interaction[self.ITEM_SEQ_LEN].values).to(self.device)
-        user_emb = self.attention(target_item_feat_emb, history_item_feat_emd, item_seq_len)
+        if self.group_history:
+            # 历史序列的emb及注意力中只与历史有关的部分，每个不同的历史序列只算一次
+            user_embedding, target_item_feat_emb, history_item_feat_emd, item_seq_len, history_id = \
+                self.embedding_layer.forward_grouped(interaction)
+            user_emb = self.attention.forward_grouped(
+                target_item_feat_emb, history_item_feat_emd, item_seq_len, history_id)
+        else:
+            user_embedding, item_seqs_embedding = self.embedding_layer(interaction)
+
+            target_item_feat_emb, history_item_feat_emd = torch.split(
+                item_seqs_embedding, [1, self.max_seq_length], dim=1)
+            target_item_feat_emb = target_item_feat_emb.squeeze(1)
+
+            # attention
+            item_seq_len = interaction[self.ITEM_SEQ_LEN].long().to(self.device)
+            user_emb = self.attention(target_item_feat_emb, history_item_feat_emd, item_seq_len)
         user_emb = user_emb.squeeze(1)
 
         # input the DNN to get the prediction score
@@ -80,8 +87,7 @@ class DIN(SequentialRecommender):
         return preds.squeeze(1)
 
     def calculate_loss(self, interaction):
-        label = torch.from_numpy(interaction[self.LABEL_FIELD].values)\
-            .float().to(self.device)
+        label = interaction[self.LABEL_FIELD].float().to(self.device)
         output = self.forward(interaction)
         loss = self.loss(output, label)
         return loss
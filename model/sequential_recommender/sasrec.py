@@ -73,40 +73,55 @@ class SASRec(SequentialRecommender):
         if isinstance(module, nn.Linear) and module.bias is not None:
             module.bias.data.zero_()
 
-    def forward(self, interaction):
-        B = len(interaction)
+    def encode_histories(self, history_item_feat_emd, item_seq_len):
+        r"""
+        Args:
+            history_item_feat_emd: [N, max_seq_length, hidden_size]
+            item_seq_len: [N], clamped to max_seq_length
 
-        user_embedding, item_seqs_embedding = self.embedding_layer(interaction)
-        target_item_feat_emb, history_item_feat_emd = torch.split(
-            item_seqs_embedding, [1, self.max_seq_length], dim=1)
-        target_item_feat_emb = target_item_feat_emb.squeeze(1)  # [B, ?]
-
-        # 注意上面的这些_embedding的最后一维并不是self.hidden_size
-        user_embedding = self.ue_fc(user_embedding)
-        target_item_feat_emb = self.tgt_ie_fc(target_item_feat_emb)
-        history_item_feat_emd = self.hst_ie_fc(history_item_feat_emd)
+        Returns:
+            [N, hidden_size], the transformer output at the last valid position of each history
+        """
+        N = history_item_feat_emd.size(0)
 
         # position information
         position_ids = torch.arange(history_item_feat_emd.size(1), dtype=torch.long, device=self.device)
-        position_ids = position_ids.unsqueeze(0).expand(B, -1)
+        position_ids = position_ids.unsqueeze(0).expand(N, -1)
         position_embedding = self.position_embedding(position_ids)
 
         input_emb = history_item_feat_emd + position_embedding
         input_emb = self.LayerNorm(input_emb)
         input_emb = self.dropout(input_emb)
 
-        item_seq_len = torch.from_numpy(interaction[self.ITEM_SEQ_LEN].values)
-        item_seq_len = torch.clamp(item_seq_len, max=self.max_seq_length).to(self.device)
-
-        padding_mask = self.mask_mat.repeat(B, 1)
+        padding_mask = self.mask_mat.repeat(N, 1)
         padding_mask = padding_mask >= item_seq_len.unsqueeze(1)  # padding mask
         subsequent_mask = nn.Transformer.generate_square_subsequent_mask(self.max_seq_length).to(self.device)
 
-        # [B, max_seq_length, h]
+        # [N, max_seq_length, h]
         trm_output = self.trm_encoder(input_emb, mask=subsequent_mask, src_key_padding_mask=padding_mask)
 
         # 从自注意完的历史item列表emb收集最后一个（有效序列长度-1）
-        trm_output = self.gather_indexes(trm_output, item_seq_len - 1)  # [B, H]
+        return self.gather_indexes(trm_output, item_seq_len - 1)  # [N, H]
+
+    def forward(self, interaction):
+        if self.group_history:
+            # 每个不同的历史序列只过一次transformer，再按history_id广播到各行
+            user_embedding, target_item_feat_emb, history_item_feat_emd, item_seq_len, history_id = \
+                self.embedding_layer.forward_grouped(interaction)
+            trm_output = self.encode_histories(self.hst_ie_fc(history_item_feat_emd), item_seq_len)[history_id]
+        else:
+            user_embedding, item_seqs_embedding = self.embedding_layer(interaction)
+            target_item_feat_emb, history_item_feat_emd = torch.split(
+                item_seqs_embedding, [1, self.max_seq_length], dim=1)
+            target_item_feat_emb = target_item_feat_emb.squeeze(1)  # [B, ?]
+
+            item_seq_len = interaction[self.ITEM_SEQ_LEN].long()
+            item_seq_len = torch.clamp(item_seq_len, max=self.max_seq_length).to(self.device)
+            trm_output = self.encode_histories(self.hst_ie_fc(history_item_feat_emd), item_seq_len)  # [B, H]
+
+        # 注意上面的这些_embedding的最后一维并不是self.hidden_size
+        user_embedding = self.ue_fc(user_embedding)
+        target_item_feat_emb = self.tgt_ie_fc(target_item_feat_emb)
 
         scores = self.dnn_predict_layers(
             torch.cat([trm_output, target_item_feat_emb, user_embedding], dim=-1))
@@ -114,8 +129,7 @@ class SASRec(SequentialRecommender):
         return scores.squeeze(1)
 
     def calculate_loss(self, interaction):
-        label = torch.from_numpy(interaction[self.LABEL_FIELD].values)\
-            .float().to(self.device)
+        label = interaction[self.LABEL_FIELD].float().to(self.device)
         output = self.forward(interaction)
         loss = self.loss_fct(output, label)
         return loss
@@ -1,21 +1,52 @@
 import argparse
 import os
+import time
 import pandas as pd
 import torch
 import utils.constant as constant
 
+from contextlib import nullcontext
 from d2l import torch as d2l
 from typing import List
 from tqdm import tqdm
+from torch.nn.parallel import DistributedDataParallel
 
 from dataset.unified import SourceDataFrames, OneAdmOneHG
+from dataset.cost_model import compute_admission_costs, SlowSampleTracker
 from model.backbone import BackBoneV2
-from utils.misc import get_latest_model_ckpt, EarlyStopper, init_seed
-from utils.config import HeteroGraphConfig, GNNConfig
-from utils.metrics import convert2df, save_results
+from utils.misc import get_latest_model_ckpt, EarlyStopper, init_seed, reset_peak_rss, get_peak_rss_mb, append_to_csv
+from utils.config import HeteroGraphConfig, GNNConfig, max_adm_length
+from utils.metrics import convert2df, save_results, recall_at_k
+from utils.optim import get_optimizer, clip_grad_norm_
+from utils.async_valid import AsyncValidator
+from utils.profiler import profiler, build_torch_profiler
+from utils.run_log import ThroughputMeter
+from utils.asha import TrialReporter
+from utils.checkpoint import (CheckpointWriter, get_rng_states, set_rng_states,
+                              get_resume_ckpt_path, load_resume_ckpt)
+from utils.distributed import (init_distributed, cleanup_distributed, is_main_process, shard_list,
+                               cost_balanced_shard, all_reduce_sum, all_reduce_bn_buffers, broadcast_bool, barrier)
 
 
-if __name__ == '__main__':
+def validate(model, valid_dataset, device, train_loop=None, desc=""):
+    """在验证集（分布式训练时为本rank的分片）上计算loss，返回 (loss之和, 住院数)"""
+    model.eval()
+    valid_metric = d2l.Accumulator(2)
+    with torch.no_grad(), profiler.region("validate"):
+        for hg in valid_dataset:
+            hg = hg.to(device)
+            logits, labels = model(hg)
+            validloss = BackBoneV2.get_loss(logits, labels)
+            valid_metric.add(validloss.item(), 1)
+
+            if train_loop is not None:
+                train_loop.set_description_str(desc)
+                train_loop.set_postfix_str(f'loss:{validloss.item():.3f}, avg:{valid_metric[0] / valid_metric[1]:.3f}')
+    model.train()  # 验证完了，返回训练模式
+    return valid_metric[0], valid_metric[1]
+
+
+def build_parser():
     parser = argparse.ArgumentParser()
 
     # following arguments are model settings
@@ -25,6 +56,18 @@ if __name__ == '__main__':
     parser.add_argument("--hidden_dim", type=int, default=256)
     parser.add_argument("--embedding_size", type=int, default=10)
     parser.add_argument("--lr", type=float, default=0.001)
+    parser.add_argument("--gnn_checkpoint", action="store_true", default=False,
+                        help="recompute activations of GNN layers in backward to save memory")
+    parser.add_argument("--gnn_checkpoint_layers", type=int, nargs="+", default=None,
+                        help="indices of GNN layers to checkpoint, default all layers")
+    parser.add_argument("--sparse_embedding", action="store_true", default=False,
+                        help="build embedding tables with sparse gradients, optimized by lazy adam")
+    parser.add_argument("--attention_window", type=int, default=None,
+                        help="only attend to the conditions of the last W days, default all previous days")
+    parser.add_argument("--attention_summary", action="store_true", default=False,
+                        help="add a summary token (mean) of the days older than the attention window")
+    parser.add_argument("--max_adm_length", type=int, default=max_adm_length,
+                        help="max number of days of an admission used by the model")
 
     parser.add_argument("--root_path_dataset", default=constant.PATH_MIMIC_III_ETL_OUTPUT,
                         help="path where dataset directory locates")  # in linux
@@ -36,6 +79,13 @@ if __name__ == '__main__':
     parser.add_argument("--reproducibility", action="store_true", default=False)
     parser.add_argument("--init_method", default="xavier_normal")
     parser.add_argument("--use_gpu", action="store_true", default=False)
+    parser.add_argument("--distributed", action="store_true", default=False,
+                        help="CPU data-parallel training with gloo backend, launched by torchrun")
+    parser.add_argument("--num_threads", type=int, default=None,
+                        help="torch intra-op threads per process, default: cpu cores / number of processes")
+    parser.add_argument("--shard_by_cost", action="store_true", default=False,
+                        help="in distributed mode, shard the training admissions by their predicted cost, "
+                             "so that the ranks train admissions of similar costs at the same step")
 
     parser.add_argument("--item_type", default="MIX")
     parser.add_argument("--goal", default="drug", help="the goal of the recommended task, in ['drug', 'labitem']")
@@ -45,18 +95,78 @@ if __name__ == '__main__':
     parser.add_argument("--epochs", type=int, default=10)
     parser.add_argument("--patience", type=int, default=5)
     parser.add_argument("--accumulation_steps", type=int, default=16)
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="resume the training from the latest resumable checkpoint in path_dir_model_hub")
+    parser.add_argument("--resume_ckpt_interval", type=int, default=200,
+                        help="save a resumable checkpoint every N optimizer steps, 0 to disable")
+    parser.add_argument("--run_tag", default=None,
+                        help="tag of the resumable checkpoint and profile files, to tell apart the runs sharing "
+                             "path_dir_model_hub / path_dir_results at the same time (e.g. trials of run_sweep.py)")
+    parser.add_argument("--async_valid", action="store_true", default=False,
+                        help="validate weight snapshots in a background process while training goes on")
+    parser.add_argument("--async_valid_policy", default="latest", choices=AsyncValidator.policies,
+                        help="what to do when the validation lags behind the training, see AsyncValidator")
+    parser.add_argument("--async_valid_threads", type=int, default=None,
+                        help="torch threads of the async validation process, defaults to half of the threads")
+    parser.add_argument("--log_peak_rss_min_days", type=int, default=None,
+                        help="log the peak RSS of training admissions whose length >= this value to peak_rss.csv")
+    parser.add_argument("--slow_sample_top_n", type=int, default=None,
+                        help="track the training time of each admission, save the N slowest ones with their "
+                             "predicted costs to slow_admissions.csv, and calibrate the cost model")
 
     parser.add_argument("--test", action="store_true", default=False)
     parser.add_argument("--model_ckpt", default=None, help="the .pt filename where stores the state_dict of model")
+    parser.add_argument("--retrieval_topk", type=int, default=None,
+                        help="also run top-k retrieval over the full goal vocabulary when testing, "
+                             "and measure the recall of the approximate retrieval against the exact one")
+    parser.add_argument("--retrieval_chunk_size", type=int, default=1024)
+
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="time the named stages, export a Chrome trace and a summary table to path_dir_results")
+    parser.add_argument("--profile_torch_steps", type=int, default=None,
+                        help="with --profile, also run torch.profiler for this many training steps")
+    parser.add_argument("--profile_torch_wait", type=int, default=10,
+                        help="training steps to skip before torch.profiler starts recording")
 
     parser.add_argument("--notes", default=None, help="experiment description and running args")
 
-    args = parser.parse_args()
+    return parser
+
 
+def main(args, sources_dfs: SourceDataFrames = None, reporter: TrialReporter = None):
+    r"""Train and/or test `BackBoneV2` with the parsed `args`.
+
+    Args:
+        sources_dfs: an already loaded dataset (e.g. shared by the trials of `run_sweep.py`),
+            loaded from `args.root_path_dataset` if None
+        reporter: reports the validation losses to the ASHA scheduler of `run_sweep.py`; when the trial reaches
+            its budget, a resumable checkpoint is saved and the run pauses (no model saving, no test)
+    """
     init_seed(args.seed, args.reproducibility)
 
+    rank, world_size = 0, 1
+    if args.distributed:
+        assert not args.use_gpu, "distributed mode is for CPU training with gloo backend"
+        rank, world_size = init_distributed("gloo")
+        if args.num_threads is None:
+            args.num_threads = max(1, os.cpu_count() // world_size)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    if reporter is not None:
+        assert not args.distributed and not args.async_valid, "ASHA trials validate synchronously on a single process"
+    if args.async_valid:
+        assert not args.distributed, "async validation does not support distributed mode"
+        assert not args.use_gpu, "async validation forks a CPU worker process, which does not work with CUDA"
+
+    if args.profile:
+        profiler.enable()
+        profile_prefix = f"{time.strftime('%Y%m%d_%H%M%S', time.localtime())}_backbone_rank{rank}"
+        if args.run_tag is not None:
+            profile_prefix += f"_{args.run_tag}"
+
     device = torch.device('cuda') if args.use_gpu else torch.device('cpu')
-    sources_dfs = SourceDataFrames(args.root_path_dataset)
+    if sources_dfs is None:
+        sources_dfs = SourceDataFrames(args.root_path_dataset)
 
     if args.item_type == "MIX":
         node_types, edge_types = HeteroGraphConfig.use_all_edge_type()
@@ -65,68 +175,246 @@ if __name__ == '__main__':
     gnn_conf = GNNConfig(args.gnn_type, args.gnn_layer_num, node_types, edge_types)
     model = BackBoneV2(sources_dfs, args.goal, args.hidden_dim, gnn_conf, device,
                        args.num_encoder_layers, args.embedding_size, args.is_gnn_only,
-                       init_method=args.init_method,).to(device)
+                       init_method=args.init_method,
+                       gnn_checkpoint=args.gnn_checkpoint,
+                       gnn_checkpoint_layers=args.gnn_checkpoint_layers,
+                       sparse_embedding=args.sparse_embedding,
+                       attention_window=args.attention_window,
+                       attention_summary=args.attention_summary,
+                       max_adm_length=args.max_adm_length).to(device)
 
     os.makedirs(args.path_dir_model_hub, exist_ok=True)
     os.makedirs(args.path_dir_results, exist_ok=True)
 
+    paused = False  # ASHA试验达到预算后暂停
     if args.train:
         train_dataset = OneAdmOneHG(sources_dfs, "train")  # 因为空间占用问题（>200G），训练集不用HGDataset
         valid_dataset = OneAdmOneHG(sources_dfs, "val")
 
-        optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr)
+        admission_costs = None
+        if args.slow_sample_top_n is not None or (args.distributed and args.shard_by_cost):
+            admission_costs = compute_admission_costs(sources_dfs, args.goal, gnn_conf,
+                                                      args.attention_window, args.attention_summary,
+                                                      args.max_adm_length, admissions=train_dataset.admissions)
+        slow_sample_tracker = SlowSampleTracker(args.slow_sample_top_n) if args.slow_sample_top_n is not None else None
+
+        train_model = model
+        if args.distributed:
+            # 训练集按rank切分（补齐到相同长度），验证集不补齐，loss跨rank求和后再平均
+            if args.shard_by_cost:
+                train_dataset.admissions = cost_balanced_shard(
+                    train_dataset.admissions, admission_costs.loc[train_dataset.admissions, "cost"].tolist(),
+                    rank, world_size, seed=args.seed)
+            else:
+                train_dataset.admissions = shard_list(train_dataset.admissions, rank, world_size, pad=True)
+            valid_dataset.admissions = shard_list(valid_dataset.admissions, rank, world_size, pad=False)
+            # 构造时从rank 0广播参数；不同的种子让各rank的负采样不同
+            # 不在每次前向时广播BN的缓冲区（no_sync()中也会广播），改为在优化器更新时对各rank取平均
+            train_model = DistributedDataParallel(model, find_unused_parameters=True, broadcast_buffers=False)
+            init_seed(args.seed + rank, args.reproducibility)
+
+        optimizer = get_optimizer(model, args.lr, args.sparse_embedding)
         scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(
             optimizer=optimizer, T_max=args.epochs*(len(train_dataset)//args.accumulation_steps + 1), eta_min=0.001*args.lr)
         early_stopper = EarlyStopper(args.patience, False)
+        peak_rss_records = []
+
+        resume_ckpt_name = f"{model.__class__.__name__}_goal_{args.goal}"
+        if args.run_tag is not None:
+            resume_ckpt_name += f"_{args.run_tag}"
+        resume_ckpt_path = get_resume_ckpt_path(args.path_dir_model_hub, resume_ckpt_name, rank)
+        start_epoch, start_index = 0, 0
+        resumed_train_metric = None
+        if args.resume and os.path.exists(resume_ckpt_path):
+            ckpt = load_resume_ckpt(resume_ckpt_path)
+            model.load_state_dict(ckpt["model"])
+            optimizer.load_state_dict(ckpt["optimizer"])
+            scheduler.load_state_dict(ckpt["scheduler"])
+            early_stopper.load_state_dict(ckpt["early_stopper"])
+            start_epoch, start_index = ckpt["epoch"], ckpt["next_index"]
+            resumed_train_metric = ckpt["train_metric"]
+            set_rng_states(ckpt["rng_states"])  # 最后恢复，之前的操作不会再消耗随机数
+            print(f"resume training from epoch {start_epoch}, admission #{start_index}")
+        elif args.resume:
+            print(f"no resumable checkpoint found at {resume_ckpt_path}, training from scratch")
+        ckpt_writer = CheckpointWriter() if args.resume_ckpt_interval > 0 or reporter is not None else None
+        pause_requested = False
+
+        meter = ThroughputMeter(args.path_dir_results, "run_backbone", {
+            "model": model.__class__.__name__,
+            "goal": args.goal,
+            "gnn_type": args.gnn_type,
+            "hidden_dim": args.hidden_dim,
+            "attention_window": args.attention_window,
+            "attention_summary": args.attention_summary,
+            "max_adm_length": args.max_adm_length,
+            "world_size": world_size,
+            "notes": args.notes,
+        }, enabled=is_main_process())
+
+        torch_prof = None
+        if args.profile and args.profile_torch_steps is not None:
+            torch_prof = build_torch_profiler(args.path_dir_results, profile_prefix,
+                                              args.profile_torch_wait, args.profile_torch_steps)
+            torch_prof.start()
 
-        for epoch in range(args.epochs):
+        async_validator = None
+        if args.async_valid:  # 在训练开始前fork验证进程，验证集和模型直接被子进程继承
+            async_validator = AsyncValidator(
+                model, lambda m: (lambda loss_sum, num: loss_sum / num)(*validate(m, valid_dataset, device)),
+                policy=args.async_valid_policy,
+                num_threads=args.async_valid_threads or max(1, torch.get_num_threads() // 2))
+
+        for epoch in range(start_epoch, args.epochs):
             if args.use_gpu:
                 torch.cuda.empty_cache()
 
             # TRAIN STAGE
             train_metric = d2l.Accumulator(2)  # train loss, iter num
+            first_index = 0
+            if epoch == start_epoch and resumed_train_metric is not None:  # 从中断的位置继续
+                train_metric.data = list(resumed_train_metric)
+                first_index = start_index
             model.train()
-            train_loop = tqdm(enumerate(train_dataset), ncols=80, leave=False, total=len(train_dataset), ascii=True)
-            for i, hg in train_loop:
-                hg = hg.to(device)
-                logits, labels = model(hg)
-                loss = BackBoneV2.get_loss(logits, labels)
-                train_metric.add(loss.detach().item(), 1)
+            train_loop = tqdm(range(first_index, len(train_dataset)), ncols=80, leave=False, total=len(train_dataset),
+                              initial=first_index, ascii=True, disable=not is_main_process())
+            for i in train_loop:
+                load_start = time.perf_counter()
+                hg = train_dataset[i]
+                meter.data_ready()
+                compute_start = time.perf_counter()
+                num_edges = sum(hg[edge_type].edge_index.size(1) for edge_type in hg.edge_types)
+                if args.log_peak_rss_min_days is not None:
+                    adm_len = OneAdmOneHG.get_adm_length(hg)
+                    is_long_adm = adm_len >= args.log_peak_rss_min_days
+                    if is_long_adm:
+                        reset_peak_rss()
+
+                is_step = (i+1) % args.accumulation_steps == 0 or (i+1) == len(train_dataset)
+                # 分布式训练时，只在梯度累计的边界处同步梯度
+                sync_context = train_model.no_sync() if (args.distributed and not is_step) else nullcontext()
+                with sync_context:
+                    hg = hg.to(device)
+                    with profiler.region("forward"):
+                        logits, labels = train_model(hg)
+                    with profiler.region("loss"):
+                        loss = BackBoneV2.get_loss(logits, labels)
+                    train_metric.add(loss.detach().item(), 1)
+
+                    train_loop.set_description_str(f"E#{epoch:02}TRN")
+                    train_loop.set_postfix_str(f'loss:{loss.detach().item():.3f}, avg:{train_metric[0] / train_metric[1]:.3f}')
 
-                train_loop.set_description_str(f"E#{epoch:02}TRN")
-                train_loop.set_postfix_str(f'loss:{loss.detach().item():.3f}, avg:{train_metric[0] / train_metric[1]:.3f}')
+                    loss = loss / args.accumulation_steps
+                    with profiler.region("backward"):
+                        loss.backward()  # 累加梯度
+                if slow_sample_tracker is not None:  # 只计入本住院的构图和前向+反向，不含优化器更新和验证
+                    slow_sample_tracker.record(train_dataset.admissions[i], load_s=compute_start - load_start,
+                                               compute_s=time.perf_counter() - compute_start)
 
-                loss = loss / args.accumulation_steps
-                loss.backward()  # 累加梯度
-                if (i+1) % args.accumulation_steps == 0 or (i+1) == len(train_dataset):
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-                    optimizer.step()  # 注意：使用梯度累计时，学习率要适当放大
-                    scheduler.step()
-                    optimizer.zero_grad()
+                if args.log_peak_rss_min_days is not None and is_long_adm:  # 前向+反向过程中的峰值内存
+                    peak_rss_records.append({
+                        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
+                        "hadm_id": train_dataset.admissions[i],
+                        "adm_len": adm_len,
+                        "peak_rss_mb": get_peak_rss_mb(),
+                        "hidden_dim": args.hidden_dim,
+                        "gnn_type": args.gnn_type,
+                        "gnn_layer_num": args.gnn_layer_num,
+                        "gnn_checkpoint": args.gnn_checkpoint,
+                        "gnn_checkpoint_layers": str(args.gnn_checkpoint_layers),
+                        "notes": args.notes,
+                    })
+                if is_step:
+                    with profiler.region("optimizer_step"):
+                        clip_grad_norm_(model.parameters(), max_norm=1.0)
+                        optimizer.step()  # 注意：使用梯度累计时，学习率要适当放大
+                        scheduler.step()
+                        optimizer.zero_grad()
+                        if args.distributed:
+                            all_reduce_bn_buffers(model)
 
                 # VALID STAGE
-                if i > 0 and i % (len(train_dataset) // 10) == 0:  # 每遍历完训练集的10%
-                    model.eval()
-                    valid_metric = d2l.Accumulator(2)
-                    with torch.no_grad():
-                        for hg in valid_dataset:
-                            hg = hg.to(device)
-                            logits, labels = model(hg)
-                            validloss = BackBoneV2.get_loss(logits, labels)
-                            valid_metric.add(validloss.item(), 1)
-
-                            train_loop.set_description_str(f"E#{epoch:02}VLD")
-                            train_loop.set_postfix_str(f'loss:{validloss.item():.3f}, avg:{valid_metric[0] / valid_metric[1]:.3f}')
-
-                    early_stopper(score=valid_metric[0] / valid_metric[1], model=model)
-                    model.train()  # 验证完了，返回训练模式
-                if early_stopper.is_stop: break
-            if early_stopper.is_stop: break
+                is_valid = i > 0 and i % (len(train_dataset) // 10) == 0  # 每遍历完训练集的10%
+                valid_loss = None
+                if is_valid:
+                    with meter.validating():
+                        if async_validator is not None:
+                            async_validator.submit(model)
+                        else:
+                            valid_loss_sum, valid_num = all_reduce_sum(
+                                validate(model, valid_dataset, device, train_loop, f"E#{epoch:02}VLD"))
+                            valid_loss = valid_loss_sum / valid_num
+                            early_stopper(score=valid_loss, model=model)
+                            early_stopper.is_stop = broadcast_bool(early_stopper.is_stop)
+                            if reporter is not None and not reporter.report(early_stopper.best_score):
+                                pause_requested = True  # 达到预算，在下一个梯度累计的边界处暂停
+                is_ckpt = ckpt_writer is not None and is_step and (
+                    pause_requested or
+                    (args.resume_ckpt_interval > 0 and scheduler.last_epoch % args.resume_ckpt_interval == 0))
+                if async_validator is not None:  # 异步验证的结果对应的是提交时的权重快照
+                    # 保存检查点前等待所有快照验证完，检查点中不会丢失还在验证中的结果
+                    with meter.validating():
+                        for _, snapshot_loss, snapshot in (async_validator.drain() if is_ckpt else async_validator.poll()):
+                            early_stopper(score=snapshot_loss, model=model, state_dict=snapshot)
+                if is_ckpt:  # 只在梯度累计的边界处保存，此时没有累计到一半的梯度
+                    with profiler.region("save_checkpoint"):  # 只计入内存中的拷贝，写盘在后台线程
+                        ckpt_writer.save({
+                            "model": model.state_dict(),
+                            "optimizer": optimizer.state_dict(),
+                            "scheduler": scheduler.state_dict(),
+                            "early_stopper": early_stopper.state_dict(),
+                            "epoch": epoch,
+                            "next_index": i + 1,
+                            "train_metric": list(train_metric.data),
+                            "rng_states": get_rng_states(),
+                            "args": vars(args),
+                        }, resume_ckpt_path)
+                if torch_prof is not None:
+                    torch_prof.step()
+                meter.step_done(admissions=1, interactions=sum(label.numel() for label in labels), edges=num_edges)
+                if is_valid:
+                    meter.log_interval(epoch=epoch, iter=i, valid_loss=valid_loss,
+                                       best_valid_loss=early_stopper.best_score, lr=scheduler.get_last_lr()[0])
+                paused = pause_requested and is_step
+                if early_stopper.is_stop or paused: break
+            if early_stopper.is_stop or paused: break
+
+        if torch_prof is not None:
+            torch_prof.stop()
+
+        if async_validator is not None:  # 等待剩余的快照验证完，它们仍可能是最优的模型
+            for _, valid_loss, snapshot in async_validator.drain():
+                early_stopper(score=valid_loss, model=model, state_dict=snapshot)
+            async_validator.close()
+            print(f"async validation: {async_validator.num_validated} snapshots validated, "
+                  f"{async_validator.num_skipped} skipped")
+        meter.log_run(best_valid_loss=early_stopper.best_score, args=vars(args))
+        if ckpt_writer is not None:
+            ckpt_writer.close()
+            if os.path.exists(resume_ckpt_path) and not paused:  # 训练已完成，不再需要续训
+                os.remove(resume_ckpt_path)
+        if reporter is not None:
+            reporter.finish(paused)
 
         model_name = f"loss_{early_stopper.best_score:.4f}_{model.__class__.__name__}_goal_{args.goal}.pt"
-        early_stopper.save_checkpoint(args.path_dir_model_hub, model_name, args.notes)  # 保存valid_loss最低的模型参数检查点
+        if is_main_process() and not paused:
+            early_stopper.save_checkpoint(args.path_dir_model_hub, model_name, args.notes)  # 保存valid_loss最低的模型参数检查点
+        barrier()
+
+        if len(peak_rss_records) > 0 and is_main_process():  # 分布式训练时只记录rank 0
+            append_to_csv(os.path.join(args.path_dir_results, "peak_rss.csv"), peak_rss_records)
+
+        if slow_sample_tracker is not None and len(slow_sample_tracker) > 0 and is_main_process():
+            slow_admissions = slow_sample_tracker.report(admission_costs)
+            slow_admissions.insert(0, "timestamp", time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()))
+            slow_admissions["notes"] = args.notes
+            append_to_csv(os.path.join(args.path_dir_results, "slow_admissions.csv"), slow_admissions.to_dict("records"))
+            if len(slow_sample_tracker) >= 3:
+                (w_gnn, w_att), intercept, r2 = slow_sample_tracker.fit(admission_costs)
+                print(f"cost model: step_ms ≈ {w_gnn:.3e} * gnn_cost + {w_att:.3e} * attention_pairs "
+                      f"+ {intercept:.1f} (R^2={r2:.3f})")
 
-    if args.test:
+    if args.test and is_main_process() and not paused:
         test_dataset = OneAdmOneHG(sources_dfs, "test")
 
         if not args.train:
@@ -146,12 +434,39 @@ if __name__ == '__main__':
         model.eval()
         with torch.no_grad():
             collector: List[pd.DataFrame] = []
+            retrieval_recalls: List[float] = []
             for hg in tqdm(test_dataset, leave=False, ncols=80, total=len(test_dataset), ascii=True):
                 hg = hg.to(device)
-                logits, labels = model(hg)
+                hg_retrieval = hg.clone() if args.retrieval_topk is not None else None  # forward会原地修改特征
+                with profiler.region("forward"):
+                    logits, labels = model(hg)
 
                 # 把预测结果全部收集成DataFrame，后面再单独写notebook/脚本进行细致的指标计算
-                collector.append(convert2df(logits, labels))
+                with profiler.region("convert2df"):
+                    collector.append(convert2df(logits, labels))
+
+                if args.retrieval_topk is not None:
+                    with profiler.region("retrieve"):
+                        retrieved = model.retrieve(hg_retrieval, args.retrieval_topk, exact=True, approx=True,
+                                                   chunk_size=args.retrieval_chunk_size)
+                    for exact_items, approx_items in zip(retrieved["exact"][1], retrieved["approx"][1]):
+                        retrieval_recalls.append(recall_at_k(exact_items, approx_items))
+
+        extra_metrics = None
+        if len(retrieval_recalls) > 0:
+            approx_recall = sum(retrieval_recalls) / len(retrieval_recalls)
+            print(f"recall@{args.retrieval_topk} of approx. retrieval against exact retrieval: {approx_recall:.4f}")
+            extra_metrics = {f"approx_retrieval_recall@{args.retrieval_topk}": approx_recall}
 
         results: pd.DataFrame = pd.concat(collector, axis=0)
-        save_results(args.path_dir_results, results, ckpt_filename, args.notes)
+        save_results(args.path_dir_results, results, ckpt_filename, args.notes, extra_metrics)
+
+    if args.profile:
+        summary = profiler.export(args.path_dir_results, profile_prefix)
+        print(summary.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+
+    cleanup_distributed()
+
+
+if __name__ == '__main__':
+    main(build_parser().parse_args())
@@ -1,4 +1,6 @@
 import os
+import math
+import time
 import pandas as pd
 import argparse
 import torch
@@ -13,9 +15,18 @@ from dataset.unified import (SourceDataFrames,
                              SingleItemType,
                              SingleItemTypeForContextAwareRec,
                              SingleItemTypeForSequentialRec,
-                             DFDataset)
+                             DFDataset,
+                             NegSamplingDataset,
+                             interaction_to_dataframe)
 from utils.misc import get_latest_model_ckpt, EarlyStopper, init_seed
 from utils.metrics import save_results
+from utils.optim import get_optimizer
+from utils.async_valid import AsyncValidator
+from utils.profiler import profiler, build_torch_profiler
+from utils.run_log import ThroughputMeter
+from utils.asha import TrialReporter
+from utils.checkpoint import (CheckpointWriter, get_rng_states, set_rng_states,
+                              get_resume_ckpt_path, load_resume_ckpt)
 
 
 def get_model_and_dataset_class(model_name):
@@ -48,6 +59,7 @@ def prepare_corr_config(model_c, args) -> Dict:
         "hidden_size": args.hidden_size,
         "mlp_hidden_size": [args.hidden_size, args.hidden_size, args.hidden_size],
         "dropout_prob": args.dropout_prob,
+        "sparse_embedding": args.sparse_embedding,
 
         "LABEL_FIELD": "label",
         "USER_ID_FIELD": "user_id",
@@ -61,13 +73,36 @@ def prepare_corr_config(model_c, args) -> Dict:
             config["double_tower"] = True
     elif name_parent_c == "SequentialRecommender":
         config["MAX_HISTORY_ITEM_ID_LIST_LENGTH"] = args.max_seq_length
+        config["group_history"] = not args.ungrouped_history
     else:
         raise NotImplementedError
 
     return config
 
 
-if __name__ == '__main__':
+def has_loss_samples(interaction):
+    """BPR的batch可能配不出三元组（如只剩某天正样本的最后一个batch），这样的batch不参与训练和loss的统计"""
+    return "bpr_pos_item_id" not in interaction or len(interaction["bpr_pos_item_id"]) > 0
+
+
+@torch.no_grad()
+def validate(model, valid_dataloader, train_loop=None):
+    """在验证集上计算平均loss"""
+    valid_metric = d2l.Accumulator(2)
+    model.eval()
+    with profiler.region("validate"):
+        for val_interaction in valid_dataloader:
+            if not has_loss_samples(val_interaction):
+                continue
+            cur_loss = model.calculate_loss(val_interaction)
+            valid_metric.add(cur_loss.item(), 1)
+            if train_loop is not None:
+                train_loop.set_postfix_str(f'valid loss: {cur_loss.item():.4f}')
+    model.train()  # 退出时恢复下train模式
+    return valid_metric[0] / valid_metric[1]
+
+
+def build_parser():
     parser = argparse.ArgumentParser()
 
     parser.add_argument("--model_name", default=None)
@@ -85,83 +120,243 @@ if __name__ == '__main__':
     parser.add_argument("--hidden_size", type=int, default=256)
     parser.add_argument("--dropout_prob", type=float, default=0.1)
     parser.add_argument("--max_seq_length", type=int, default=50)
+    parser.add_argument("--ungrouped_history", action="store_true", default=False,
+                        help="encode the history once per row instead of once per (admission, day) in SASRec and DIN")
+    parser.add_argument("--sparse_embedding", action="store_true", default=False,
+                        help="build embedding tables with sparse gradients, optimized by lazy adam")
 
     parser.add_argument("--lr", type=float, default=0.001)
-    # parser.add_argument("--epochs", type=int, default=3)  # 不需要——由于训练集非常大，单次遍历足够，且多epochs耗时太长了
+    # 存储的负样本固定不变，只遍历一次；现采负样本时每个epoch的负样本都不同，可以训练多个epoch
+    parser.add_argument("--epochs", type=int, default=1, help="more than 1 needs --neg_on_the_fly")
+    parser.add_argument("--neg_on_the_fly", action="store_true", default=False,
+                        help="train on the positives only, sampling fresh negatives for each batch in each epoch")
     parser.add_argument("--use_gpu", action="store_true", default=False)
     parser.add_argument("--batch_size", type=int, default=8192)  # adjustable
+    parser.add_argument("--async_valid", action="store_true", default=False,
+                        help="validate weight snapshots in a background process while training goes on")
+    parser.add_argument("--async_valid_policy", default="latest", choices=AsyncValidator.policies)
+    parser.add_argument("--async_valid_threads", type=int, default=None,
+                        help="torch threads of the async validation process, defaults to half of the threads")
+    parser.add_argument("--build_workers", type=int, default=1,
+                        help="processes building the interaction datasets when they are not cached yet")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="resume a paused training (e.g. a trial promoted by the ASHA scheduler of run_sweep.py)")
+    parser.add_argument("--run_tag", default=None,
+                        help="tag of the resumable checkpoint, to tell apart the runs sharing path_dir_model_hub")
+
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="time the named stages, export a Chrome trace and a summary table to path_dir_results")
+    parser.add_argument("--profile_torch_steps", type=int, default=None,
+                        help="with --profile, also run torch.profiler for this many training steps")
+    parser.add_argument("--profile_torch_wait", type=int, default=10,
+                        help="training steps to skip before torch.profiler starts recording")
 
     parser.add_argument("--root_path_dataset", default=constant.PATH_MIMIC_III_ETL_OUTPUT)
     parser.add_argument("--path_dir_model_hub", default=r"./model/hub")
     parser.add_argument("--path_dir_results", default=r"./results")
     parser.add_argument("--model_ckpt", default=None)
 
-    args = parser.parse_args()
+    return parser
 
+
+def main(args, sources_dfs: SourceDataFrames = None, reporter: TrialReporter = None):
+    r"""Train and/or test a baseline model with the parsed `args`.
+
+    Args:
+        sources_dfs: an already loaded dataset (e.g. shared by the trials of `run_sweep.py`),
+            loaded from `args.root_path_dataset` if None
+        reporter: reports the validation losses to the ASHA scheduler of `run_sweep.py`; when the trial reaches
+            its budget, a resumable checkpoint is saved and the run pauses (no model saving, no test)
+    """
     init_seed(args.seed, args.reproducibility)
+    if reporter is not None:
+        assert not args.async_valid, "ASHA trials validate synchronously"
+    if args.async_valid:
+        assert not args.use_gpu, "async validation forks a CPU worker process, which does not work with CUDA"
+
+    if args.profile:
+        profiler.enable()
+        profile_prefix = f"{time.strftime('%Y%m%d_%H%M%S', time.localtime())}_{args.model_name}"
 
     device = torch.device('cuda') if args.use_gpu else torch.device('cpu')
-    sources_dfs = SourceDataFrames(args.root_path_dataset)
+    if sources_dfs is None:
+        sources_dfs = SourceDataFrames(args.root_path_dataset)
 
     model_class, dataset_class = get_model_and_dataset_class(args.model_name)
     config = prepare_corr_config(model_class, args)
 
+    paused = False  # ASHA试验达到预算后暂停
     if args.train:
-        train_pre_dataset = dataset_class(sources_dfs, "train", args.goal)
-        train_itr_dataset = DFDataset(train_pre_dataset)
-        train_dataloader = torchdata.DataLoader(
-            train_itr_dataset, batch_size=args.batch_size,
-            shuffle=False, pin_memory=True, collate_fn=DFDataset.collect_fn)
+        train_pre_dataset = dataset_class(sources_dfs, "train", args.goal, seed=args.seed)
+        if args.neg_on_the_fly:  # 只保存正样本，取batch时采样负样本
+            train_itr_dataset = NegSamplingDataset(train_pre_dataset, args.batch_size, args.seed)
+        else:
+            assert args.epochs == 1, "several epochs over the stored (fixed) negatives, use --neg_on_the_fly"
+            train_itr_dataset = DFDataset(train_pre_dataset, args.build_workers)
 
-        valid_pre_dataset = dataset_class(sources_dfs, "val", args.goal)
-        valid_itr_dataset = DFDataset(valid_pre_dataset)
+        # BPR按(用户, 正样本, 负样本)三元组计算loss，在collate时配好
+        loss_collate_fn = DFDataset.collect_bpr_fn if model_class is general_recommender.BPR else DFDataset.collect_fn
+
+        valid_pre_dataset = dataset_class(sources_dfs, "val", args.goal, seed=args.seed)
+        valid_itr_dataset = DFDataset(valid_pre_dataset, args.build_workers)
         valid_dataloader = torchdata.DataLoader(
             valid_itr_dataset, batch_size=args.batch_size,
-            shuffle=False, pin_memory=True, collate_fn=DFDataset.collect_fn)
+            shuffle=False, pin_memory=True, collate_fn=loss_collate_fn)
 
         model = model_class(config, train_pre_dataset).to(device)
 
         path2save = os.path.join(args.path_dir_model_hub, model_class.__bases__[0].__name__, model_class.__name__)
         os.makedirs(path2save, exist_ok=True)
 
-        optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr)
+        optimizer = get_optimizer(model, args.lr, args.sparse_embedding)
         early_stopper = EarlyStopper(args.patience, False)
         train_metric = d2l.Accumulator(2)  # train loss, batch number counter
 
+        resume_ckpt_name = f"{model_class.__name__}_goal_{args.goal}"
+        if args.run_tag is not None:
+            resume_ckpt_name += f"_{args.run_tag}"
+        resume_ckpt_path = get_resume_ckpt_path(path2save, resume_ckpt_name)
+        start_epoch, start_index = 0, 0
+        if args.resume and os.path.exists(resume_ckpt_path):
+            ckpt = load_resume_ckpt(resume_ckpt_path)
+            assert ckpt["batch_size"] == args.batch_size, "resume with a different batch size"
+            model.load_state_dict(ckpt["model"])
+            optimizer.load_state_dict(ckpt["optimizer"])
+            early_stopper.load_state_dict(ckpt["early_stopper"])
+            train_metric.data = list(ckpt["train_metric"])
+            start_epoch, start_index = ckpt.get("epoch", 0), ckpt["next_index"]
+            set_rng_states(ckpt["rng_states"])
+            print(f"resume training from epoch {start_epoch}, batch #{start_index}")
+        elif args.resume:
+            print(f"no resumable checkpoint found at {resume_ckpt_path}, training from scratch")
+
+        async_validator = None
+        if args.async_valid:  # 在训练开始前fork验证进程，验证集和模型直接被子进程继承
+            async_validator = AsyncValidator(
+                model, lambda m: validate(m, valid_dataloader), policy=args.async_valid_policy,
+                num_threads=args.async_valid_threads or max(1, torch.get_num_threads() // 2))
+
+        torch_prof = None
+        if args.profile and args.profile_torch_steps is not None:
+            torch_prof = build_torch_profiler(args.path_dir_results, profile_prefix,
+                                              args.profile_torch_wait, args.profile_torch_steps)
+            torch_prof.start()
+
+        meter = ThroughputMeter(args.path_dir_results, "run_baseline", {
+            "model": args.model_name,
+            "goal": args.goal,
+            "batch_size": args.batch_size,
+            "world_size": 1,
+            "notes": args.notes,
+        })
+
         model.train()
-        train_loop = tqdm(enumerate(train_dataloader), leave=False, ncols=80, total=len(train_dataloader))
-        for i, interaction in train_loop:
-            loss = model.calculate_loss(interaction)
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-            with torch.no_grad():
-                train_metric.add(loss.item(), 1)
-                train_loop.set_postfix_str(f'train loss: {loss.item():.4f}')
-
-                # 每遍历完训练集的10%或最后一个，在验证集上计算下loss
-                if (i > 0 and i % (len(train_dataloader) // 10) == 0) or i == (len(train_dataloader) - 1):
-                    valid_metric = d2l.Accumulator(2)
-                    model.eval()
-                    for val_interaction in valid_dataloader:
-                        cur_loss = model.calculate_loss(val_interaction)
-                        valid_metric.add(cur_loss.item(), 1)
-                        train_loop.set_postfix_str(f'valid loss: {cur_loss.item():.4f}')
-                    valid_loss = valid_metric[0] / valid_metric[1]
-                    model.train()  # 退出时恢复下train模式
-
-                    early_stopper(valid_loss, model)
-                    if early_stopper.is_stop or i == (len(train_dataloader) - 1):  # 有更小的valid_loss了，保存一下checkpoint
+        for epoch in range(start_epoch, args.epochs):
+            # 从start_index个batch处继续（batch大小不变，因此各batch与从头训练时一致）
+            first_index = start_index if epoch == start_epoch else 0
+            if args.neg_on_the_fly:
+                train_itr_dataset.set_epoch(epoch)
+                num_batches = len(train_itr_dataset)
+                train_dataloader = torchdata.DataLoader(  # 数据集的每个元素已是一个batch
+                    train_itr_dataset, batch_size=None, sampler=range(first_index, num_batches),
+                    pin_memory=True, collate_fn=loss_collate_fn)
+            else:
+                num_batches = math.ceil(len(train_itr_dataset) / args.batch_size)
+                train_dataloader = torchdata.DataLoader(
+                    train_itr_dataset, batch_size=args.batch_size,
+                    sampler=range(first_index * args.batch_size, len(train_itr_dataset)),
+                    pin_memory=True, collate_fn=loss_collate_fn)
+
+            train_loop = tqdm(enumerate(train_dataloader, start=first_index), leave=False, ncols=80,
+                              total=num_batches, initial=first_index)
+            train_loop.set_description_str(f"E#{epoch:02}TRN")
+            for i, interaction in train_loop:
+                meter.data_ready()
+                is_trained = has_loss_samples(interaction)  # 没有样本的batch跳过，但仍按位置验证、保存
+                if is_trained:
+                    with profiler.region("forward_loss"):
+                        loss = model.calculate_loss(interaction)
+                    optimizer.zero_grad()
+                    with profiler.region("backward"):
+                        loss.backward()
+                    with profiler.region("optimizer_step"):
+                        optimizer.step()
+                if torch_prof is not None:
+                    torch_prof.step()
+
+                with torch.no_grad():
+                    if is_trained:
+                        train_metric.add(loss.item(), 1)
+                        train_loop.set_postfix_str(f'train loss: {loss.item():.4f}')
+
+                    # 每遍历完训练集的10%或每个epoch的最后一个，在验证集上计算下loss
+                    is_epoch_end = i == (num_batches - 1)
+                    is_last = is_epoch_end and epoch == args.epochs - 1
+                    is_valid = (i > 0 and i % (num_batches // 10) == 0) or is_epoch_end
+                    valid_loss = None
+                    pause_requested = False
+                    if is_valid:
+                        with meter.validating():
+                            if async_validator is not None:
+                                async_validator.submit(model, force=is_last)  # 最后一个快照必须验证
+                            else:
+                                valid_loss = validate(model, valid_dataloader, train_loop)
+                                early_stopper(valid_loss, model)
+                                if reporter is not None:
+                                    pause_requested = not reporter.report(early_stopper.best_score)
+
+                    if async_validator is not None:  # 异步验证的结果对应的是提交时的权重快照
+                        with meter.validating():
+                            for _, snapshot_loss, snapshot in (async_validator.drain() if is_last else async_validator.poll()):
+                                early_stopper(snapshot_loss, model, snapshot)
+
+                    # 一个batch中的住院数、样本数、正样本（即用户-物品图中的边）数
+                    meter.step_done(admissions=interaction['user_id'].unique().numel(),
+                                    interactions=interaction['label'].size(0),
+                                    edges=int((interaction['label'] == 1).sum()))
+                    if is_valid:
+                        meter.log_interval(epoch=epoch, iter=i, valid_loss=valid_loss,
+                                           best_valid_loss=early_stopper.best_score)
+
+                    if early_stopper.is_stop or is_last:  # 有更小的valid_loss了，保存一下checkpoint
                         model_name = f"loss_{early_stopper.best_score:.4f}_{model.__class__.__name__}_goal_{args.goal}.pt"
                         early_stopper.save_checkpoint(path2save, model_name, args.notes)
                         break
 
+                    if pause_requested:  # 达到预算，保存续训检查点后暂停，等待晋升
+                        ckpt_writer = CheckpointWriter()
+                        ckpt_writer.save({
+                            "model": model.state_dict(),
+                            "optimizer": optimizer.state_dict(),
+                            "early_stopper": early_stopper.state_dict(),
+                            "epoch": epoch,
+                            "next_index": i + 1,
+                            "batch_size": args.batch_size,
+                            "train_metric": list(train_metric.data),
+                            "rng_states": get_rng_states(),
+                            "args": vars(args),
+                        }, resume_ckpt_path)
+                        ckpt_writer.close()
+                        paused = True
+                        break
+            if early_stopper.is_stop or paused: break
+
+        if torch_prof is not None:
+            torch_prof.stop()
+        if async_validator is not None:
+            async_validator.close()
+            print(f"async validation: {async_validator.num_validated} snapshots validated, "
+                  f"{async_validator.num_skipped} skipped")
+        meter.log_run(best_valid_loss=early_stopper.best_score, args=vars(args))
+        if os.path.exists(resume_ckpt_path) and not paused:  # 训练已完成，不再需要续训
+            os.remove(resume_ckpt_path)
+        if reporter is not None:
+            reporter.finish(paused)
         print(f"avg. train loss: {train_metric[0] / train_metric[1]:.4f}")
 
-    if args.test:
-        test_pre_dataset = dataset_class(sources_dfs, "test", args.goal)
-        test_itr_dataset = DFDataset(test_pre_dataset)
+    if args.test and not paused:
+        test_pre_dataset = dataset_class(sources_dfs, "test", args.goal, seed=args.seed)
+        test_itr_dataset = DFDataset(test_pre_dataset, args.build_workers)
         test_dataloader = torchdata.DataLoader(
             test_itr_dataset, batch_size=args.batch_size,
             shuffle=False, pin_memory=True, collate_fn=DFDataset.collect_fn)
@@ -185,9 +380,19 @@ if __name__ == '__main__':
         with torch.no_grad():
             collector: List[pd.DataFrame] = []
             for interaction in tqdm(test_dataloader, leave=False, ncols=80):
-                scores = model.predict(interaction)
-                interaction['score'] = scores.cpu().tolist()
-                collector.append(interaction)
+                with profiler.region("predict"):
+                    scores = model.predict(interaction)
+                batch_results = interaction_to_dataframe(interaction)
+                batch_results['score'] = scores.cpu().numpy()
+                collector.append(batch_results)
 
         results: pd.DataFrame = pd.concat(collector, axis=0)
         save_results(args.path_dir_results, results, ckpt_filename, args.notes)
+
+    if args.profile:
+        summary = profiler.export(args.path_dir_results, profile_prefix)
+        print(summary.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+
+
+if __name__ == '__main__':
+    main(build_parser().parse_args())
@@ -0,0 +1,211 @@
+r"""
+Run several configurations of run_backbone.py / run_baseline.py concurrently, sharing one loaded dataset.
+
+The dataset is loaded (and remapped) once, then the trials run in forked processes which inherit it read-only,
+see `SourceDataFrames.share_memory_`. The CPU threads are split between the concurrent trials, and every trial
+writes to the usual result files (results.csv, log.csv, run_log.jsonl...), which are locked while being written.
+
+The trials file holds one trial per line, i.e. the command line arguments of the runner (`#` starts a comment):
+    --train --test --max_adm_length 100 --notes "full attention, max_adm_length=100"
+    --train --test --max_adm_length 100 --attention_window 7 --attention_summary --notes "W=7"
+
+Usage:
+    python run_sweep.py --runner backbone --trials sweeps/attention_window.txt --num_workers 4
+    python run_sweep.py --runner baseline --trials sweeps/baselines.txt --num_workers 3 -- --goal labitem
+
+The arguments after `--` are appended to every trial. Each trial's stdout/stderr goes to
+`{path_dir_results}/sweep/{sweep_id}/trial_{k}.log`, and a summary of the sweep to `summary.csv` next to them.
+
+With `--asha`, the trials are early terminated by asynchronous successive halving (see `utils/asha.py`):
+they pause at the budgets of the rungs, and only the best `1/eta` of each rung are resumed for a longer budget,
+e.g. 27 trials with eta=3 and budgets 1, 3, 9, 27, 45 (a full run) cost 99 validation points, 2.2 full runs:
+    python run_sweep.py --runner backbone --trials sweeps/gnn_lr.txt --num_workers 3 --asha --asha_max_budget 27 -- --epochs 3
+"""
+import argparse
+import copy
+import gc
+import multiprocessing as mp
+import os
+import shlex
+import sys
+import time
+import pandas as pd
+import torch
+import utils.constant as constant
+
+from multiprocessing.connection import wait
+from typing import List
+
+import run_backbone
+import run_baseline
+from dataset.unified import SourceDataFrames
+from utils.asha import ASHA, TrialReporter
+
+
+runners = {
+    "backbone": run_backbone,
+    "baseline": run_baseline,
+}
+
+_source_dfs = None  # 在fork之前加载，子进程直接继承
+
+
+def read_trials(path_file) -> List[List[str]]:
+    """每行是一组试验的命令行参数，跳过空行和注释"""
+    trials = []
+    with open(path_file) as f:
+        for line in f:
+            argv = shlex.split(line, comments=True)
+            if len(argv) > 0:
+                trials.append(argv)
+    return trials
+
+
+def parse_trials(runner_name, trials_argv, common_argv, num_threads, sweep_id):
+    """在加载数据之前解析所有试验的参数，尽早暴露参数错误"""
+    parser = runners[runner_name].build_parser()
+    trials = []
+    for k, argv in enumerate(trials_argv):
+        args = parser.parse_args(argv + common_argv)
+        assert not args.use_gpu, "the sweep runs CPU trials only"
+        assert not getattr(args, "distributed", False), "distributed trials are launched by torchrun, not by the sweep"
+        if hasattr(args, "num_threads"):
+            args.num_threads = num_threads
+        if args.run_tag is None:  # 并发的试验不能共用同一个续训检查点
+            args.run_tag = f"{sweep_id}_trial_{k}"
+        trials.append(args)
+    return trials
+
+
+def _run_trial(runner_name, args, num_threads, path_log, path_report=None, budget=None):
+    # 输出重定向到该试验的日志文件（ASHA的试验会多次运行，追加写入）
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with open(path_log, "a") as f:
+        os.dup2(f.fileno(), sys.stdout.fileno())
+        os.dup2(f.fileno(), sys.stderr.fileno())
+    print(f"> {runner_name}: {vars(args)}", flush=True)
+
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(num_threads)
+    except RuntimeError:  # 父进程中已经启用过inter-op线程池
+        pass
+    reporter = TrialReporter(path_report, budget) if path_report is not None else None
+    runners[runner_name].main(args, _source_dfs, reporter)
+
+
+def run_sweep(runner_name, trials, num_workers, num_threads, path_dir_sweep, asha: ASHA = None):
+    r"""Run `trials` (parsed args) in at most `num_workers` forked processes at a time.
+
+    Args:
+        asha: if given, it decides which trial runs next and for how long, the trials with rung > 0 are resumed
+
+    Returns:
+        pd.DataFrame: one row per run (a trial runs once per rung under ASHA) with its exit code and elapsed time
+    """
+    ctx = mp.get_context("fork")
+    pending = [(k, 0) for k in range(len(trials))]
+    running = {}  # sentinel -> (k, rung, process, start time)
+    rows = []
+    while True:
+        while len(running) < num_workers:
+            if asha is not None:
+                job = asha.next_job(num_running=len(running))
+            else:
+                job = pending.pop(0) if len(pending) > 0 else None
+            if job is None:
+                break
+            k, rung = job
+
+            args = copy.copy(trials[k])
+            path_report, budget = None, None
+            if asha is not None:
+                args.resume = rung > 0  # 被晋升的试验从续训检查点继续
+                path_report, budget = os.path.join(path_dir_sweep, f"trial_{k}_asha.json"), asha.budgets[rung]
+            path_log = os.path.join(path_dir_sweep, f"trial_{k}.log")
+            process = ctx.Process(target=_run_trial,
+                                  args=(runner_name, args, num_threads, path_log, path_report, budget),
+                                  name=f"trial_{k}")
+            process.start()
+            running[process.sentinel] = (k, rung, process, time.perf_counter())
+            print(f"> trial #{k} started (pid {process.pid}"
+                  f"{'' if asha is None else f', rung {rung}, budget {budget}'}): {args.notes}")
+
+        if len(running) == 0:
+            break
+
+        for sentinel in wait(list(running.keys())):
+            k, rung, process, start = running.pop(sentinel)
+            process.join()
+            elapsed = time.perf_counter() - start
+            status = "done" if process.exitcode == 0 else f"FAILED (exit code {process.exitcode})"
+            if asha is not None:
+                report = TrialReporter.load(os.path.join(path_dir_sweep, f"trial_{k}_asha.json"))
+                asha.on_trial_exit(k, rung, report, process.exitcode)
+                status = asha.status[k][1]
+            print(f"> trial #{k} {status} in {elapsed / 60:.1f} min, see {os.path.join(path_dir_sweep, f'trial_{k}.log')}")
+            rows.append({
+                "trial": k,
+                "rung": rung,
+                "exitcode": process.exitcode,
+                "elapsed_s": elapsed,
+                "notes": trials[k].notes,
+                "args": vars(trials[k]),
+            })
+
+    return pd.DataFrame(rows).sort_values(by=["trial", "rung"])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="run several trials of a runner concurrently on one shared dataset")
+    parser.add_argument("--runner", required=True, choices=list(runners.keys()))
+    parser.add_argument("--trials", required=True, help="file of the trials, one line of runner arguments per trial")
+    parser.add_argument("--num_workers", type=int, default=2, help="number of trials running at the same time")
+    parser.add_argument("--threads_per_trial", type=int, default=None,
+                        help="torch threads of each trial, default: cpu cores / num_workers")
+    parser.add_argument("--root_path_dataset", default=constant.PATH_MIMIC_III_ETL_OUTPUT,
+                        help="the dataset shared by all trials, their own --root_path_dataset is ignored")
+    parser.add_argument("--path_dir_results", default=r"./results", help="where the sweep logs save")
+    parser.add_argument("--asha", action="store_true", default=False,
+                        help="early terminate the trials by asynchronous successive halving")
+    parser.add_argument("--asha_eta", type=int, default=3, help="only the best 1/eta of a rung are promoted")
+    parser.add_argument("--asha_min_budget", type=int, default=1, help="validation points of the lowest rung")
+    parser.add_argument("--asha_max_budget", type=int, default=9,
+                        help="validation points of a full run (run_backbone: about 9 per epoch, run_baseline: 10)")
+
+    argv = sys.argv[1:]
+    common_argv = []
+    if "--" in argv:  # `--`之后的参数追加到每个试验
+        argv, common_argv = argv[:argv.index("--")], argv[argv.index("--") + 1:]
+    args = parser.parse_args(argv)
+
+    assert "fork" in mp.get_all_start_methods(), "the sweep shares the dataset by fork, which is unavailable here"
+    num_threads = args.threads_per_trial or max(1, (os.cpu_count() or 1) // args.num_workers)
+    sweep_id = time.strftime('%Y%m%d_%H%M%S', time.localtime())
+    path_dir_sweep = os.path.join(args.path_dir_results, "sweep", sweep_id)
+    os.makedirs(path_dir_sweep, exist_ok=True)
+
+    trials = parse_trials(args.runner, read_trials(args.trials), common_argv, num_threads, sweep_id)
+    print(f"> {len(trials)} trials of {args.runner}, {args.num_workers} at a time with {num_threads} threads each")
+    asha = None
+    if args.asha:
+        assert all(trial.train and not trial.async_valid for trial in trials), \
+            "ASHA trials must train, with synchronous validation"
+        asha = ASHA(len(trials), args.asha_eta, args.asha_min_budget, args.asha_max_budget)
+        print(f"> ASHA budgets of the rungs (validation points): {asha.budgets}")
+
+    _source_dfs = SourceDataFrames(args.root_path_dataset).share_memory_()
+    # 把已有对象移出GC的追踪范围，避免子进程中的GC写入对象头，触发写时复制
+    gc.collect()
+    gc.freeze()
+
+    summary = run_sweep(args.runner, trials, args.num_workers, num_threads, path_dir_sweep, asha)
+    summary.to_csv(os.path.join(path_dir_sweep, "summary.csv"), index=False)
+    if asha is not None:
+        asha_summary = pd.DataFrame(asha.summary())
+        asha_summary.to_csv(os.path.join(path_dir_sweep, "asha.csv"), index=False)
+        print(asha_summary.to_string(index=False))
+    num_failed = int((summary["exitcode"] != 0).sum())
+    print(f"> {len(summary) - num_failed} of {len(summary)} trials done, logs in {path_dir_sweep}")
+    sys.exit(1 if num_failed > 0 else 0)
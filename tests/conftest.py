@@ -0,0 +1,11 @@
+r"""
+Fixtures shared by the tests: a tiny synthetic dataset (see `dataset/synthetic.py`), generated once per session.
+"""
+import pytest
+
+from benchmark.context import BenchContext
+
+
+@pytest.fixture(scope="session")
+def ctx(tmp_path_factory) -> BenchContext:
+    return BenchContext(data_dir=str(tmp_path_factory.mktemp("synthetic")), scale=0.005, seed=10043, batch_size=256)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+import torch
+
+from model.context_aware_recommender import DSSM
+from utils.optim import get_optimizer
+
+
+@pytest.fixture
+def model(ctx):
+    ctx.reseed()
+    return DSSM(ctx.baseline_config(double_tower=True), ctx.context_dataset)
+
+
+def scores_of_all_items(model, interaction, row):
+    r"""第row行的用户与全部物品的打分（不经过`sigmoid`），走双塔的`forward`、不用物品塔的缓存"""
+    layer, n_items = model.embedding_layer, model.n_items
+    rows = {name: tensor[row:row + 1].expand(n_items, *tensor.shape[1:]).clone() for name, tensor in interaction.items()}
+    rows[model.ITEM_ID] = torch.arange(n_items, dtype=rows[model.ITEM_ID].dtype)
+    if model.all_item_token_fields is not None:  # 先用户、后物品的token特征，换成各物品的
+        rows[layer.TOKEN_FIELDS][:, layer.user_token_field_num:] = model.all_item_token_fields
+    if model.all_item_float_fields is not None:
+        rows[layer.FLOAT_FIELDS] = model.all_item_float_fields
+    with torch.no_grad():
+        return model(rows)
+
+
+def assert_predict_matches_forward(model, batch):
+    model.eval()
+    with torch.no_grad():
+        torch.testing.assert_close(model.predict(batch), torch.sigmoid(model(batch)), atol=1e-5, rtol=1e-4)
+
+
+def test_predict_matches_forward(ctx, model):
+    assert_predict_matches_forward(model, ctx.context_train_batch)
+
+
+def test_item_tower_cache_invalidated_by_optimizer_step(ctx, model):
+    batch = ctx.context_train_batch
+    assert_predict_matches_forward(model, batch)  # 填充缓存
+    cached = model.item_tower_outputs()
+
+    model.train()
+    optimizer = get_optimizer(model, 1e-2)
+    model.calculate_loss(batch).backward()
+    optimizer.step()
+
+    assert_predict_matches_forward(model, batch)
+    assert not torch.equal(model.item_tower_outputs(), cached)
+
+
+def test_retrieve_matches_scoring_all_items(ctx, model):
+    batch = ctx.context_train_batch
+    model.eval()
+    _, first_rows = np.unique(batch[model.USER_ID].numpy(), return_index=True)
+    rows = torch.from_numpy(np.sort(first_rows)[:8])  # 前几个用户各取一行
+    k = 10
+    top_scores, top_items = model.retrieve({name: tensor[rows] for name, tensor in batch.items()}, k)
+    for i, row in enumerate(rows.tolist()):
+        ref_scores = scores_of_all_items(model, batch, row)
+        torch.testing.assert_close(top_scores[i], torch.topk(ref_scores, k).values, atol=1e-5, rtol=1e-4)
+        torch.testing.assert_close(ref_scores[top_items[i]], top_scores[i], atol=1e-5, rtol=1e-4)
@@ -0,0 +1,65 @@
+import copy
+import pytest
+import torch
+
+from torch_geometric.data import HeteroData
+from torch_geometric.nn import to_hetero
+
+from model.layers import SingelGnn, checkpoint_gnn_layers
+
+
+@pytest.fixture
+def hetero_data():
+    torch.manual_seed(0)
+    data = HeteroData()
+    data["a"].x = torch.randn(30, 16)
+    data["b"].x = torch.randn(20, 16)
+    for edge_type, (num_src, num_dst) in {("a", "r", "b"): (30, 20), ("b", "rev", "a"): (20, 30)}.items():
+        data[edge_type].edge_index = torch.stack([torch.randint(num_src, (80,)), torch.randint(num_dst, (80,))])
+        data[edge_type].edge_attr = torch.randn(80, 16)
+    return data
+
+
+def train_step(gnn, data, seed=0):
+    torch.manual_seed(seed)  # GINEConv的MLP中有dropout，重计算时沿用前向的随机状态
+    gnn.train()
+    out = gnn(data.x_dict, data.edge_index_dict, data.edge_attr_dict)
+    sum(v.sum() for v in out.values()).backward()
+    return out
+
+
+@pytest.mark.parametrize("gnn_type", ["GENConv", "GINEConv"])
+@pytest.mark.parametrize("layer_indices", [None, [1]])
+def test_same_state_dict_and_grads(hetero_data, gnn_type, layer_indices):
+    gnn = to_hetero(SingelGnn(16, gnn_type, 2), hetero_data.metadata())
+    checkpointed = checkpoint_gnn_layers(copy.deepcopy(gnn), layer_indices)
+
+    for step in range(2):  # 第二步用第一步更新过的running stats
+        gnn.zero_grad()
+        checkpointed.zero_grad()
+        out = train_step(gnn, hetero_data, step)
+        checkpointed_out = train_step(checkpointed, hetero_data, step)
+        for node_type in out:
+            torch.testing.assert_close(checkpointed_out[node_type], out[node_type])
+
+    state_dict, checkpointed_state_dict = gnn.state_dict(), checkpointed.state_dict()
+    assert list(checkpointed_state_dict.keys()) == list(state_dict.keys())
+    for key in state_dict:  # 包括BatchNorm的running stats：每步只更新一次
+        torch.testing.assert_close(checkpointed_state_dict[key], state_dict[key], msg=key)
+
+    grads = {name: p.grad for name, p in gnn.named_parameters()}
+    checkpointed_grads = {name.replace("module.", ""): p.grad for name, p in checkpointed.named_parameters()}
+    assert checkpointed_grads.keys() == grads.keys()
+    for name, grad in grads.items():
+        assert (grad is None) == (checkpointed_grads[name] is None), name
+        if grad is not None:
+            torch.testing.assert_close(checkpointed_grads[name], grad)
+
+
+def test_load_state_dict(hetero_data):
+    gnn = to_hetero(SingelGnn(16, "GENConv", 2), hetero_data.metadata())
+    train_step(gnn, hetero_data)
+    checkpointed = checkpoint_gnn_layers(to_hetero(SingelGnn(16, "GENConv", 2), hetero_data.metadata()))
+    checkpointed.load_state_dict(gnn.state_dict())
+    for key, value in gnn.state_dict().items():
+        torch.testing.assert_close(checkpointed.state_dict()[key], value)
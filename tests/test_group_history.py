@@ -0,0 +1,48 @@
+import copy
+import pytest
+import torch
+import torch.nn as nn
+
+from model.sequential_recommender import DIN, SASRec
+
+
+def without_dropout(model):
+    for module in model.modules():
+        if isinstance(module, nn.Dropout):
+            module.p = 0.
+        elif isinstance(module, nn.MultiheadAttention):
+            module.dropout = 0.
+    return model
+
+
+@pytest.fixture(params=[DIN, SASRec], ids=lambda model_class: model_class.__name__)
+def models(request, ctx):
+    r"""按(住院, 天)只编码一次历史序列的模型（group_history=True），及参数相同、逐行编码的模型"""
+    ctx.reseed()
+    model = request.param(ctx.baseline_config(group_history=True), ctx.seq_dataset)
+    ref_model = copy.deepcopy(model)
+    ref_model.group_history = False
+    return model, ref_model
+
+
+def test_eval_output(ctx, models):
+    model, ref_model = models
+    model.eval()
+    ref_model.eval()
+    with torch.no_grad():
+        torch.testing.assert_close(model(ctx.seq_train_batch), ref_model(ctx.seq_train_batch), atol=1e-5, rtol=1e-4)
+
+
+def test_train_loss_and_grads(ctx, models):
+    r"""train模式下两者的dropout按不同的形状采样，结果不可比，因此去掉dropout"""
+    model, ref_model = (without_dropout(m).train() for m in models)
+    loss = model.calculate_loss(ctx.seq_train_batch)
+    ref_loss = ref_model.calculate_loss(ctx.seq_train_batch)
+    torch.testing.assert_close(loss, ref_loss, atol=1e-5, rtol=1e-4)
+
+    loss.backward()
+    ref_loss.backward()
+    for (name, p), (_, q) in zip(model.named_parameters(), ref_model.named_parameters()):
+        assert (p.grad is None) == (q.grad is None), name
+        if p.grad is not None:
+            torch.testing.assert_close(p.grad, q.grad, atol=1e-5, rtol=1e-4)
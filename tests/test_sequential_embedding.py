@@ -0,0 +1,37 @@
+import torch
+import torch.nn.functional as fn
+
+
+def item_seqs_embedding_per_row(layer, interaction):
+    """逐行取物品序列（目标物品+历史序列）的emb，即批量实现之前的做法，作为`SequentialEmbeddingLayer.forward`的参照"""
+    history_id = interaction[layer.HISTORY_ID].long()
+    item_seq = interaction[layer.ITEM_SEQ].long()[history_id]
+    item_seq_len = interaction[layer.ITEM_SEQ_LEN].long()
+    next_items = interaction[layer.ITEM_ID].long()
+    rows = []
+    for history, length, next_item in zip(item_seq, item_seq_len.tolist(), next_items):
+        ids = torch.cat([next_item.view(1), history[:length]])[:layer.max_seq_length + 1]  # 过长则截断
+        num_pad = layer.max_seq_length + 1 - ids.size(0)
+        feature_embedding = fn.pad(layer._embed_item_feat_fields(ids), (0, 0, 0, 0, 0, num_pad), value=0)
+        ids = fn.pad(ids, (0, num_pad), value=layer.item_padding_idx)
+        ids_embedding = layer.item_id_embedding_table(ids).unsqueeze(1)
+        rows.append(torch.cat([feature_embedding, ids_embedding], dim=1).flatten(start_dim=1))
+    return torch.stack(rows)
+
+
+def test_forward_matches_per_row(ctx):
+    layer, batch = ctx.make_seq_embedding_layer(), ctx.seq_train_batch
+    ref_layer = ctx.make_seq_embedding_layer()
+    ref_layer.load_state_dict(layer.state_dict())
+
+    _, item_seqs_embedding = layer(batch)
+    ref_item_seqs_embedding = item_seqs_embedding_per_row(ref_layer, batch)
+    torch.testing.assert_close(item_seqs_embedding, ref_item_seqs_embedding, atol=1e-5, rtol=1e-4)
+
+    weight = torch.randn_like(item_seqs_embedding)
+    (item_seqs_embedding * weight).sum().backward()
+    (ref_item_seqs_embedding * weight).sum().backward()
+    for (name, p), (_, q) in zip(layer.named_parameters(), ref_layer.named_parameters()):
+        assert (p.grad is None) == (q.grad is None), name
+        if p.grad is not None:
+            torch.testing.assert_close(p.grad, q.grad, atol=1e-5, rtol=1e-4)
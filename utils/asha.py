@@ -0,0 +1,141 @@
+r"""
+Asynchronous successive halving (ASHA, Li et al. 2020) for the trials of `run_sweep.py`.
+
+The budget of a trial is counted in validation points, i.e. the periodic validations of the runners
+(every 10% of the training set). The rungs have budgets `min_budget * eta^k` (< `max_budget`), plus a top rung
+where the trials train to the end (or until early stopping). A trial that reaches the budget of its rung saves
+a resumable checkpoint and pauses; whenever a worker is free, the best `1/eta` of each rung are promoted
+(resumed from their checkpoints) to the next rung, otherwise a new trial starts in the lowest rung.
+
+    scheduler (in the sweep process)            trial (in a forked worker)
+    --------------------------------            --------------------------
+    trial, rung = asha.next_job(...)   ->       reporter = TrialReporter(path, asha.budgets[rung])
+                                                main(args, sources_dfs, reporter)
+                                                  `reporter.report(best_valid_loss)` at each validation,
+                                                  pauses when it returns False, then `reporter.finish(paused)`
+    asha.on_trial_exit(trial, rung, ...)  <-    losses and status in the reporter's json file
+"""
+import json
+import os
+
+from typing import List
+
+
+class TrialReporter:
+    r"""Used by a runner to report its validation losses, and to learn when to pause.
+
+    Args:
+        path_file: json file of the reports, kept across the pauses and resumes of the trial
+        budget: total number of validation points allowed to the trial so far, None to train to the end
+    """
+
+    def __init__(self, path_file: str, budget: int = None):
+        self.path_file = path_file
+        self.budget = budget
+        self.losses: List[float] = []
+        self.status = "running"
+        if os.path.exists(path_file):  # 被晋升后从检查点继续的试验，累计之前的验证次数
+            with open(path_file) as f:
+                self.losses = json.load(f)["losses"]
+
+    def report(self, valid_loss: float):
+        r"""Report the (best so far) validation loss, returns whether to go on training"""
+        self.losses.append(float(valid_loss))
+        self._save()
+        return self.budget is None or len(self.losses) < self.budget
+
+    def finish(self, paused: bool):
+        """试验退出前调用：paused为True时等待晋升，否则已训练完（或早停）"""
+        self.status = "paused" if paused else "done"
+        self._save()
+
+    def _save(self):
+        with open(self.path_file, "w") as f:
+            json.dump({"losses": self.losses, "budget": self.budget, "status": self.status}, f)
+
+    @staticmethod
+    def load(path_file: str):
+        if not os.path.exists(path_file):
+            return {"losses": [], "budget": None, "status": "failed"}
+        with open(path_file) as f:
+            return json.load(f)
+
+
+class ASHA:
+    r"""The promotion decisions of asynchronous successive halving.
+
+    Args:
+        num_trials: number of trial configurations
+        eta: the top `1/eta` of a rung are promoted
+        min_budget: validation points of the lowest rung
+        max_budget: validation points of a full run, the rungs below the top one have budgets < max_budget
+    """
+
+    def __init__(self, num_trials: int, eta: int = 3, min_budget: int = 1, max_budget: int = 9):
+        assert eta >= 2 and min_budget >= 1
+        self.eta = eta
+        self.budgets = []
+        budget = min_budget
+        while budget < max_budget:
+            self.budgets.append(budget)
+            budget *= eta
+        self.budgets.append(None)  # 最高一级：训练到结束
+
+        self.rungs = [dict() for _ in self.budgets]  # 每一级：trial -> 在该级预算时的loss
+        self.promoted = [set() for _ in self.budgets]  # 每一级中已晋升（或无法晋升）的trial
+        self.new_trials = list(range(num_trials))
+        self.status = {}  # trial -> (rung, "running" / "paused" / "done" / "failed")
+
+    def next_job(self, num_running: int = 0):
+        r"""Returns (trial, rung) to run next, or None if there is nothing to run for now.
+        A trial with rung > 0 is resumed from its checkpoint."""
+        for k in reversed(range(len(self.budgets) - 1)):
+            rung = self.rungs[k]
+            for trial in sorted(rung, key=rung.get)[:len(rung) // self.eta]:
+                if trial not in self.promoted[k]:
+                    return self._start(trial, k + 1)
+
+        if len(self.new_trials) > 0:
+            return self._start(self.new_trials.pop(0), 0)
+
+        top_rung = len(self.budgets) - 1
+        if num_running == 0 and all(rung < top_rung for rung, _ in self.status.values()):
+            # 试验数不够多、没有试验能按比例晋升到最高一级时，保证最好的一个最终能完整训练
+            for k in reversed(range(top_rung)):
+                candidates = [trial for trial in self.rungs[k] if trial not in self.promoted[k]]
+                if len(candidates) > 0:
+                    return self._start(min(candidates, key=self.rungs[k].get), k + 1)
+        return None
+
+    def _start(self, trial, rung):
+        if rung > 0:
+            self.promoted[rung - 1].add(trial)
+        self.status[trial] = (rung, "running")
+        return trial, rung
+
+    def on_trial_exit(self, trial, rung, report, exitcode):
+        r"""Update the rungs with the `TrialReporter.load` of the exited trial"""
+        if exitcode != 0 or report["status"] == "failed":
+            self.status[trial] = (rung, "failed")
+            return
+        if report["status"] == "paused" and len(report["losses"]) > 0:
+            self.rungs[rung][trial] = report["losses"][-1]
+            self.status[trial] = (rung, "paused")
+        else:  # 训练到结束，或早停
+            if len(report["losses"]) > 0:
+                self.rungs[rung][trial] = report["losses"][-1]
+            self.promoted[rung].add(trial)
+            self.status[trial] = (rung, "done")
+
+    def summary(self):
+        r"""list of dict, one per trial: the highest rung reached, its status and the last reported loss"""
+        rows = []
+        for trial, (rung, status) in sorted(self.status.items()):
+            rows.append({
+                "trial": trial,
+                "rung": rung,
+                "budget": self.budgets[rung],
+                "status": status,
+                "valid_loss": self.rungs[rung].get(trial),
+            })
+        return rows
@@ -0,0 +1,156 @@
+r"""
+Asynchronous validation: evaluate weight snapshots in a worker process while the training goes on.
+"""
+import queue
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+
+from typing import Callable, Dict, List, Tuple
+
+
+_STOP = -2  # 通知worker退出的版本号
+
+
+def _worker_loop(model, shared_state, lock, has_pending, pending_version, results, eval_fn, num_threads):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    while True:
+        has_pending.wait()
+        with lock:  # 拷贝共享内存中的权重到worker自己的模型，拷完即释放，主进程可以继续写入新的快照
+            version = pending_version.value
+            has_pending.clear()
+            if version == _STOP:
+                break
+            model.load_state_dict(shared_state)
+
+        try:
+            score = eval_fn(model)
+            results.put((version, float(score), None))
+        except Exception as e:  # 交给主进程抛出
+            results.put((version, None, repr(e)))
+
+
+class AsyncValidator:
+    r"""Evaluate weight snapshots in a separate (forked) worker process.
+
+    The weights are copied into a shared memory buffer when a snapshot is submitted, the worker loads them
+    into its own copy of the model and runs `eval_fn` on it, results are fetched back with `poll` / `drain`.
+
+    Args:
+        model: the model being trained, the worker inherits a copy of it when forked
+        eval_fn: `eval_fn(model) -> float`, e.g. the average validation loss
+        policy: what to do when a snapshot is submitted while the worker still lags behind
+            - "block": wait until all previous snapshots are evaluated
+            - "skip": drop the new snapshot if the worker is busy
+            - "latest": keep at most one pending snapshot, a newer one replaces the stale pending one
+        num_threads: torch intra-op threads of the worker process
+
+    Example::
+
+        >>> validator = AsyncValidator(model, lambda m: valid_loss(m), policy="latest")
+        >>> validator.submit(model)
+        >>> for version, score, state_dict in validator.poll():
+        >>>     early_stopper(score, model, state_dict)
+        >>> validator.close()
+    """
+
+    policies = ("block", "skip", "latest")
+
+    def __init__(self, model: nn.Module, eval_fn: Callable[[nn.Module], float],
+                 policy: str = "latest", num_threads: int = None):
+        assert policy in self.policies, f"invalid async validation policy: {policy}"
+        self.policy = policy
+
+        ctx = mp.get_context("fork")  # fork: worker直接继承模型和验证集，无需pickle
+        self._shared_state = {k: v.detach().cpu().clone().share_memory_() for k, v in model.state_dict().items()}
+        self._lock = ctx.Lock()
+        self._has_pending = ctx.Event()
+        self._pending_version = ctx.Value('l', -1)
+        self._results = ctx.Queue()
+
+        self._worker = ctx.Process(
+            target=_worker_loop,
+            args=(model, self._shared_state, self._lock, self._has_pending, self._pending_version,
+                  self._results, eval_fn, num_threads),
+            daemon=True)
+        self._worker.start()
+
+        self._next_version = 0
+        self._in_flight = set()  # 已提交、尚未返回结果的快照版本
+        self._snapshots: Dict[int, Dict[str, torch.Tensor]] = {}  # 供EarlyStopper保存最优权重
+        self.num_submitted = 0
+        self.num_validated = 0
+        self.num_skipped = 0
+
+    def submit(self, model: nn.Module, force: bool = False):
+        """提交当前权重的快照，返回是否提交成功；`force`时忽略policy，等待之前的快照都评估完再提交"""
+        policy = "block" if force else self.policy
+        if policy == "block":
+            while len(self._in_flight) > 0:
+                self._wait_one()
+        elif policy == "skip" and len(self._in_flight) > 0:
+            self.num_skipped += 1
+            return False
+
+        state_dict = model.state_dict()
+        version = self._next_version
+        with self._lock:
+            if self._has_pending.is_set():  # "latest": worker还没取走的快照已经过时，直接替换
+                stale_version = self._pending_version.value
+                self._in_flight.discard(stale_version)
+                self._snapshots.pop(stale_version, None)
+                self.num_skipped += 1
+            for k, v in state_dict.items():
+                self._shared_state[k].copy_(v.detach())
+            self._pending_version.value = version
+            self._has_pending.set()
+
+        self._snapshots[version] = {k: v.detach().clone() for k, v in state_dict.items()}
+        self._in_flight.add(version)
+        self._next_version += 1
+        self.num_submitted += 1
+        return True
+
+    def _wait_one(self, timeout: float = None):
+        while True:
+            try:
+                version, score, error = self._results.get(timeout=5. if timeout is None else timeout)
+                break
+            except queue.Empty:
+                if not self._worker.is_alive():
+                    raise RuntimeError("async validation worker exited unexpectedly")
+                if timeout is not None:
+                    return None
+
+        if error is not None:
+            raise RuntimeError(f"async validation failed on snapshot #{version}: {error}")
+        self._in_flight.discard(version)
+        self.num_validated += 1
+        return version, score, self._snapshots.pop(version)
+
+    def poll(self) -> List[Tuple[int, float, Dict[str, torch.Tensor]]]:
+        """取回已评估完的快照结果（不阻塞），按版本号排列: [(version, score, state_dict), ...]"""
+        collected = []
+        while len(self._in_flight) > 0:
+            result = self._wait_one(timeout=0.)
+            if result is None:
+                break
+            collected.append(result)
+        return sorted(collected, key=lambda x: x[0])
+
+    def drain(self) -> List[Tuple[int, float, Dict[str, torch.Tensor]]]:
+        """等待所有已提交的快照评估完，并取回结果"""
+        collected = []
+        while len(self._in_flight) > 0:
+            collected.append(self._wait_one())
+        return sorted(collected, key=lambda x: x[0])
+
+    def close(self):
+        with self._lock:
+            self._pending_version.value = _STOP
+            self._has_pending.set()
+        self._worker.join(timeout=60)
+        if self._worker.is_alive():
+            self._worker.terminate()
@@ -0,0 +1,97 @@
+r"""
+Resumable training checkpoints: model, optimizer, lr scheduler, RNG states, early stopper and the position in the epoch.
+
+They are written by a background thread, so the training loop does not wait for the disk,
+and saved with the `.ckpt` extension, so they are not mistaken for the `.pt` state_dicts in the model hub.
+"""
+import os
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+from typing import Dict
+
+
+def get_rng_states() -> Dict:
+    states = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states: Dict):
+    random.setstate(states["python"])
+    np.random.set_state(states["numpy"])
+    torch.set_rng_state(states["torch"])
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+def _detached_copy(obj):
+    """递归地把tensor拷贝到CPU，之后训练中的原地更新不会影响正在写盘的内容"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    elif isinstance(obj, dict):
+        return {k: _detached_copy(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_detached_copy(v) for v in obj)
+    else:
+        return obj
+
+
+def get_resume_ckpt_path(path_dir: str, model_name: str, rank: int = 0):
+    """分布式训练时每个rank各自保存一份（负采样等的RNG状态各不相同）"""
+    return os.path.join(path_dir, f"resume_{model_name}_rank{rank}.ckpt")
+
+
+def load_resume_ckpt(path: str) -> Dict:
+    # RNG状态中包含numpy的tuple，不能用weights_only
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+
+class CheckpointWriter:
+    r"""Write checkpoints in a background thread.
+
+    `save` copies the state on the calling thread (cheap, in memory) and returns immediately,
+    the file is written to `path + ".tmp"` first and then renamed, so a crash never leaves a broken checkpoint.
+    At most one checkpoint is waiting to be written, a further `save` blocks until the previous one is on disk.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            state, path = item
+            try:
+                tmp_path = path + ".tmp"
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                self._error = e
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError(f"failed to write checkpoint: {self._error!r}")
+
+    def save(self, state: Dict, path: str):
+        self._raise_if_failed()
+        self._queue.put((_detached_copy(state), path))
+
+    def close(self):
+        """等待所有检查点写完"""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_if_failed()
@@ -0,0 +1,122 @@
+r"""
+Helpers for CPU data-parallel training with `torch.distributed` (gloo backend).
+
+Launched with torchrun on a single node, e.g.:
+    torchrun --standalone --nproc_per_node=4 run_backbone.py --train --distributed ...
+"""
+import math
+import random
+import torch
+import torch.distributed as dist
+
+from torch.nn.modules.batchnorm import _BatchNorm
+
+from typing import List
+
+
+def init_distributed(backend: str = "gloo"):
+    """用torchrun设置的环境变量(RANK, WORLD_SIZE, MASTER_ADDR...)初始化进程组，返回(rank, world_size)"""
+    dist.init_process_group(backend=backend)
+    return dist.get_rank(), dist.get_world_size()
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def shard_list(items: List, rank: int, world_size: int, pad: bool = True):
+    r"""Shard `items` across ranks in a round-robin way.
+
+    Args:
+        pad: repeat the leading items so that every rank gets the same number of items,
+            which is required for training, otherwise the ranks would wait for each other's gradients forever.
+            Use `pad=False` when each item must be counted exactly once (e.g. validation).
+    """
+    if pad and len(items) > 0:
+        total = math.ceil(len(items) / world_size) * world_size
+        items = [items[i % len(items)] for i in range(total)]
+    return items[rank::world_size]
+
+
+def cost_balanced_shard(items: List, costs: List[float], rank: int, world_size: int, seed: int = 0):
+    r"""Shard `items` so that the ranks get the same number of items and similar total costs,
+    and the items trained at the same step on different ranks have similar costs (fewer stragglers at gradient sync).
+
+    The items are sorted by cost and cut into groups of `world_size`, one item of each group per rank
+    (alternating the direction, so no rank always gets the most costly one). The order of the groups is shuffled
+    with `seed`, which must be the same on all ranks.
+
+    Args:
+        costs: predicted cost of each item, e.g. from `dataset.cost_model.compute_admission_costs`
+    """
+    assert len(items) == len(costs)
+    if len(items) == 0:
+        return []
+    order = sorted(range(len(items)), key=lambda j: costs[j], reverse=True)
+    num_pad = math.ceil(len(items) / world_size) * world_size - len(items)
+    order = order + order[len(order) - num_pad:]  # 用开销最小的几个补齐，补齐的项落在同一组里
+
+    groups = [order[k:k + world_size] for k in range(0, len(order), world_size)]
+    groups = [group if k % 2 == 0 else group[::-1] for k, group in enumerate(groups)]
+    random.Random(seed).shuffle(groups)  # 不按开销从大到小训练
+    return [items[group[rank]] for group in groups]
+
+
+def all_reduce_sum(values: List[float]):
+    """对各rank上的若干个标量求和，返回求和后的list"""
+    tensor = torch.tensor(values, dtype=torch.float64)
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+
+def all_reduce_bn_buffers(module: torch.nn.Module):
+    r"""Average the running stats of the BatchNorm layers of `module` across ranks.
+
+    Used with `DistributedDataParallel(..., broadcast_buffers=False)`, which would otherwise broadcast the buffers
+    from rank 0 at every forward (also inside `no_sync()`), so that the ranks sync only at the optimizer steps.
+    """
+    if not is_distributed():
+        return
+    buffers = [buf for m in module.modules() if isinstance(m, _BatchNorm) and m.track_running_stats
+               for buf in (m.running_mean, m.running_var) if buf is not None]
+    if len(buffers) == 0:
+        return
+    flat = torch.cat([buf.reshape(-1) for buf in buffers])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat /= get_world_size()
+    offset = 0
+    for buf in buffers:
+        buf.copy_(flat[offset:offset + buf.numel()].view_as(buf))
+        offset += buf.numel()
+
+
+def broadcast_bool(flag: bool, src: int = 0):
+    """以src rank上的值为准，保证各rank的判断（如是否早停）一致"""
+    if not is_distributed():
+        return flag
+    tensor = torch.tensor([int(flag)], dtype=torch.int64)
+    dist.broadcast(tensor, src=src)
+    return bool(tensor.item())
@@ -14,10 +14,11 @@ from sklearn.metrics import \
     precision_score, \
     recall_score, \
     average_precision_score
-from typing import List
+from typing import List, Dict
 
 
 sys.path.append('..')
+from utils.misc import file_lock
 
 
 def flat_indices_to_voc_size(indices: List[int], voc_size, exclude_indices=None) -> np.ndarray:
@@ -138,19 +139,30 @@ def calc_metrics(results):
     }
 
 
-def save_results(path_dir_results, results, ckpt_filename, notes):
+def recall_at_k(exact_topk_items: torch.tensor, approx_topk_items: torch.tensor):
+    """近似检索得到的top-k，对精确检索top-k的召回率"""
+    exact = set(exact_topk_items.tolist())
+    approx = set(approx_topk_items.tolist())
+    if len(exact) == 0:
+        return 1.
+    return len(exact & approx) / len(exact)
+
+
+def save_results(path_dir_results, results, ckpt_filename, notes, extra_metrics: Dict = None):
     assert notes is not None  # 实验备注必须填写！
     timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
     new_row = {
         "timestamp": timestamp,
         "ckpt_filename": ckpt_filename,
         "notes": notes,
-        **calc_metrics(results)
+        **calc_metrics(results),
+        **(extra_metrics if extra_metrics is not None else {})
     }
     result_file = os.path.join(path_dir_results, "results.csv")
-    if os.path.exists(result_file):
-        df_results = pd.read_csv(result_file)
-        df_results = pd.concat([df_results, pd.DataFrame(new_row, index=[0])], ignore_index=True)
-    else:
-        df_results = pd.DataFrame(new_row, index=[0])
-    df_results.to_csv(result_file, index=False)
+    with file_lock(result_file):
+        if os.path.exists(result_file):
+            df_results = pd.read_csv(result_file)
+            df_results = pd.concat([df_results, pd.DataFrame(new_row, index=[0])], ignore_index=True)
+        else:
+            df_results = pd.DataFrame(new_row, index=[0])
+        df_results.to_csv(result_file, index=False)
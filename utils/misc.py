@@ -1,6 +1,7 @@
 import torch
 import os
 import glob
+import contextlib
 import time
 import pandas as pd
 import random
@@ -75,14 +76,15 @@ class EarlyStopper:
         self.is_stop = False
         self.best_model_wts = None
 
-    def __call__(self, score, model):
+    def __call__(self, score, model, state_dict=None):
+        # state_dict: 异步验证时传入被验证的权重快照，此时model的权重已经更新过了
         if self.best_score is None:
             self.best_score = score
-            self.best_model_wts = model.state_dict()
+            self.best_model_wts = self._copy_wts(model.state_dict() if state_dict is None else state_dict)
         elif score < self.best_score:  # Assuming lower score is better (e.g., loss)
             self.best_score = score
             self.counter = 0  # 重置耐心计数器
-            self.best_model_wts = model.state_dict()
+            self.best_model_wts = self._copy_wts(model.state_dict() if state_dict is None else state_dict)
         else:
             self.counter += 1
             if self.verbose:
@@ -91,6 +93,25 @@ class EarlyStopper:
                 self.is_stop = True
                 print("\nEarly stop due to increasing valid loss!")
 
+    @staticmethod
+    def _copy_wts(state_dict):
+        # model.state_dict()与模型参数共享内存，不拷贝的话之后的训练会覆盖掉最优的权重
+        return {k: v.detach().clone() for k, v in state_dict.items()}
+
+    def state_dict(self):
+        return {
+            "counter": self.counter,
+            "best_score": self.best_score,
+            "is_stop": self.is_stop,
+            "best_model_wts": self.best_model_wts,
+        }
+
+    def load_state_dict(self, state_dict):
+        self.counter = state_dict["counter"]
+        self.best_score = state_dict["best_score"]
+        self.is_stop = state_dict["is_stop"]
+        self.best_model_wts = state_dict["best_model_wts"]
+
     def _log(self, path_to_save, model_name, notes):
         # 保存模型checkpoint时，往log.csv记录这次的实验信息，供后续查阅
         assert notes is not None  # 实验备注必须填写！
@@ -102,18 +123,77 @@ class EarlyStopper:
             "notes": notes,  # 应记录实验描述，以及运行实验脚本的参数
         }
         log_file = os.path.join(path_to_save, "log.csv")
-        if os.path.exists(log_file):
-            df = pd.read_csv(log_file)
-            df = pd.concat([df, pd.DataFrame(new_row, index=[0])], ignore_index=True)
-        else:
-            df = pd.DataFrame(new_row, index=[0])
-        df.to_csv(log_file, index=False)
+        with file_lock(log_file):
+            if os.path.exists(log_file):
+                df = pd.read_csv(log_file)
+                df = pd.concat([df, pd.DataFrame(new_row, index=[0])], ignore_index=True)
+            else:
+                df = pd.DataFrame(new_row, index=[0])
+            df.to_csv(log_file, index=False)
 
     def save_checkpoint(self, path_to_save, model_name, notes):
         self._log(path_to_save, model_name, notes)
         torch.save(self.best_model_wts, os.path.join(path_to_save, model_name))
 
 
+def reset_peak_rss():
+    """重置当前进程的峰值常驻内存(VmHWM)，仅Linux下有效；返回是否重置成功"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss_mb():
+    """当前进程的峰值常驻内存(MB)，优先读取/proc（可被`reset_peak_rss`重置），否则退回到getrusage"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # linux下单位为KB
+    except ImportError:  # windows
+        return float("nan")
+
+
+@contextlib.contextmanager
+def file_lock(file):
+    r"""Exclusive lock of `file` across processes (via `file + '.lock'`), so that concurrent runs
+    (e.g. the trials of `run_sweep.py`) do not lose each other's rows when read-modify-writing the same csv.
+    A no-op where `fcntl` is unavailable (windows)."""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+    with open(f"{file}.lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def append_to_csv(file, rows: List[Dict]):
+    """往csv文件中追加若干行记录，文件不存在时新建"""
+    new_rows = pd.DataFrame(rows)
+    with file_lock(file):
+        if os.path.exists(file):
+            df = pd.read_csv(file)
+            df = pd.concat([df, new_rows], ignore_index=True)
+        else:
+            df = new_rows
+        df.to_csv(file, index=False)
+
+
 def init_seed(seed, reproducibility=False):
     r"""init random seed for random functions in numpy, torch, cuda and cudnn
 
@@ -0,0 +1,131 @@
+import math
+import torch
+import torch.nn as nn
+
+from typing import Iterable, List, Dict
+
+
+class SparseAwareAdamW(torch.optim.Optimizer):
+    r"""AdamW which also accepts sparse gradients (from `nn.Embedding(sparse=True)`).
+
+    - Dense gradients are updated the same as `torch.optim.AdamW`.
+    - Sparse gradients are updated lazily: only the rows touched in the current step update their moments
+      and values, the other rows of the embedding table are left untouched (like `torch.optim.SparseAdam`).
+
+    Being a single optimizer, it works with `lr_scheduler` and `state_dict()` as usual.
+    Use `get_optimizer` to split the parameters into a sparse and a dense group.
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-2):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super(SparseAwareAdamW, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            lr = group["lr"]
+            beta1, beta2 = group["betas"]
+            eps = group["eps"]
+            weight_decay = group["weight_decay"]
+
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+                grad = p.grad
+
+                state = self.state[p]
+                if len(state) == 0:
+                    state["step"] = 0
+                    state["exp_avg"] = torch.zeros_like(p, memory_format=torch.preserve_format)
+                    state["exp_avg_sq"] = torch.zeros_like(p, memory_format=torch.preserve_format)
+                exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
+
+                state["step"] += 1
+                bias_correction1 = 1 - beta1 ** state["step"]
+                bias_correction2_sqrt = math.sqrt(1 - beta2 ** state["step"])
+                step_size = lr / bias_correction1
+
+                if grad.is_sparse:
+                    # lazy adam: 只更新当前step中出现过的行
+                    grad = grad.coalesce()
+                    rows, values = grad.indices()[0], grad.values()
+
+                    p_rows = p.index_select(0, rows)
+                    if weight_decay != 0:
+                        p_rows.mul_(1 - lr * weight_decay)
+                    exp_avg_rows = exp_avg.index_select(0, rows).mul_(beta1).add_(values, alpha=1 - beta1)
+                    exp_avg_sq_rows = exp_avg_sq.index_select(0, rows).mul_(beta2).addcmul_(values, values, value=1 - beta2)
+                    denom = (exp_avg_sq_rows.sqrt() / bias_correction2_sqrt).add_(eps)
+                    p_rows.addcdiv_(exp_avg_rows, denom, value=-step_size)
+
+                    exp_avg.index_copy_(0, rows, exp_avg_rows)
+                    exp_avg_sq.index_copy_(0, rows, exp_avg_sq_rows)
+                    p.index_copy_(0, rows, p_rows)
+                else:
+                    if weight_decay != 0:
+                        p.mul_(1 - lr * weight_decay)
+                    exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                    exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                    denom = (exp_avg_sq.sqrt() / bias_correction2_sqrt).add_(eps)
+                    p.addcdiv_(exp_avg, denom, value=-step_size)
+
+        return loss
+
+
+def split_sparse_dense_params(model: nn.Module):
+    """把模型参数分成两组：sparse=True的embedding表 / 其余的dense参数"""
+    sparse_params = []
+    for module in model.modules():
+        if isinstance(module, nn.Embedding) and module.sparse:
+            sparse_params.append(module.weight)
+    sparse_ids = set(id(p) for p in sparse_params)
+    dense_params = [p for p in model.parameters() if id(p) not in sparse_ids]
+    return sparse_params, dense_params
+
+
+def get_optimizer(model: nn.Module, lr: float, sparse_embedding: bool = False):
+    r"""Build the optimizer used by the runners.
+
+    Args:
+        model: the model to optimize
+        lr: learning rate
+        sparse_embedding: whether the embedding tables of the model are built with `sparse=True`,
+            if so, the parameters are split into a sparse group (lazy adam, without weight decay)
+            and a dense group (AdamW), otherwise plain `torch.optim.AdamW` is returned.
+    """
+    if not sparse_embedding:
+        return torch.optim.AdamW(model.parameters(), lr=lr)
+
+    sparse_params, dense_params = split_sparse_dense_params(model)
+    param_groups: List[Dict] = [
+        {"params": sparse_params, "weight_decay": 0.0},
+        {"params": dense_params},
+    ]
+    return SparseAwareAdamW(param_groups, lr=lr)
+
+
+@torch.no_grad()
+def clip_grad_norm_(parameters: Iterable[torch.Tensor], max_norm: float, eps: float = 1e-6):
+    """Same as `torch.nn.utils.clip_grad_norm_`, but also works with sparse gradients."""
+    parameters = [p for p in parameters if p.grad is not None]
+    if len(parameters) == 0:
+        return torch.tensor(0.)
+
+    norms = []
+    for p in parameters:
+        if p.grad.is_sparse:
+            p.grad = p.grad.coalesce()  # 合并重复的行，否则范数不对
+            norms.append(p.grad.values().norm(2))
+        else:
+            norms.append(p.grad.norm(2))
+    total_norm = torch.stack(norms).norm(2)
+
+    clip_coef = min(max_norm / (total_norm.item() + eps), 1.0)
+    for p in parameters:
+        p.grad.mul_(clip_coef)
+    return total_norm
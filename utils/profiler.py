@@ -0,0 +1,133 @@
+r"""
+Stage-level profiling: wrap named stages in timing regions, aggregate p50/p95 per stage,
+and export a Chrome trace (chrome://tracing, https://ui.perfetto.dev) plus a summary table.
+
+The global `profiler` is disabled by default, then `profiler.region(name)` is a shared no-op context manager,
+so the regions can stay in the code paths at (almost) no cost.
+
+Example::
+
+    >>> from utils.profiler import profiler
+    >>> profiler.enable()
+    >>> with profiler.region("gnn"):
+    >>>     ...
+    >>> profiler.export(path_dir_results, "run_backbone")
+"""
+import os
+import json
+import threading
+import time
+import numpy as np
+import pandas as pd
+import torch
+
+from collections import defaultdict
+from contextlib import nullcontext
+from typing import Dict, List
+
+
+_NULL_REGION = nullcontext()
+
+
+class _Region:
+    __slots__ = ("profiler", "name", "record_function", "start_ns")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        # 同时在torch.profiler的时间线上标出这个阶段（未运行torch.profiler时几乎无开销）
+        self.record_function = torch.profiler.record_function(name)
+
+    def __enter__(self):
+        self.record_function.__enter__()
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end_ns = time.perf_counter_ns()
+        self.record_function.__exit__(exc_type, exc_val, exc_tb)
+        self.profiler._record(self.name, self.start_ns, end_ns)
+        return False
+
+
+class StageProfiler:
+    def __init__(self):
+        self.enabled = False
+        self.max_trace_events = 0
+        self.durations: Dict[str, List[int]] = defaultdict(list)  # ns
+        self.trace_events: List[Dict] = []
+        self._origin_ns = time.perf_counter_ns()
+
+    def enable(self, max_trace_events: int = 1_000_000):
+        """开启计时；Chrome trace最多保留`max_trace_events`个事件，避免长时间训练时占用过多内存（统计量不受影响）"""
+        self.enabled = True
+        self.max_trace_events = max_trace_events
+        self.reset()
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.durations.clear()
+        self.trace_events.clear()
+        self._origin_ns = time.perf_counter_ns()
+
+    def region(self, name: str):
+        if not self.enabled:
+            return _NULL_REGION
+        return _Region(self, name)
+
+    def _record(self, name, start_ns, end_ns):
+        self.durations[name].append(end_ns - start_ns)
+        if len(self.trace_events) < self.max_trace_events:
+            self.trace_events.append({
+                "name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                "ts": (start_ns - self._origin_ns) / 1e3, "dur": (end_ns - start_ns) / 1e3,  # 单位：us
+            })
+
+    def summary(self) -> pd.DataFrame:
+        rows = []
+        for name, durations in self.durations.items():
+            durations_ms = np.asarray(durations, dtype=np.float64) / 1e6
+            rows.append({
+                "stage": name,
+                "count": len(durations_ms),
+                "total_s": durations_ms.sum() / 1e3,
+                "mean_ms": durations_ms.mean(),
+                "p50_ms": np.percentile(durations_ms, 50),
+                "p95_ms": np.percentile(durations_ms, 95),
+                "max_ms": durations_ms.max(),
+            })
+        columns = ["stage", "count", "total_s", "mean_ms", "p50_ms", "p95_ms", "max_ms"]
+        return pd.DataFrame(rows, columns=columns).sort_values("total_s", ascending=False, ignore_index=True)
+
+    def export(self, path_dir: str, prefix: str):
+        """在`path_dir`下写出 {prefix}_profile_summary.csv 和 {prefix}_profile_trace.json，返回summary"""
+        os.makedirs(path_dir, exist_ok=True)
+        summary = self.summary()
+        summary.to_csv(os.path.join(path_dir, f"{prefix}_profile_summary.csv"), index=False)
+        with open(os.path.join(path_dir, f"{prefix}_profile_trace.json"), "w") as f:
+            json.dump({"traceEvents": self.trace_events, "displayTimeUnit": "ms"}, f)
+        return summary
+
+
+profiler = StageProfiler()
+
+
+def build_torch_profiler(path_dir: str, prefix: str, wait_steps: int, active_steps: int):
+    r"""Run `torch.profiler` for a bounded window of steps: skip `wait_steps`, warm up 1 step,
+    then record `active_steps` steps (call `.step()` once per training step), and export a Chrome trace
+    to {path_dir}/{prefix}_torch_trace.json.
+    """
+    os.makedirs(path_dir, exist_ok=True)
+    trace_path = os.path.join(path_dir, f"{prefix}_torch_trace.json")
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=wait_steps, warmup=1, active=active_steps, repeat=1),
+        on_trace_ready=lambda prof: prof.export_chrome_trace(trace_path),
+        record_shapes=True,
+        profile_memory=True,
+    )
@@ -0,0 +1,153 @@
+r"""
+Throughput and resource metrics of a training run, written as JSON lines to `run_log.jsonl`.
+
+One line per validation interval (`event="interval"`) and one line per run (`event="run"`), e.g.:
+    {"event": "interval", "run_id": "...", "runner": "run_backbone", "epoch": 0, "iter": 1200,
+     "admissions_per_s": 5.1, "interactions_per_s": 812.3, "edges_per_s": 2961.0, "avg_step_ms": 196.1,
+     "data_wait_s": 21.7, "compute_s": 213.5, "data_wait_ratio": 0.09, "valid_s": 35.2, "valid_loss": 0.31,
+     "peak_rss_mb": 10240.5, "num_threads": 16, "num_interop_threads": 16, "world_size": 1, ...}
+
+In distributed training the numbers are those of the logging rank (rank 0), `world_size` is recorded alongside.
+"""
+import json
+import os
+import time
+import torch
+
+from contextlib import contextmanager
+from typing import Dict
+
+from utils.misc import get_peak_rss_mb, file_lock
+
+
+class _Counters:
+    def __init__(self):
+        self.steps = 0
+        self.admissions = 0
+        self.interactions = 0
+        self.edges = 0
+        self.data_wait = 0.
+        self.compute = 0.
+        self.valid = 0.
+        self.start = time.perf_counter()
+
+    def to_dict(self):
+        elapsed = time.perf_counter() - self.start
+        train_time = max(self.data_wait + self.compute, 1e-9)
+        return {
+            "steps": self.steps,
+            "admissions": self.admissions,
+            "interactions": self.interactions,
+            "edges": self.edges,
+            "admissions_per_s": self.admissions / train_time,
+            "interactions_per_s": self.interactions / train_time,
+            "edges_per_s": self.edges / train_time,
+            "avg_step_ms": 1e3 * train_time / max(self.steps, 1),
+            "data_wait_s": self.data_wait,
+            "compute_s": self.compute,
+            "data_wait_ratio": self.data_wait / train_time,
+            "valid_s": self.valid,
+            "elapsed_s": elapsed,
+        }
+
+
+class ThroughputMeter:
+    r"""Measure the training throughput, splitting the time of each step into data-wait and compute.
+
+    Args:
+        path_dir: the directory of `run_log.jsonl`
+        runner: name of the running script
+        run_info: extra fields written in every line (model name, notes, world size...)
+        enabled: write the log or not (e.g. only on the main process), the measurement is cheap anyway
+
+    Example::
+
+        >>> meter = ThroughputMeter(args.path_dir_results, "run_baseline", {"model": "DIN"})
+        >>> for i, batch in enumerate(loader):
+        >>>     meter.data_ready()  # 数据已就绪，之前的时间计为data-wait
+        >>>     ...  # forward / backward / step
+        >>>     with meter.validating():  # 验证的时间不计入训练吞吐
+        >>>         ...
+        >>>     meter.step_done(admissions=..., interactions=..., edges=...)
+        >>>     meter.log_interval(epoch=0, iter=i, valid_loss=...)  # 每次验证之后
+        >>> meter.log_run()
+    """
+
+    def __init__(self, path_dir: str, runner: str, run_info: Dict = None, enabled: bool = True):
+        self.path_file = os.path.join(path_dir, "run_log.jsonl")
+        self.runner = runner
+        self.run_info = run_info or {}
+        self.enabled = enabled
+        self.run_id = f"{time.strftime('%Y%m%d_%H%M%S', time.gmtime())}_{os.getpid()}"
+
+        self._total = _Counters()
+        self._interval = _Counters()
+        self._last_step_end = time.perf_counter()
+        self._step_start = None
+        self._step_excluded = 0.
+
+    def data_ready(self):
+        now = time.perf_counter()
+        for counters in (self._total, self._interval):
+            counters.data_wait += now - self._last_step_end
+        self._step_start = now
+        self._step_excluded = 0.
+
+    @contextmanager
+    def validating(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self._step_excluded += duration
+            for counters in (self._total, self._interval):
+                counters.valid += duration
+
+    def step_done(self, admissions: int = 0, interactions: int = 0, edges: int = 0):
+        now = time.perf_counter()
+        compute = now - (self._step_start if self._step_start is not None else self._last_step_end) - self._step_excluded
+        for counters in (self._total, self._interval):
+            counters.steps += 1
+            counters.admissions += admissions
+            counters.interactions += interactions
+            counters.edges += edges
+            counters.compute += compute
+        self._last_step_end = now
+        self._step_start = None
+        self._step_excluded = 0.
+
+    def _resources(self):
+        return {
+            "peak_rss_mb": get_peak_rss_mb(),
+            "num_threads": torch.get_num_threads(),
+            "num_interop_threads": torch.get_num_interop_threads(),
+        }
+
+    def _write(self, row: Dict):
+        if not self.enabled:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path_file)), exist_ok=True)
+        with file_lock(self.path_file), open(self.path_file, "a") as f:
+            f.write(json.dumps(row, default=str) + "\n")
+
+    def _row(self, event, counters, extra):
+        return {
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
+            "event": event,
+            "run_id": self.run_id,
+            "runner": self.runner,
+            **counters.to_dict(),
+            **self._resources(),
+            **self.run_info,
+            **extra,
+        }
+
+    def log_interval(self, **extra):
+        """记录上次调用以来（一个验证间隔）的吞吐量，然后重新计数"""
+        self._write(self._row("interval", self._interval, extra))
+        self._interval = _Counters()
+
+    def log_run(self, **extra):
+        """记录整个训练过程的吞吐量"""
+        self._write(self._row("run", self._total, extra))